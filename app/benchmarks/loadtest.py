@@ -0,0 +1,223 @@
+from gevent import monkey
+monkey.patch_all()  # noqa
+
+import argparse
+import collections
+import json
+import os
+import subprocess
+import sys
+import time
+
+import gevent.pool
+import redis
+import requests
+
+from benchmarks.process import APP_DIR, free_port
+from benchmarks.results import (
+    build_result, print_comparison, print_metrics, save_result,
+    summarize_latencies)
+from benchmarks.traffic import ReplayMix, TrafficMix, seed_cache
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, weight = part.split('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def parse_range(value):
+    if '-' in value:
+        low, high = value.split('-')
+        return int(low), int(high)
+    return int(value), int(value)
+
+
+def spawn_server(args):
+    port = free_port()
+    env = dict(os.environ)
+    env['BENCH_HOT_KEYS'] = str(args.hot_keys)
+    if args.redis_url:
+        env['BENCH_REDIS_URL'] = args.redis_url
+
+    server = subprocess.Popen([
+        sys.executable, '-c',
+        'from gunicorn.app.wsgiapp import run; run()',
+        '-c', 'gunicorn.conf',
+        '--bind', '127.0.0.1:{}'.format(port),
+        '--workers', str(args.workers),
+        '--access-logfile', '/dev/null',
+        'benchmarks.wsgi:application',
+    ], cwd=APP_DIR, env=env)
+
+    target = 'http://127.0.0.1:{}'.format(port)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(target + '/__lbheartbeat__', timeout=1)
+            return server, target
+        except requests.RequestException:
+            time.sleep(0.2)
+
+    server.kill()
+    raise SystemExit('gunicorn did not start within 30 seconds')
+
+
+class RedisCommandCounter(object):
+
+    def __init__(self, session, target, redis_client):
+        self.session = session
+        self.target = target
+        self.redis_client = redis_client
+
+    def total(self):
+        if self.redis_client is not None:
+            # Subtract the INFO call itself.
+            return self.redis_client.info('stats')[
+                'total_commands_processed'] - 1
+
+        response = self.session.get(self.target + '/__bench__/stats')
+        commands = response.json().get('redis_commands')
+        return sum(commands.values()) if commands is not None else None
+
+
+def run_load(session, target, traffic, total_requests, concurrency):
+    latencies = collections.defaultdict(list)
+    statuses = collections.Counter()
+    requests_iter = iter(traffic)
+
+    def send(method, path, urls):
+        started = time.time()
+        try:
+            if method == 'POST':
+                response = session.post(
+                    target + path,
+                    data=json.dumps({'urls': urls}),
+                    headers={'content-type': 'application/json'},
+                )
+            else:
+                response = session.get(target + path)
+            response.content
+            statuses[response.status_code] += 1
+        except requests.RequestException:
+            statuses['error'] += 1
+            return
+
+        latencies[path].append((time.time() - started) * 1000)
+
+    pool = gevent.pool.Pool(concurrency)
+    started = time.time()
+    for _ in range(total_requests):
+        pool.spawn(send, *next(requests_iter))
+    pool.join()
+    elapsed = time.time() - started
+
+    return latencies, statuses, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test the proxy web tier.')
+    parser.add_argument(
+        '--target', help='Base URL of a running proxy. '
+        'Omit to spawn gunicorn with benchmarks.wsgi.')
+    parser.add_argument(
+        '--redis-url', help='Redis used by the app (redis://host:port/db). '
+        'Omit to use the in-memory stand-in, which requires --workers 1 '
+        'for exact command counts.')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--warmup', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument(
+        '--mix', type=parse_mix,
+        default=parse_mix('extract=0.6,metadata=0.3,recommendations=0.1'),
+        help='Endpoint weights, e.g. extract=0.6,recommendations=0.4')
+    parser.add_argument(
+        '--hit-ratio', type=float, default=0.9,
+        help='Fraction of URLs drawn from the seeded (cached) key set.')
+    parser.add_argument(
+        '--urls-per-request', type=parse_range, default=parse_range('1-25'),
+        help='URLs per POST, a number or a range like 5-25.')
+    parser.add_argument(
+        '--hot-keys', type=int, default=1000,
+        help='Number of seeded URLs per service.')
+    parser.add_argument(
+        '--skew', type=float, default=1.1,
+        help='Zipf exponent for hot key popularity, 0 for uniform.')
+    parser.add_argument(
+        '--replay', help='Replay requests from a .jsonl file instead.')
+    parser.add_argument('--output', help='Write results as JSON here.')
+    parser.add_argument('--compare', help='Baseline results JSON file.')
+    args = parser.parse_args()
+
+    redis_client = None
+    if args.redis_url:
+        redis_client = redis.StrictRedis.from_url(args.redis_url)
+        seed_cache(redis_client, args.hot_keys)
+
+    server = None
+    target = args.target
+    if target is None:
+        server, target = spawn_server(args)
+
+    if args.replay:
+        traffic = ReplayMix(args.replay)
+    else:
+        traffic = TrafficMix(
+            args.mix, args.hit_ratio, args.urls_per_request,
+            args.hot_keys, args.skew)
+
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=args.concurrency))
+
+    try:
+        run_load(session, target, traffic, args.warmup, args.concurrency)
+
+        counter = RedisCommandCounter(session, target, redis_client)
+        commands_before = counter.total()
+        latencies, statuses, elapsed = run_load(
+            session, target, traffic, args.requests, args.concurrency)
+        commands_after = counter.total()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    all_latencies = [
+        latency for path_latencies in latencies.values()
+        for latency in path_latencies]
+
+    metrics = {
+        'requests_per_second': args.requests / elapsed,
+        'latency_ms': summarize_latencies(all_latencies),
+        'latency_ms_by_path': {
+            path: summarize_latencies(path_latencies)
+            for path, path_latencies in latencies.items()
+        },
+        'status_codes': {
+            str(status): count for status, count in statuses.items()},
+    }
+
+    if commands_before is not None and commands_after is not None:
+        metrics['redis_commands_per_request'] = (
+            float(commands_after - commands_before) / args.requests)
+
+    print_metrics(metrics)
+
+    config = dict(vars(args))
+    config['target'] = target
+    result = build_result('loadtest', config, metrics)
+
+    if args.output:
+        save_result(result, args.output)
+
+    if args.compare:
+        print_comparison(args.compare, metrics)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+import collections
+import fnmatch
+import time
+
+
+class MemoryRedis(object):
+    """An in-process stand-in for the subset of StrictRedis the proxy uses.
+
+    Every command is counted so a load test can report Redis commands per
+    request without a real server.  Lua scripts are not interpreted: a
+    registered script simply returns ``script_result``.
+    """
+
+    def __init__(self, script_result=1):
+        self.data = {}
+        self.expiry = {}
+        self.commands = collections.Counter()
+        self.script_result = script_result
+
+    def _count(self, command):
+        self.commands[command] += 1
+
+    def _alive(self, key):
+        expires_at = self.expiry.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+
+        return key in self.data
+
+    def _set(self, key, value, timeout=None):
+        self.data[key] = value
+        self.expiry.pop(key, None)
+        if timeout is not None:
+            self.expiry[key] = time.time() + timeout
+
+    def info(self, section=None):
+        self._count('info')
+        return {
+            'redis_version': '3.0.0',
+            'total_commands_processed': sum(self.commands.values()),
+        }
+
+    def ping(self):
+        self._count('ping')
+        return True
+
+    def get(self, key):
+        self._count('get')
+        return self.data.get(key) if self._alive(key) else None
+
+    def mget(self, keys, *args):
+        self._count('mget')
+        keys = list(keys) + list(args)
+        return [self.data.get(key) if self._alive(key) else None
+                for key in keys]
+
+    def set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        self._count('set')
+        if nx and self._alive(key):
+            return None
+        if xx and not self._alive(key):
+            return None
+        timeout = ex if ex is not None else (
+            px / 1000.0 if px is not None else None)
+        self._set(key, str(value), timeout)
+        return True
+
+    def setex(self, key, timeout, value):
+        self._count('setex')
+        self._set(key, str(value), timeout)
+        return True
+
+    def psetex(self, key, timeout_ms, value):
+        self._count('psetex')
+        self._set(key, str(value), timeout_ms / 1000.0)
+        return True
+
+    def delete(self, *keys):
+        self._count('delete')
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                removed += 1
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+        return removed
+
+    def exists(self, key):
+        self._count('exists')
+        return self._alive(key)
+
+    def expire(self, key, timeout):
+        self._count('expire')
+        if not self._alive(key):
+            return False
+        self.expiry[key] = time.time() + timeout
+        return True
+
+    def ttl(self, key):
+        self._count('ttl')
+        if not self._alive(key):
+            return -2
+        if key not in self.expiry:
+            return -1
+        return int(round(self.expiry[key] - time.time()))
+
+    def pttl(self, key):
+        self._count('pttl')
+        if not self._alive(key):
+            return -2
+        if key not in self.expiry:
+            return -1
+        return int((self.expiry[key] - time.time()) * 1000)
+
+    def incr(self, key, amount=1):
+        self._count('incr')
+        value = int(self.data.get(key, 0) if self._alive(key) else 0)
+        self.data[key] = str(value + amount)
+        return value + amount
+
+    def hmget(self, key, fields, *args):
+        self._count('hmget')
+        fields = list(fields) + list(args)
+        values = self.data.get(key, {}) if self._alive(key) else {}
+        return [values.get(field) for field in fields]
+
+    def hincrby(self, key, field, amount=1):
+        self._count('hincrby')
+        if not self._alive(key):
+            self.data[key] = {}
+        value = int(self.data[key].get(field, 0)) + amount
+        self.data[key][field] = str(value)
+        return value
+
+    def hgetall(self, key):
+        self._count('hgetall')
+        return dict(self.data[key]) if self._alive(key) else {}
+
+    def _zadd(self, key, nx, pairs):
+        if not self._alive(key):
+            self.data[key] = {}
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            if member not in self.data[key]:
+                added += 1
+            elif nx:
+                continue
+            self.data[key][member] = float(score)
+        return added
+
+    def zadd(self, key, *pairs):
+        self._count('zadd')
+        return self._zadd(key, False, pairs)
+
+    def execute_command(self, command, *args):
+        # Only the ZADD options redis-py 2.10 has no keywords for.
+        if command.upper() != 'ZADD':
+            raise NotImplementedError(command)
+        self._count('zadd')
+        key, args = args[0], list(args[1:])
+        nx = bool(args) and str(args[0]).upper() == 'NX'
+        return self._zadd(key, nx, args[1:] if nx else args)
+
+    def zrange(self, key, start, end, withscores=False):
+        self._count('zrange')
+        if not self._alive(key):
+            return []
+        members = sorted(
+            self.data[key].items(), key=lambda item: (item[1], item[0]))
+        members = members[start:None if end == -1 else end + 1]
+        return members if withscores else [member for member, _ in members]
+
+    def zscore(self, key, member):
+        self._count('zscore')
+        return self.data[key].get(member) if self._alive(key) else None
+
+    def zrem(self, key, *members):
+        self._count('zrem')
+        if not self._alive(key):
+            return 0
+        return len([
+            member for member in members
+            if self.data[key].pop(member, None) is not None])
+
+    def _in_range(self, score, low, high):
+        return float(low) <= score <= float(high)
+
+    def zcount(self, key, low, high):
+        self._count('zcount')
+        if not self._alive(key):
+            return 0
+        return len([
+            score for score in self.data[key].values()
+            if self._in_range(score, low, high)])
+
+    def zremrangebyscore(self, key, low, high):
+        self._count('zremrangebyscore')
+        if not self._alive(key):
+            return 0
+        members = [
+            member for member, score in self.data[key].items()
+            if self._in_range(score, low, high)]
+        for member in members:
+            del self.data[key][member]
+        return len(members)
+
+    def strlen(self, key):
+        self._count('strlen')
+        return len(self.data[key]) if self._alive(key) else 0
+
+    def scan_iter(self, match=None, count=None):
+        for key in list(self.data):
+            self._count('scan')
+            if self._alive(key) and (
+                    match is None or fnmatch.fnmatchcase(key, match)):
+                yield key
+
+    def flushdb(self):
+        self._count('flushdb')
+        self.data.clear()
+        self.expiry.clear()
+
+    def register_script(self, script):
+        def run_script(keys=[], args=[], client=None):
+            (client or self)._count('evalsha')
+            return self.script_result
+
+        return run_script
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MemoryPipeline(self)
+
+
+class MemoryPipeline(object):
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.calls = []
+
+    def __getattr__(self, name):
+        command = getattr(self.redis_client, name)
+
+        def queue_call(*args, **kwargs):
+            self.calls.append((command, args, kwargs))
+            return self
+
+        return queue_call
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.calls = []
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [command(*args, **kwargs) for command, args, kwargs in calls]
+
+
+StubJob = collections.namedtuple('StubJob', ['id'])
+
+
+class StubQueue(object):
+    """Accepts rq enqueues without running them, for web tier load tests."""
+
+    def __init__(self):
+        self.enqueued = 0
+
+    @property
+    def count(self):
+        return self.enqueued
+
+    def enqueue(self, *args, **kwargs):
+        self.enqueued += 1
+        return StubJob(str(self.enqueued))
@@ -0,0 +1,70 @@
+from gevent import monkey
+monkey.patch_all()  # noqa
+
+import argparse
+
+import requests
+
+from benchmarks.loadtest import run_load
+from benchmarks.results import (
+    build_result, print_comparison, print_metrics, save_result,
+    summarize_latencies)
+from benchmarks.traffic import TrafficMix
+
+
+def measure(target, args):
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=args.concurrency))
+    traffic = TrafficMix({'recommendations': 1}, 0, (0, 0), 1, 0)
+
+    run_load(session, target, traffic, args.warmup, args.concurrency)
+    latencies, statuses, elapsed = run_load(
+        session, target, traffic, args.requests, args.concurrency)
+
+    return {
+        'requests_per_second': args.requests / elapsed,
+        'latency_ms': summarize_latencies(
+            latencies['/v2/recommendations']),
+        'status_codes': {
+            str(status): count for status, count in statuses.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare /v2/recommendations served by the app '
+                    'directly and through the nginx micro-cache.')
+    parser.add_argument('--app-target', default='http://app:7001')
+    parser.add_argument('--nginx-target', default='http://nginx')
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--warmup', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--output', help='Write results as JSON here.')
+    parser.add_argument('--compare', help='Baseline results JSON file.')
+    args = parser.parse_args()
+
+    app_metrics = measure(args.app_target, args)
+    nginx_metrics = measure(args.nginx_target, args)
+
+    metrics = {
+        'app': app_metrics,
+        'nginx': nginx_metrics,
+        'throughput_gain': (
+            nginx_metrics['requests_per_second'] /
+            app_metrics['requests_per_second']),
+    }
+
+    print_metrics(metrics)
+
+    result = build_result('microcache', vars(args), metrics)
+
+    if args.output:
+        save_result(result, args.output)
+
+    if args.compare:
+        print_comparison(args.compare, metrics)
+
+
+if __name__ == '__main__':
+    main()
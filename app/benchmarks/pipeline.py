@@ -0,0 +1,204 @@
+import argparse
+import os
+import resource
+import signal
+import subprocess
+import sys
+import time
+
+from benchmarks.process import APP_DIR, free_port
+from benchmarks.results import (
+    build_result, print_comparison, print_metrics, save_result,
+    summarize_latencies)
+from benchmarks.traffic import cold_url
+from benchmarks.upstream import get_parser as get_upstream_parser
+
+
+SERVICES = {
+    'embedly': ('EMBEDLY_URL', '/1/extract', 'get_embedly_client'),
+    'mozilla': ('MOZILLA_URL', '/metadata', 'get_mozilla_client'),
+}
+
+
+def start_upstream(args, port):
+    command = [
+        sys.executable, '-m', 'benchmarks.upstream',
+        '--port', str(port),
+        '--latency-ms', str(args.latency_ms),
+        '--jitter-ms', str(args.jitter_ms),
+        '--error-rate', str(args.error_rate),
+        '--response-size', str(args.response_size),
+    ]
+    return subprocess.Popen(command, cwd=APP_DIR)
+
+
+def start_workers(args, env):
+    if args.url_queue:
+        command = [
+            sys.executable, '-m', 'proxy.workqueue',
+            '--service', args.service,
+            '--concurrency', str(args.concurrency),
+        ]
+    elif args.executor:
+        command = [
+            sys.executable, '-m', 'proxy.worker', '--child',
+            '--concurrency', str(args.concurrency),
+        ]
+    else:
+        command = [
+            sys.executable, '-c', 'from rq.cli import main; main()',
+            'worker', '--quiet',
+            '--url', 'redis://{host}:6379/0'.format(host=args.redis_host),
+            '--worker-class', args.worker_class,
+        ]
+
+    return [
+        subprocess.Popen(command, cwd=APP_DIR, env=env)
+        for _ in range(args.workers)
+    ]
+
+
+def redis_commands(metadata_client):
+    # GETs are left out, as the benchmark polls for cached URLs with them
+    # while the app reads the cache with MGET.
+    stats = metadata_client.redis_client.info('commandstats')
+    return sum(
+        command['calls'] for name, command in stats.items()
+        if name != 'cmdstat_get')
+
+
+def children_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def wait_until_cached(metadata_client, enqueued_at, timeout):
+    redis_client = metadata_client.cache_redis_client
+    cache_key = metadata_client._get_cache_key
+    sentinel = metadata_client.IN_JOB_QUEUE_JSON
+    pending = dict(enqueued_at)
+    cached_at = {}
+    deadline = time.time() + timeout
+
+    while pending and time.time() < deadline:
+        urls = list(pending)
+        pipeline = redis_client.pipeline(transaction=False)
+        for url in urls:
+            pipeline.get(cache_key(url))
+
+        now = time.time()
+        for url, value in zip(urls, pipeline.execute()):
+            if value is not None and value != sentinel:
+                cached_at[url] = now
+                del pending[url]
+
+        time.sleep(0.01)
+
+    return cached_at
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        parents=[get_upstream_parser()], conflict_handler='resolve',
+        description='Push cold URLs through the queue, workers and a fake '
+                    'upstream and measure fetch throughput.')
+    parser.add_argument('--redis-host', default='localhost',
+                        help='Redis on port 6379, db 0, as in production.')
+    parser.add_argument('--service', choices=sorted(SERVICES),
+                        default='embedly')
+    parser.add_argument('--urls', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--worker-class', default='rq.Worker')
+    parser.add_argument(
+        '--executor', action='store_true',
+        help='Run proxy.worker executor processes instead of rq workers.')
+    parser.add_argument(
+        '--concurrency', type=int, default=20,
+        help='Jobs, or URL batches, at once per worker process.')
+    parser.add_argument(
+        '--url-queue', action='store_true',
+        help='Queue URLs for proxy.workqueue workers instead of as jobs.')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument(
+        '--startup-delay', type=float, default=3,
+        help='Seconds to let workers boot before enqueueing.')
+    parser.add_argument('--output', help='Write results as JSON here.')
+    parser.add_argument('--compare', help='Baseline results JSON file.')
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    url_setting, upstream_path, client_factory = SERVICES[args.service]
+
+    env = dict(os.environ)
+    env.update({
+        'REDIS_URL': args.redis_host,
+        url_setting: 'http://127.0.0.1:{port}{path}'.format(
+            port=upstream_port, path=upstream_path),
+        'EMBEDLY_KEY': 'bench',
+        'URL_WORK_QUEUE': '1' if args.url_queue else '',
+    })
+    os.environ.update(env)
+
+    from proxy import app
+    metadata_client = getattr(app, client_factory)()
+    max_post_urls = app.get_config()['MAXIMUM_POST_URLS']
+
+    upstream = start_upstream(args, upstream_port)
+    cpu_before = children_cpu_seconds()
+    workers = start_workers(args, env)
+    time.sleep(args.startup_delay)
+    commands_before = redis_commands(metadata_client)
+
+    try:
+        urls = [cold_url() for _ in range(args.urls)]
+        enqueued_at = {}
+        started = time.time()
+        for offset in range(0, len(urls), max_post_urls):
+            request_urls = urls[offset:offset + max_post_urls]
+            metadata_client.extract_urls_async(request_urls)
+            now = time.time()
+            enqueued_at.update((url, now) for url in request_urls)
+        enqueue_seconds = time.time() - started
+
+        cached_at = wait_until_cached(
+            metadata_client, enqueued_at, args.timeout)
+        fetch_seconds = max(cached_at.values()) - started if cached_at else 0
+    finally:
+        for worker in workers:
+            worker.send_signal(signal.SIGTERM)
+        for worker in workers:
+            worker.wait()
+        worker_cpu = children_cpu_seconds() - cpu_before
+
+        upstream.terminate()
+        upstream.wait()
+
+    commands = redis_commands(metadata_client) - commands_before
+
+    fetched = len(cached_at)
+    metrics = {
+        'urls_fetched': fetched,
+        'urls_failed': args.urls - fetched,
+        'urls_per_second': fetched / fetch_seconds if fetch_seconds else 0,
+        'enqueue_ms_per_url': enqueue_seconds * 1000 / args.urls,
+        'enqueue_to_cached_ms': summarize_latencies([
+            (cached_at[url] - enqueued_at[url]) * 1000 for url in cached_at]),
+        'redis_commands_per_url': commands / float(args.urls),
+        # Includes worker process start up, amortized over --urls.
+        'worker_cpu_ms_per_url': (
+            worker_cpu * 1000 / fetched if fetched else None),
+    }
+
+    print_metrics(metrics)
+
+    result = build_result('pipeline', vars(args), metrics)
+
+    if args.output:
+        save_result(result, args.output)
+
+    if args.compare:
+        print_comparison(args.compare, metrics)
+
+
+if __name__ == '__main__':
+    main()
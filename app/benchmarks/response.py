@@ -0,0 +1,66 @@
+import argparse
+import json
+import timeit
+
+from benchmarks.results import (
+    build_result, print_comparison, print_metrics, save_result)
+from benchmarks.traffic import hot_url, url_metadata
+from proxy.api.views import dump_metadata_response
+
+
+def reparse_response(cached_values):
+    # The response path before cached values were passed through raw.
+    return json.dumps({
+        'urls': {
+            url: json.loads(cached) for url, cached in cached_values.items()
+        },
+        'error': '',
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time building a metadata response from cached values.')
+    parser.add_argument('--urls', type=int, default=25)
+    parser.add_argument('--response-size', type=int, default=500)
+    parser.add_argument('--iterations', type=int, default=5000)
+    parser.add_argument('--output', help='Write results as JSON here.')
+    parser.add_argument('--compare', help='Baseline results JSON file.')
+    args = parser.parse_args()
+
+    cached_values = {
+        hot_url(index): json.dumps(url_metadata(
+            hot_url(index), args.response_size))
+        for index in range(args.urls)
+    }
+
+    assert (json.loads(reparse_response(cached_values)) ==
+            json.loads(dump_metadata_response(cached_values)))
+
+    def time_us(func):
+        seconds = min(timeit.repeat(
+            lambda: func(cached_values), number=args.iterations, repeat=3))
+        return seconds * 1000000 / args.iterations
+
+    reparse_us = time_us(reparse_response)
+    passthrough_us = time_us(dump_metadata_response)
+
+    metrics = {
+        'reparse_us_per_response': reparse_us,
+        'passthrough_us_per_response': passthrough_us,
+        'speedup': reparse_us / passthrough_us,
+    }
+
+    print_metrics(metrics)
+
+    result = build_result('response', vars(args), metrics)
+
+    if args.output:
+        save_result(result, args.output)
+
+    if args.compare:
+        print_comparison(args.compare, metrics)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import json
+import platform
+import subprocess
+import time
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def summarize_latencies(latencies_ms):
+    latencies_ms = sorted(latencies_ms)
+
+    return {
+        'count': len(latencies_ms),
+        'mean': (sum(latencies_ms) / len(latencies_ms)
+                 if latencies_ms else None),
+        'p50': percentile(latencies_ms, 0.50),
+        'p95': percentile(latencies_ms, 0.95),
+        'p99': percentile(latencies_ms, 0.99),
+        'max': latencies_ms[-1] if latencies_ms else None,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_result(benchmark, config, metrics):
+    return {
+        'benchmark': benchmark,
+        'timestamp': int(time.time()),
+        'revision': git_revision(),
+        'host': platform.node(),
+        'config': config,
+        'metrics': metrics,
+    }
+
+
+def save_result(result, path):
+    with open(path, 'w') as result_file:
+        json.dump(result, result_file, indent=2, sort_keys=True)
+
+
+def flatten(metrics, prefix=''):
+    flat = {}
+    for name, value in metrics.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, '{}{}.'.format(prefix, name)))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + name] = value
+    return flat
+
+
+def print_metrics(metrics):
+    for name, value in sorted(flatten(metrics).items()):
+        print('{name:<48} {value:>14.3f}'.format(name=name, value=value))
+
+
+def print_comparison(baseline_path, metrics):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    print('')
+    print('Compared to {path} (revision {revision}):'.format(
+        path=baseline_path, revision=baseline.get('revision')))
+
+    before = flatten(baseline['metrics'])
+    after = flatten(metrics)
+
+    for name in sorted(set(before) & set(after)):
+        change = ''
+        if before[name]:
+            change = '{:+.1f}%'.format(
+                100.0 * (after[name] - before[name]) / before[name])
+
+        print('{name:<48} {before:>14.3f} {after:>14.3f} {change:>9}'.format(
+            name=name, before=before[name], after=after[name], change=change))
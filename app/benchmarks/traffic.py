@@ -0,0 +1,145 @@
+import bisect
+import hashlib
+import itertools
+import json
+import random
+import uuid
+
+
+ENDPOINTS = {
+    'extract': ('POST', '/v2/extract', 'embedly'),
+    'metadata': ('POST', '/v2/metadata', 'mozilla'),
+    'recommendations': ('GET', '/v2/recommendations', None),
+}
+
+HOT_DOMAINS = 50
+COLD_DOMAINS = 500
+
+
+def hot_url(index):
+    return 'http://hot{domain}.bench.example.com/page/{index}'.format(
+        domain=index % HOT_DOMAINS, index=index)
+
+
+def cold_url():
+    # Spread cold URLs across many hosts so the per-domain limiter does not
+    # turn a cache miss benchmark into a rate limiter benchmark.
+    return 'http://cold{domain}.bench.example.com/{token}'.format(
+        domain=random.randrange(COLD_DOMAINS), token=uuid.uuid4().hex)
+
+
+def url_metadata(url, size=0):
+    return {
+        'description': 'Benchmark page {url} {padding}'.format(
+            url=url, padding='x' * size),
+        'favicon_url': 'http://bench.example.com/favicon.ico',
+        'images': [{
+            'height': 100,
+            'url': 'http://bench.example.com/image.jpg',
+            'width': 100,
+        }],
+        'original_url': url,
+        'provider_name': 'Benchmark',
+        'title': 'Benchmark page',
+        'url': url,
+    }
+
+
+def recommended_urls(count=20):
+    return [{
+        'url': 'http://hot{i}.bench.example.com/recommended'.format(i=i),
+        'pocket_url': 'http://getpocket.com/bench/{i}'.format(i=i),
+        'timestamp': 1470000000000 + i,
+    } for i in range(count)]
+
+
+def seed_cache(redis_client, hot_keys, timeout=24 * 60 * 60):
+    services = set(
+        service for _, _, service in ENDPOINTS.values() if service)
+
+    pipeline = redis_client.pipeline(transaction=False)
+    for service in services:
+        for index in range(hot_keys):
+            url = hot_url(index)
+            pipeline.setex(
+                u'{service}:{url}'.format(service=service, url=url),
+                timeout,
+                json.dumps(url_metadata(url)),
+            )
+
+            if index % 1000 == 999:
+                pipeline.execute()
+
+    recommended_urls_json = json.dumps(recommended_urls())
+    pipeline.setex('POCKET_RECOMMENDED_URLS', timeout, recommended_urls_json)
+    pipeline.set('POCKET_RECOMMENDED_URLS_LAST_GOOD', recommended_urls_json)
+    pipeline.set(
+        'POCKET_RECOMMENDED_URLS_VERSION',
+        hashlib.sha1(recommended_urls_json).hexdigest())
+    pipeline.execute()
+
+
+class ZipfSampler(object):
+
+    def __init__(self, size, skew):
+        total = 0
+        self.cumulative = []
+        for rank in range(size):
+            total += 1.0 / ((rank + 1) ** skew)
+            self.cumulative.append(total)
+
+    def sample(self):
+        point = random.random() * self.cumulative[-1]
+        return bisect.bisect_left(self.cumulative, point)
+
+
+class TrafficMix(object):
+
+    def __init__(self, mix, hit_ratio, urls_per_request, hot_keys, skew):
+        self.endpoints = []
+        self.weights = []
+        for name, weight in sorted(mix.items()):
+            self.endpoints.append(name)
+            self.weights.append(
+                weight + (self.weights[-1] if self.weights else 0))
+
+        self.hit_ratio = hit_ratio
+        self.urls_per_request = urls_per_request
+        self.sampler = ZipfSampler(hot_keys, skew)
+
+    def pick_endpoint(self):
+        point = random.random() * self.weights[-1]
+        return self.endpoints[bisect.bisect_left(self.weights, point)]
+
+    def pick_urls(self):
+        low, high = self.urls_per_request
+        urls = set()
+        for _ in range(random.randint(low, high)):
+            if random.random() < self.hit_ratio:
+                urls.add(hot_url(self.sampler.sample()))
+            else:
+                urls.add(cold_url())
+        return list(urls)
+
+    def __iter__(self):
+        while True:
+            endpoint = self.pick_endpoint()
+            method, path, service = ENDPOINTS[endpoint]
+            yield method, path, self.pick_urls() if service else None
+
+
+class ReplayMix(object):
+    """Replays recorded requests, one JSON object per line:
+
+        {"endpoint": "extract", "urls": ["http://...", ...]}
+    """
+
+    def __init__(self, path):
+        with open(path) as replay_file:
+            self.records = [
+                json.loads(line) for line in replay_file if line.strip()]
+
+    def __iter__(self):
+        for record in itertools.cycle(self.records):
+            method, path, service = ENDPOINTS[record['endpoint']]
+            yield method, path, record.get('urls') if service else None
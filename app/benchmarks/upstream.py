@@ -0,0 +1,105 @@
+import argparse
+import json
+import random
+import time
+import urllib
+import urlparse
+
+import gevent
+from gevent.pywsgi import WSGIServer
+
+from benchmarks.traffic import recommended_urls, url_metadata
+
+
+class FakeUpstream(object):
+    """Serves Embedly, Mozilla and Pocket shaped responses.
+
+    * GET  /1/extract?urls=a,b   Embedly extract
+    * POST /metadata             Mozilla metadata service
+    * GET  /pocket               Pocket global recommendations
+    """
+
+    def __init__(self, latency_ms, jitter_ms, error_rate, response_size):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.response_size = response_size
+
+    def delay(self):
+        latency = self.latency_ms + random.uniform(
+            -self.jitter_ms, self.jitter_ms)
+        gevent.sleep(max(latency, 0) / 1000.0)
+
+    def respond(self, start_response, status, payload):
+        body = json.dumps(payload)
+        start_response(status, [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+    def embedly(self, environ):
+        params = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+        urls = [
+            urllib.unquote_plus(url)
+            for url in params.get('urls', [''])[0].split(',') if url]
+
+        return [url_metadata(url, self.response_size) for url in urls]
+
+    def mozilla(self, environ):
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        urls = json.loads(environ['wsgi.input'].read(length))['urls']
+
+        return {'urls': {
+            url: url_metadata(url, self.response_size) for url in urls}}
+
+    def pocket(self, environ):
+        return {'list': [{
+            'dedupe_url': recommended['url'],
+            'url': recommended['pocket_url'],
+            'published_timestamp': str(int(time.time())),
+        } for recommended in recommended_urls()]}
+
+    def __call__(self, environ, start_response):
+        routes = {
+            '/1/extract': self.embedly,
+            '/metadata': self.mozilla,
+            '/pocket': self.pocket,
+        }
+
+        handler = routes.get(environ['PATH_INFO'])
+        if handler is None:
+            return self.respond(start_response, '404 Not Found', {})
+
+        self.delay()
+
+        if random.random() < self.error_rate:
+            return self.respond(
+                start_response, '500 Internal Server Error', {'error': 'x'})
+
+        return self.respond(start_response, '200 OK', handler(environ))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Fake Embedly/Mozilla/Pocket upstream.')
+    parser.add_argument('--port', type=int, default=7101)
+    parser.add_argument('--latency-ms', type=float, default=150)
+    parser.add_argument('--jitter-ms', type=float, default=50)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument(
+        '--response-size', type=int, default=500,
+        help='Extra bytes of description per URL.')
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+
+    upstream = FakeUpstream(
+        args.latency_ms, args.jitter_ms, args.error_rate, args.response_size)
+    WSGIServer(('127.0.0.1', args.port), upstream, log=None).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import json
+import os
+
+import redis
+from flask import Response, current_app
+from rq import Queue
+
+from benchmarks.memory_redis import MemoryRedis, StubQueue
+from benchmarks.traffic import seed_cache
+from proxy.app import create_app
+
+
+def get_backend():
+    redis_url = os.environ.get('BENCH_REDIS_URL')
+
+    if redis_url:
+        redis_client = redis.StrictRedis.from_url(redis_url)
+        return redis_client, Queue(connection=redis_client)
+
+    redis_client = MemoryRedis()
+    seed_cache(redis_client, int(os.environ.get('BENCH_HOT_KEYS', 1000)))
+    redis_client.commands.clear()
+
+    return redis_client, StubQueue()
+
+
+def bench_stats():
+    redis_client = current_app.redis_client
+    commands = getattr(redis_client, 'commands', None)
+
+    return Response(json.dumps({
+        'pid': os.getpid(),
+        'redis_commands': dict(commands) if commands is not None else None,
+    }), status=200, mimetype='application/json')
+
+
+redis_client, job_queue = get_backend()
+
+application = create_app(redis_client=redis_client, job_queue=job_queue)
+application.add_url_rule('/__bench__/stats', 'bench_stats', bench_stats)
@@ -0,0 +1,199 @@
+import argparse
+import json
+import sys
+import time
+import urlparse
+
+from proxy.metadata import MetadataClient
+from proxy.sharding import get_nodes
+
+SERVICES = ('embedly', 'mozilla')
+
+# Upper bounds of the size (bytes) and TTL (seconds) histogram buckets.
+SIZE_BUCKETS = [2 ** power for power in range(6, 21)]
+TTL_BUCKETS = [60, 10 * 60, 60 * 60, 6 * 60 * 60, 12 * 60 * 60,
+               24 * 60 * 60, 7 * 24 * 60 * 60]
+
+
+def get_bucket(buckets, value):
+    for bucket in buckets:
+        if value <= bucket:
+            return '<={bucket}'.format(bucket=bucket)
+
+    return '>{bucket}'.format(bucket=buckets[-1])
+
+
+def get_domain(url):
+    return urlparse.urlsplit(url).hostname or ''
+
+
+class ServiceStats(object):
+
+    def __init__(self):
+        self.keys = 0
+        self.bytes = 0
+        self.sentinels = 0
+        self.no_ttl = 0
+        self.sizes = {}
+        self.ttls = {}
+        self.domains = {}
+
+    def add(self, url, size, ttl, is_sentinel):
+        self.keys += 1
+        self.bytes += size
+
+        if is_sentinel:
+            self.sentinels += 1
+        else:
+            size_bucket = get_bucket(SIZE_BUCKETS, size)
+            self.sizes[size_bucket] = self.sizes.get(size_bucket, 0) + 1
+
+        if ttl < 0:
+            self.no_ttl += 1
+        else:
+            ttl_bucket = get_bucket(TTL_BUCKETS, ttl / 1000)
+            self.ttls[ttl_bucket] = self.ttls.get(ttl_bucket, 0) + 1
+
+        domain = get_domain(url)
+        domain_keys, domain_bytes = self.domains.get(domain, (0, 0))
+        self.domains[domain] = (domain_keys + 1, domain_bytes + size)
+
+    def report(self, scale, top_domains):
+        domains = sorted(
+            self.domains.items(), key=lambda item: item[1][1], reverse=True)
+
+        return {
+            'keys': self.keys,
+            'bytes': self.bytes,
+            'estimated_keys': int(self.keys * scale),
+            'estimated_bytes': int(self.bytes * scale),
+            'mean_bytes': self.bytes / self.keys if self.keys else 0,
+            'sentinels': self.sentinels,
+            'no_ttl': self.no_ttl,
+            'sizes': self.sizes,
+            'ttls': self.ttls,
+            'top_domains': [
+                {'domain': domain, 'keys': keys, 'bytes': size}
+                for domain, (keys, size) in domains[:top_domains]
+            ],
+        }
+
+
+class CacheAnalyzer(object):
+    # Walks the cache nodes with SCAN and sizes each batch of keys with one
+    # pipeline of STRLEN, PTTL and a GETRANGE just long enough to recognize
+    # a sentinel, so values are never read.  With a sample, each node stops
+    # after that many keys; SCAN visits keys in hash order, which is as
+    # good as random for these URLs.
+
+    def __init__(self, cache_redis_client, batch_size, rate, sample,
+                 top_domains):
+        self.cache_redis_client = cache_redis_client
+        self.batch_size = batch_size
+        self.rate = rate
+        self.sample = sample
+        self.top_domains = top_domains
+        self.services = {service: ServiceStats() for service in SERVICES}
+        self.scanned = 0
+        self.total_keys = 0
+
+    def throttle(self, started):
+        if self.rate:
+            ahead = self.scanned / float(self.rate) - (time.time() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def analyze_batch(self, node, keys):
+        sentinel = MetadataClient.IN_JOB_QUEUE_JSON
+
+        pipeline = node.pipeline(transaction=False)
+        for key in keys:
+            pipeline.strlen(key).pttl(key).getrange(key, 0, len(sentinel))
+        results = pipeline.execute()
+
+        for index, key in enumerate(keys):
+            size, ttl, head = results[index * 3:index * 3 + 3]
+            service, _, url = key.partition(':')
+
+            # A key expired between SCAN and the pipeline has a TTL of -2.
+            if service in self.services and ttl != -2:
+                self.services[service].add(url, size, ttl, head == sentinel)
+
+        self.scanned += len(keys)
+
+    def analyze_node(self, node, started):
+        self.total_keys += node.dbsize()
+
+        batch = []
+        scanned = 0
+        for key in node.scan_iter(count=self.batch_size):
+            batch.append(key)
+            scanned += 1
+
+            if len(batch) >= self.batch_size:
+                self.analyze_batch(node, batch)
+                batch = []
+                self.throttle(started)
+
+            if self.sample and scanned >= self.sample:
+                break
+
+        if batch:
+            self.analyze_batch(node, batch)
+
+    def run(self):
+        started = time.time()
+
+        for node in get_nodes(self.cache_redis_client):
+            self.analyze_node(node, started)
+
+        scale = self.total_keys / float(self.scanned) if self.scanned else 0
+
+        return {
+            'scanned_keys': self.scanned,
+            'total_keys': self.total_keys,
+            'services': {
+                service: stats.report(scale, self.top_domains)
+                for service, stats in self.services.items()
+            },
+        }
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Report the size, TTL and domain breakdown of the '
+                    'metadata cache as JSON.')
+    parser.add_argument(
+        '--sample', type=int, default=0,
+        help='Keys to scan per node, 0 to scan every key.')
+    parser.add_argument(
+        '--batch-size', type=int, default=500,
+        help='Keys per SCAN call and pipeline.')
+    parser.add_argument(
+        '--rate', type=float, default=5000,
+        help='Most keys inspected per second, 0 for no limit.')
+    parser.add_argument(
+        '--top-domains', type=int, default=20,
+        help='Domains using the most memory to list per service.')
+    return parser
+
+
+def main():  # pragma: no cover
+    from proxy.app import get_cache_redis_client
+
+    args = get_parser().parse_args()
+
+    report = CacheAnalyzer(
+        get_cache_redis_client(),
+        batch_size=args.batch_size,
+        rate=args.rate,
+        sample=args.sample,
+        top_domains=args.top_domains,
+    ).run()
+
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
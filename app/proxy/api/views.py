@@ -1,44 +1,138 @@
+import hashlib
 import json
+import time
 
-import redis
 from flask import Blueprint, current_app, request as Request, Response
 from werkzeug.exceptions import HTTPException
 
+from proxy.metadata import group_by
 from proxy.stats import statsd_client
 
 
 blueprint = Blueprint('views', __name__)
 
+STREAM_MIMETYPE = 'application/x-ndjson'
 
-def fail(response_data, status, error_msg):
+
+def dump_metadata_response(url_data, error=''):
+    # url_data values are raw JSON from the cache, so only the envelope is
+    # serialized here.
+    return '{{"urls": {{{urls}}}, "error": {error}}}'.format(
+        urls=', '.join(
+            '{url}: {data}'.format(url=json.dumps(url), data=data)
+            for url, data in url_data.items()
+        ),
+        error=json.dumps(error),
+    )
+
+
+def get_cache_headers(digest, max_age):
+    return {
+        'Cache-Control': 'public, max-age={max_age}'.format(max_age=max_age),
+        'ETag': '"{digest}"'.format(digest=digest),
+    }
+
+
+def is_not_modified(request, etag):
+    if_none_match = request.headers.get('If-None-Match', '')
+    return etag in [tag.strip() for tag in if_none_match.split(',')]
+
+
+def fail(response_data, status, error_msg, headers=None):
     response_data['error'] = error_msg
     raise HTTPException(response=Response(
         json.dumps(response_data),
         status=status,
         mimetype='application/json',
+        headers=headers,
     ))
 
 
+def fail_quota(response_data, e):
+    fail(response_data, 429, e.message,
+         headers={'Retry-After': str(e.retry_after)})
+
+
+def get_quota_exception(metadata_client):
+    # Caught through the client's quota, as under gunicorn the app imports
+    # its modules outside the proxy package.  With quotas off an empty
+    # tuple catches nothing.
+    if metadata_client.quota is None:
+        return ()
+
+    return metadata_client.quota.QuotaException
+
+
+def take_request_quota(metadata_client, request, response_data):
+    # Returns the consumer whose quota any uncached URLs are taken from, or
+    # None when quotas are off.
+    if metadata_client.quota is None:
+        return None
+
+    consumer = metadata_client.quota.get_consumer(request)
+
+    try:
+        metadata_client.quota.take(consumer, 'requests', 1)
+    except metadata_client.quota.QuotaException, e:
+        fail_quota(response_data, e)
+
+    return consumer
+
+
+HEALTH_STATUS_CODES = {
+    'ok': 200,
+    # Still serving, but load balancers that weigh backends by status should
+    # send it less traffic.
+    'degraded': 429,
+    'dead': 503,
+}
+
+
 @blueprint.route('/__heartbeat__')
 def heartbeat():
     status = 200
 
-    # Check cache connectivity
-    try:
-        current_app.redis_client.ping()
-        statsd_client.incr('heartbeat.pass')
-    except redis.ConnectionError:
+    # Check cache connectivity, as of the last background probe
+    report = current_app.health_monitor.get_report()
+
+    if report['status'] == current_app.health_monitor.DEAD:
         statsd_client.incr('heartbeat.fail')
         status = 500
+    else:
+        statsd_client.incr('heartbeat.pass')
 
     return Response('', status=status)
 
 
+@blueprint.route('/__health__')
+def health():
+    report = current_app.health_monitor.get_report()
+
+    return Response(
+        json.dumps(report),
+        status=HEALTH_STATUS_CODES[report['status']],
+        mimetype='application/json',
+    )
+
+
 @blueprint.route('/__lbheartbeat__')
 def lbheartbeat():
     return Response('', status=200)
 
 
+@blueprint.route('/__metrics__')
+def metrics():
+    # Served only when the workers share their metrics, as under gunicorn.
+    if statsd_client.metrics is None:
+        return Response('', status=404)
+
+    return Response(
+        statsd_client.metrics.render(),
+        status=200,
+        content_type='text/plain; version=0.0.4',
+    )
+
+
 @blueprint.route('/__version__')
 def version():
     return Response(
@@ -62,6 +156,8 @@ def get_metadata(metadata_client, config, request):
             mimetype='application/json',
         ))
 
+    consumer = take_request_quota(metadata_client, request, response_data)
+
     if request.content_type and 'application/json' not in request.content_type:
         fail(
             response_data,
@@ -75,37 +171,186 @@ def get_metadata(metadata_client, config, request):
         fail(response_data, 400,
              'POST content must be a JSON encoded dictionary {urls: [...]}')
 
-    if len(urls) > config['MAXIMUM_POST_URLS']:
+    streaming = STREAM_MIMETYPE in request.headers.get('Accept', '')
+    maximum_urls = config[
+        'MAXIMUM_STREAM_URLS' if streaming else 'MAXIMUM_POST_URLS']
+
+    if len(urls) > maximum_urls:
         fail(response_data, 400, (
             'A single request must contain '
             'at most {max} URLs in the POST body.'
-        ).format(max=config['MAXIMUM_POST_URLS']))
+        ).format(max=maximum_urls))
 
     if not all(urls):
         fail(response_data, 400, 'Do not send empty or null URLs.')
 
+    # Repeated, malformed and blocked URLs are left out of the response
+    # rather than failing the rest of the request.
+    netlocs = metadata_client.preprocess_urls(urls)
+    urls = netlocs.keys()
+
+    if streaming:
+        try:
+            wait = min(
+                float(request.args.get('wait', 0)),
+                config['MAXIMUM_STREAM_WAIT'],
+            )
+        except ValueError:
+            fail(response_data, 400, 'The wait parameter must be a number.')
+
+        return Response(
+            stream_metadata(
+                metadata_client, config, urls, wait, netlocs, consumer),
+            status=200,
+            mimetype=STREAM_MIMETYPE,
+            headers={'X-Accel-Buffering': 'no'},
+        )
+
     try:
-        response_data['urls'] = metadata_client.extract_urls_async(urls)
+        url_data = metadata_client.extract_urls_async(
+            urls, netlocs, consumer)
     except metadata_client.MetadataClientException, e:
         fail(response_data, 500, e.message)
+    except get_quota_exception(metadata_client), e:
+        # The quota protects the upstream services, so the cached URLs are
+        # still served and only the rest are refused.
+        return Response(
+            dump_metadata_response(e.url_data, e.message),
+            status=200,
+            mimetype='application/json',
+            headers={'Retry-After': str(e.retry_after)},
+        )
 
     return Response(
-        json.dumps(response_data),
+        dump_metadata_response(url_data),
         status=200,
         mimetype='application/json',
     )
 
 
+def stream_metadata(metadata_client, config, urls, wait, netlocs=None,
+                    consumer=None):
+    # Writes one JSON line per URL as soon as its metadata is available and
+    # a final line carrying the error, so a truncated stream is detectable.
+    def dump_line(url, data):
+        return '{{"url": {url}, "data": {data}}}\n'.format(
+            url=json.dumps(url), data=data)
+
+    pending = []
+    quota_error = None
+
+    try:
+        for url_batch in group_by(urls, config['MAXIMUM_POST_URLS']):
+            # Once over its quota a consumer is only sent cached URLs, and
+            # the stream does not wait for the ones it could not queue.
+            if quota_error is not None:
+                url_data = metadata_client.get_completed_urls(url_batch)
+            else:
+                try:
+                    url_data = metadata_client.extract_urls_async(
+                        url_batch, netlocs, consumer)
+                except get_quota_exception(metadata_client), e:
+                    quota_error = e
+                    url_data = e.url_data
+                else:
+                    pending.extend(
+                        url for url in url_batch if url not in url_data)
+
+            for url, data in url_data.items():
+                yield dump_line(url, data)
+
+        deadline = time.time() + wait
+
+        while pending and time.time() < deadline:
+            time.sleep(config['STREAM_POLL_INTERVAL'])
+
+            url_data = metadata_client.get_completed_urls(pending)
+
+            for url, data in url_data.items():
+                yield dump_line(url, data)
+
+            pending = [url for url in pending if url not in url_data]
+    except metadata_client.MetadataClientException, e:
+        yield json.dumps({'error': e.message}) + '\n'
+    else:
+        yield json.dumps({
+            'error': quota_error.message if quota_error else ''}) + '\n'
+
+
+def get_single_metadata(metadata_client, config, request):
+    response_data = {
+        'urls': {},
+        'error': '',
+    }
+
+    consumer = take_request_quota(metadata_client, request, response_data)
+
+    url = request.args.get('url')
+
+    if not url:
+        fail(response_data, 400, 'The url query parameter is required.')
+
+    url_data = None
+    netlocs = metadata_client.preprocess_urls([url])
+
+    if netlocs:
+        try:
+            url_data, ttl = metadata_client.get_cached_url_with_ttl(url)
+
+            if url_data is None:
+                metadata_client.queue_urls(
+                    [url], netlocs=netlocs, consumer=consumer)
+        except metadata_client.MetadataClientException, e:
+            fail(response_data, 500, e.message)
+        except get_quota_exception(metadata_client), e:
+            fail_quota(response_data, e)
+
+    if url_data is None or url_data == metadata_client.IN_JOB_QUEUE_JSON:
+        return Response(
+            dump_metadata_response({}),
+            status=200,
+            mimetype='application/json',
+            headers={'Cache-Control': 'no-cache'},
+        )
+
+    # The ETag is derived from the stored bytes so a conditional request is
+    # answered without deserializing the metadata.
+    headers = get_cache_headers(
+        hashlib.sha1(url_data).hexdigest(), max(ttl, 0))
+
+    if is_not_modified(request, headers['ETag']):
+        return Response(status=304, headers=headers)
+
+    return Response(
+        dump_metadata_response({url: url_data}),
+        status=200,
+        mimetype='application/json',
+        headers=headers,
+    )
+
+
 @blueprint.route('/v2/extract', methods=['POST'])
 def embedly_metadata():
     return get_metadata(
         current_app.embedly_client, current_app.config, Request)
 
 
+@blueprint.route('/v2/extract', methods=['GET'])
+def embedly_single_metadata():
+    return get_single_metadata(
+        current_app.embedly_client, current_app.config, Request)
+
+
 @blueprint.route('/v2/metadata', methods=['POST'])
 def mozilla_metadata():
     return get_metadata(
-        current_app.mozilla_client, current_app.config, Request)
+        current_app.metadata_client, current_app.config, Request)
+
+
+@blueprint.route('/v2/metadata', methods=['GET'])
+def mozilla_single_metadata():
+    return get_single_metadata(
+        current_app.metadata_client, current_app.config, Request)
 
 
 @blueprint.route('/v2/recommendations', methods=['GET'])
@@ -116,13 +361,29 @@ def get_recommended_urls():
     }
 
     try:
-        response_data['urls'] = (
+        version, urls_json = (
             current_app.pocket_client.get_recommended_urls())
     except current_app.pocket_client.PocketException, e:
         fail(response_data, 500, e.message)
 
+    # The list is held serialized by the pocket client, so only the
+    # envelope is added here.
+    response_body = '{{"urls": {urls}, "error": ""}}'.format(urls=urls_json)
+
+    # No version means the recommendations are being fetched, so the empty
+    # list must not be held by nginx or clients.
+    if version is None:
+        headers = {'Cache-Control': 'no-cache'}
+    else:
+        headers = get_cache_headers(
+            version, current_app.config['RECOMMENDATIONS_MAX_AGE'])
+
+        if is_not_modified(Request, headers['ETag']):
+            return Response(status=304, headers=headers)
+
     return Response(
-        json.dumps(response_data),
+        response_body,
         status=200,
         mimetype='application/json',
+        headers=headers,
     )
@@ -7,36 +7,199 @@ from raven.contrib.flask import Sentry
 from rq import Queue
 
 import api.views
-from metadata import EmbedlyClient, MozillaClient
+from health import HealthMonitor, UpstreamResults, WorkerRegistry
+from lock import RedisLock
+from metadata import EmbedlyClient, MozillaClient, ProviderChainClient
 from pocket import PocketClient
+from pool import MonitoredConnectionPool
+from popularity import CountMinSketch, PopularityPolicy, get_sketch_width
+from quota import ConsumerQuota
+from replicas import ReplicaRedis
+from scheduler import RecommendationsScheduler
+from sharding import ShardedRedis
+from worker import JobExecutor
+from workqueue import URLQueue
 
 
 def get_config():
     return {
+        'ADMISSION_TIMEOUT': 10 * 60,  # 10 minutes for URLs not admitted
         'BLOCKED_DOMAINS': ['embedly.com'],
+        'CACHE_ADMISSION': {
+            service: {
+                # Requests in POPULARITY_WINDOW before a URL is cached in
+                # full, and what to do until then: short or skip.  1 turns
+                # admission off.
+                'min_requests': int(os.environ.get(
+                    '{}_ADMISSION_MIN_REQUESTS'.format(service.upper()), 1)),
+                'reject': os.environ.get(
+                    '{}_ADMISSION_REJECT'.format(service.upper()), 'short'),
+            }
+            for service in ('embedly', 'mozilla')
+        },
+        # Comma separated name:key pairs of consumers sending X-Api-Key.
+        'CONSUMER_API_KEYS': {
+            key: name for name, _, key in (
+                consumer.partition(':') for consumer
+                in os.environ.get('CONSUMER_API_KEYS', '').split(','))
+            if key},
+        # Proxies in front of the app that append to X-Forwarded-For: nginx,
+        # plus a load balancer in front of it if there is one.
+        'CONSUMER_PROXY_HOPS': int(os.environ.get('CONSUMER_PROXY_HOPS', 1)),
+        # Token buckets per consumer, refilled at rate tokens a second up to
+        # burst tokens.
+        'CONSUMER_QUOTA': os.environ.get('CONSUMER_QUOTA', '') == '1',
+        'CONSUMER_QUOTA_LIMITS': {
+            'requests': {'rate': 5, 'burst': 50},
+            'urls': {'rate': 10, 'burst': 200},  # uncached URLs queued
+        },
         'EMBEDLY_KEY': os.environ.get('EMBEDLY_KEY', None),
-        'EMBEDLY_URL': 'https://api.embedly.com/1/extract',
+        'HEALTH_CHECK_INTERVAL': 5,  # 5 seconds between probes
+        # Past any of these the instance reports itself degraded.
+        'HEALTH_LIMITS': {
+            'pool_saturation': 0.9,  # share of a pool checked out
+            'queue_age': 5 * 60,  # 5 minutes for the oldest queued fetch
+            'queue_depth': 10000,
+            'redis_latency_ms': 100,
+            'upstream_error_rate': 0.25,
+            'upstream_requests': 20,  # at least, to judge the error rate
+            'workers': 1,
+        },
+        'EMBEDLY_URL': os.environ.get(
+            'EMBEDLY_URL', 'https://api.embedly.com/1/extract'),
+        # Embedly is only asked for the URLs Mozilla misses once it is
+        # listed here, e.g. mozilla,embedly.
+        'METADATA_PROVIDERS': os.environ.get(
+            'METADATA_PROVIDERS', 'mozilla').split(','),
         'MOZILLA_URL': os.environ.get('MOZILLA_URL', None),
         'JOB_TTL': 300,
         'MAXIMUM_POST_URLS': 25,
-        'POCKET_URL': (
+        'MAXIMUM_STREAM_URLS': 1000,
+        'MAXIMUM_STREAM_WAIT': 10,  # 10 seconds
+        'POCKET_URL': os.environ.get('POCKET_URL', (
             'https://getpocket.com/v3/firefox/'
-            'global-recs?consumer_key={pocket_key}').format(
+            'global-recs?consumer_key={pocket_key}')).format(
                 pocket_key=os.environ.get('POCKET_KEY', None)),
+        'POPULARITY_DEPTH': 4,
+        'POPULARITY_FLUSH_INTERVAL': 5,  # write counts every 5 seconds
+        'POPULARITY_FLUSH_SIZE': 1000,  # or once 1000 counters are pending
+        'POPULARITY_HOT_COUNT': 20,  # requests a window for the full timeout
+        # URL requests counted a window, cache hits included, which sets the
+        # width of the sketch.
+        'POPULARITY_REQUESTS': int(
+            os.environ.get('POPULARITY_REQUESTS', 200000)),
+        'POPULARITY_WINDOW': 60 * 60,  # 1 hour sliding window
+        'PROVIDER_HEDGE_MIN_SAMPLES': 20,
+        'PROVIDER_HEDGE_PERCENTILE': 95,
+        'PROVIDER_LATENCY_SAMPLES': 200,
         'POCKET_DATA_TIMEOUT': 10 * 60,  # 10 minutes timeout
+        'POCKET_REFRESH_INTERVAL': 30,  # 30 seconds between checks
+        'POCKET_REFRESH_MARGIN': 3 * 60,  # refresh 3 minutes before expiry
+        'RECOMMENDATIONS_MAX_AGE': 60,  # 1 minute client and nginx cache
+        'REDIS_CACHE_URLS': [
+            host for host in os.environ.get('REDIS_CACHE_URLS', '').split(',')
+            if host],
+        'REDIS_CONNECT_TIMEOUT': 1,  # 1 second to open a connection
         'REDIS_DATA_TIMEOUT': 24 * 60 * 60,  # 24 hour timeout
+        'REDIS_HEALTH_CHECK_INTERVAL': 30,  # ping connections idle 30s
         'REDIS_JOB_TIMEOUT': 60 * 60,  # 1 hour timeout
+        'REDIS_MAX_CONNECTIONS': int(os.environ.get(
+            'REDIS_MAX_CONNECTIONS', 50)),  # per process and redis node
+        'REDIS_MIN_DATA_TIMEOUT': 60 * 60,  # 1 hour for one-off URLs
+        'REDIS_POOL_TIMEOUT': 1,  # 1 second wait for a free connection
+        'REDIS_POOL_WAIT_THRESHOLD': 1,  # report checkout waits over 1ms
+        'REDIS_REPLICA_URLS': [
+            replica_set.split(',') for replica_set
+            in os.environ.get('REDIS_REPLICA_URLS', '').split(';')
+            if replica_set],
+        'REDIS_SOCKET_TIMEOUT': 2,  # 2 seconds per command
         'REDIS_URL': os.environ.get('REDIS_URL', None),
+        'SCHEDULER_LEADER_TIMEOUT': 90,  # 90 seconds leader lock
         'SENTRY_DSN': os.environ.get('SENTRY_DSN', ''),
         'SENTRY_PROCESSORS': ('raven.processors.RemovePostDataProcessor',),
+        'STREAM_POLL_INTERVAL': 0.25,  # 250 milliseconds
+        'UPSTREAM_RESULTS_WINDOW': 60,  # 1 minute windows
         'URL_BATCH_SIZE': 5,
+        'URL_QUEUE_BATCH_SIZE': 100,  # URLs a queue worker takes at once
+        # Queue URLs on per service lists for proxy.workqueue instead of as
+        # rq jobs.
+        'URL_WORK_QUEUE': os.environ.get('URL_WORK_QUEUE', '') == '1',
+        'WORKER_CONCURRENCY': 20,  # jobs at once per executor process
+        'WORKER_HEARTBEAT_TIMEOUT': 30,  # 30 seconds without one is dead
+        'WORKER_JOB_TIMEOUT': 180,  # for jobs queued without a timeout
+        'WORKER_PROCESSES': int(os.environ.get('WORKER_PROCESSES', 2)),
+        'WORKER_SHUTDOWN_TIMEOUT': 30,  # 30 seconds to finish running jobs
     }
 
 
+# One pool per process and redis node.  Tasks build their clients for
+# every job, and in a long lived worker they reuse the pooled connections.
+connection_pools = {}
+
+
+def get_redis_connection_pool(name, host, port=6379):
+    config = get_config()
+
+    if (name, host, port) not in connection_pools:
+        connection_pools[(name, host, port)] = MonitoredConnectionPool(
+            name=name,
+            health_check_interval=config['REDIS_HEALTH_CHECK_INTERVAL'],
+            max_connections=config['REDIS_MAX_CONNECTIONS'],
+            timeout=config['REDIS_POOL_TIMEOUT'],
+            wait_threshold=config['REDIS_POOL_WAIT_THRESHOLD'],
+            host=host,
+            port=port,
+            db=0,
+            socket_connect_timeout=config['REDIS_CONNECT_TIMEOUT'],
+            socket_timeout=config['REDIS_SOCKET_TIMEOUT'],
+        )
+
+    return connection_pools[(name, host, port)]
+
+
 def get_redis_client():  # pragma: nocover
     config = get_config()
 
-    return redis.StrictRedis(host=config['REDIS_URL'], port=6379, db=0)
+    return redis.StrictRedis(connection_pool=get_redis_connection_pool(
+        'primary', config['REDIS_URL']))
+
+
+def get_node_redis_client(name, redis_url):
+    host, _, port = redis_url.partition(':')
+
+    return redis.StrictRedis(connection_pool=get_redis_connection_pool(
+        name, host, int(port or 6379)))
+
+
+def get_cache_redis_client(redis_client=None):
+    config = get_config()
+
+    # Without dedicated cache nodes the cache shares the queue's redis.
+    if not config['REDIS_CACHE_URLS']:
+        cache_redis_client = redis_client or get_redis_client()
+    else:
+        cache_redis_client = ShardedRedis({
+            cache_url: get_node_redis_client('cache', cache_url)
+            for cache_url in config['REDIS_CACHE_URLS']
+        })
+
+    if not config['REDIS_REPLICA_URLS']:
+        return cache_redis_client
+
+    # Each replica set lists one replica per cache node, in the same order,
+    # and is hashed by the node names so keys map to the same shard.
+    replicas = []
+    for replica_urls in config['REDIS_REPLICA_URLS']:
+        if not config['REDIS_CACHE_URLS']:
+            replicas.append(get_node_redis_client('replica', replica_urls[0]))
+        else:
+            replicas.append(ShardedRedis({
+                cache_url: get_node_redis_client('replica', replica_url)
+                for cache_url, replica_url
+                in zip(config['REDIS_CACHE_URLS'], replica_urls)
+            }))
+
+    return ReplicaRedis(cache_redis_client, replicas)
 
 
 def get_job_queue(redis_client=None):
@@ -45,36 +208,144 @@ def get_job_queue(redis_client=None):
     return Queue(connection=redis_client)
 
 
-def get_metadata_client_args(redis_client=None, job_queue=None):
+def get_popularity_policy(redis_client=None):
+    config = get_config()
+
+    # Admission reads the same counts, so the sketch is sized for the
+    # smallest count either acts on.
+    threshold = min([config['POPULARITY_HOT_COUNT']] + [
+        policy['min_requests']
+        for policy in config['CACHE_ADMISSION'].values()
+        if policy['min_requests'] > 1])
+
+    return PopularityPolicy(
+        CountMinSketch(
+            redis_client or get_redis_client(),
+            'POPULARITY',
+            width=get_sketch_width(config['POPULARITY_REQUESTS'], threshold),
+            depth=config['POPULARITY_DEPTH'],
+            window=config['POPULARITY_WINDOW'],
+            flush_size=config['POPULARITY_FLUSH_SIZE'],
+            flush_interval=config['POPULARITY_FLUSH_INTERVAL'],
+        ),
+        hot_count=config['POPULARITY_HOT_COUNT'],
+        min_timeout=config['REDIS_MIN_DATA_TIMEOUT'],
+        max_timeout=config['REDIS_DATA_TIMEOUT'],
+    )
+
+
+def get_upstream_results(redis_client=None):
+    config = get_config()
+
+    return UpstreamResults(
+        redis_client or get_redis_client(), config['UPSTREAM_RESULTS_WINDOW'])
+
+
+def get_worker_registry(redis_client=None):
     config = get_config()
 
+    return WorkerRegistry(
+        redis_client or get_redis_client(), config['WORKER_HEARTBEAT_TIMEOUT'])
+
+
+def get_consumer_quota(redis_client=None):
+    config = get_config()
+
+    return ConsumerQuota(
+        redis_client or get_redis_client(),
+        config['CONSUMER_QUOTA_LIMITS'],
+        config['CONSUMER_API_KEYS'],
+        config['CONSUMER_PROXY_HOPS'],
+    )
+
+
+def get_metadata_client_args(redis_client=None, job_queue=None,
+                             cache_redis_client=None):
+    config = get_config()
+    redis_client = redis_client or get_redis_client()
+
     return {
-        'redis_client': redis_client or get_redis_client(),
+        'redis_client': redis_client,
         'redis_data_timeout': config['REDIS_DATA_TIMEOUT'],
         'redis_job_timeout': config['REDIS_JOB_TIMEOUT'],
         'blocked_domains': config['BLOCKED_DOMAINS'],
         'job_queue': job_queue or get_job_queue(),
         'job_ttl': config['JOB_TTL'],
         'url_batch_size': config['URL_BATCH_SIZE'],
+        'cache_redis_client': (
+            cache_redis_client or get_cache_redis_client(redis_client)),
+        'popularity': get_popularity_policy(redis_client),
+        'admission_policies': config['CACHE_ADMISSION'],
+        'admission_timeout': config['ADMISSION_TIMEOUT'],
+        'url_queue': (
+            URLQueue(redis_client) if config['URL_WORK_QUEUE'] else None),
+        'upstream_results': get_upstream_results(redis_client),
+        'quota': (
+            get_consumer_quota(redis_client)
+            if config['CONSUMER_QUOTA'] else None),
     }
 
 
-def get_embedly_client(redis_client=None, job_queue=None):
+def get_embedly_client(redis_client=None, job_queue=None,
+                       cache_redis_client=None):
     config = get_config()
 
     return EmbedlyClient(
         embedly_url=config['EMBEDLY_URL'],
         embedly_key=config['EMBEDLY_KEY'],
-        **get_metadata_client_args(redis_client, job_queue)
+        **get_metadata_client_args(
+            redis_client, job_queue, cache_redis_client)
     )
 
 
-def get_mozilla_client(redis_client=None, job_queue=None):
+def get_mozilla_client(redis_client=None, job_queue=None,
+                       cache_redis_client=None):
     config = get_config()
 
     return MozillaClient(
         mozilla_url=config['MOZILLA_URL'],
-        **get_metadata_client_args(redis_client, job_queue)
+        **get_metadata_client_args(
+            redis_client, job_queue, cache_redis_client)
+    )
+
+
+def get_provider_chain_client(redis_client=None, job_queue=None,
+                              cache_redis_client=None):
+    config = get_config()
+    redis_client = redis_client or get_redis_client()
+    cache_redis_client = (
+        cache_redis_client or get_cache_redis_client(redis_client))
+
+    provider_factories = {
+        'embedly': get_embedly_client,
+        'mozilla': get_mozilla_client,
+    }
+
+    return ProviderChainClient(
+        service_name='mozilla',
+        providers=[
+            provider_factories[provider](
+                redis_client, job_queue, cache_redis_client)
+            for provider in config['METADATA_PROVIDERS']
+        ],
+        latency_samples=config['PROVIDER_LATENCY_SAMPLES'],
+        hedge_min_samples=config['PROVIDER_HEDGE_MIN_SAMPLES'],
+        hedge_percentile=config['PROVIDER_HEDGE_PERCENTILE'],
+        **get_metadata_client_args(
+            redis_client, job_queue, cache_redis_client)
+    )
+
+
+def get_job_executor(redis_client=None, job_queue=None, concurrency=None):
+    config = get_config()
+    job_queue = job_queue or get_job_queue(redis_client)
+
+    return JobExecutor(
+        job_queue,
+        concurrency or config['WORKER_CONCURRENCY'],
+        config['WORKER_JOB_TIMEOUT'],
+        config['WORKER_SHUTDOWN_TIMEOUT'],
+        worker_registry=get_worker_registry(job_queue.connection),
     )
 
 
@@ -90,6 +361,37 @@ def get_pocket_client(redis_client=None, job_queue=None):
     )
 
 
+def get_recommendations_scheduler(redis_client=None, job_queue=None):
+    config = get_config()
+    redis_client = redis_client or get_redis_client()
+
+    return RecommendationsScheduler(
+        get_pocket_client(redis_client, job_queue),
+        RedisLock(
+            redis_client,
+            'POCKET_RECOMMENDED_URLS_SCHEDULER_LEADER',
+            config['SCHEDULER_LEADER_TIMEOUT'],
+        ),
+        config['POCKET_REFRESH_MARGIN'],
+        config['POCKET_REFRESH_INTERVAL'],
+    )
+
+
+def get_health_monitor(redis_client, cache_redis_client, metadata_clients):
+    config = get_config()
+
+    return HealthMonitor(
+        redis_client,
+        cache_redis_client,
+        metadata_clients,
+        get_worker_registry(redis_client),
+        get_upstream_results(redis_client),
+        connection_pools,
+        config['HEALTH_CHECK_INTERVAL'],
+        config['HEALTH_LIMITS'],
+    )
+
+
 def create_app(redis_client=None, job_queue=None):
     config = get_config()
 
@@ -101,14 +403,23 @@ def create_app(redis_client=None, job_queue=None):
 
     app.redis_client = redis_client or get_redis_client()
 
+    app.cache_redis_client = get_cache_redis_client(app.redis_client)
+
     app.job_queue = job_queue or get_job_queue(app.redis_client)
 
-    app.embedly_client = get_embedly_client(app.redis_client, app.job_queue)
+    app.embedly_client = get_embedly_client(
+        app.redis_client, app.job_queue, app.cache_redis_client)
 
-    app.mozilla_client = get_mozilla_client(app.redis_client, app.job_queue)
+    app.metadata_client = get_provider_chain_client(
+        app.redis_client, app.job_queue, app.cache_redis_client)
 
     app.pocket_client = get_pocket_client(app.redis_client, app.job_queue)
 
+    # The mozilla client shares the provider chain's queue and cache.
+    app.health_monitor = get_health_monitor(
+        app.redis_client, app.cache_redis_client,
+        [app.embedly_client, app.metadata_client])
+
     app.config['VERSION_INFO'] = ''
     if os.path.exists('./version.json'):  # pragma: no cover
         with open('./version.json') as version_file:
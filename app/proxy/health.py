@@ -0,0 +1,224 @@
+import os
+import socket
+import time
+
+import gevent
+import redis
+from rq import Worker
+
+from proxy.stats import statsd_client
+
+
+class UpstreamResults(object):
+    # Counts upstream request results per service in redis, where the web
+    # processes can read what the workers saw.  Counts are kept per window
+    # and read for the current and previous window.
+
+    def __init__(self, redis_client, window):
+        self.redis_client = redis_client
+        self.window = window
+
+    def _get_window_key(self, window):
+        return 'UPSTREAM_RESULTS:{window}'.format(window=window)
+
+    def record(self, service, success):
+        window_key = self._get_window_key(int(time.time() / self.window))
+
+        # Like the statsd counters they sit beside, results are advisory and
+        # a failure to count one never fails the request.
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.hincrby(window_key, '{service}:{result}'.format(
+                service=service,
+                result='success' if success else 'failure'), 1)
+            pipeline.expire(window_key, self.window * 2)
+            pipeline.execute()
+        except redis.RedisError:
+            statsd_client.incr('upstream_results_write_fail')
+
+    def get_counts(self):
+        window = int(time.time() / self.window)
+
+        counts = {}
+        for window_key in (self._get_window_key(window),
+                           self._get_window_key(window - 1)):
+            for field, count in self.redis_client.hgetall(window_key).items():
+                service, _, result = field.rpartition(':')
+                service_counts = counts.setdefault(
+                    service, {'success': 0, 'failure': 0})
+                service_counts[result] += int(count)
+
+        return counts
+
+
+class WorkerRegistry(object):
+    # Executor and URL queue worker processes are not registered with rq,
+    # so they note that they are alive in a sorted set instead.
+
+    KEY = 'WORKER_HEARTBEATS'
+
+    def __init__(self, redis_client, timeout):
+        self.redis_client = redis_client
+        self.timeout = timeout
+        self.name = '{host}:{pid}'.format(
+            host=socket.gethostname(), pid=os.getpid())
+        self.beaten_at = 0
+
+    def beat(self):
+        # Called on every pass of a worker loop, so it only writes a few
+        # times a timeout.
+        now = time.time()
+        if now - self.beaten_at < self.timeout / 3.0:
+            return
+
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.zadd(self.KEY, now, self.name)
+            pipeline.zremrangebyscore(self.KEY, '-inf', now - self.timeout)
+            pipeline.execute()
+            self.beaten_at = now
+        except redis.RedisError:
+            statsd_client.incr('worker_heartbeat_fail')
+
+    def count(self):
+        return self.redis_client.zcount(
+            self.KEY, time.time() - self.timeout, '+inf')
+
+
+class HealthMonitor(object):
+    # Probes redis, the fetch queues, the workers, upstream results and the
+    # connection pools every interval in a background greenlet, so health
+    # checks return the last report straight away.  The instance is dead
+    # when redis cannot be reached, and degraded when any probe is past
+    # its limit, so traffic can be moved before it falls over.
+
+    OK = 'ok'
+    DEGRADED = 'degraded'
+    DEAD = 'dead'
+
+    def __init__(self, redis_client, cache_redis_client, metadata_clients,
+                 worker_registry, upstream_results, connection_pools,
+                 interval, limits):
+        self.redis_client = redis_client
+        self.cache_redis_client = cache_redis_client
+        self.metadata_clients = metadata_clients
+        self.worker_registry = worker_registry
+        self.upstream_results = upstream_results
+        self.connection_pools = connection_pools
+        self.interval = interval
+        self.limits = limits
+        self.report = None
+
+    def _get_ping_time(self, redis_client):
+        started = time.time()
+        redis_client.ping()
+        return int((time.time() - started) * 1000)
+
+    def _probe_redis(self, report):
+        report['redis_latency_ms'] = max(
+            self._get_ping_time(self.redis_client),
+            self._get_ping_time(self.cache_redis_client))
+
+        if report['redis_latency_ms'] > self.limits['redis_latency_ms']:
+            report['problems'].append('redis_latency')
+
+    def _probe_queues(self, report):
+        report['queues'] = {}
+
+        for metadata_client in self.metadata_clients:
+            queued_at = metadata_client.get_oldest_queued_at()
+            queue = {
+                'depth': metadata_client.get_queue_size(),
+                'oldest_age': (
+                    int(report['checked_at'] - queued_at)
+                    if queued_at is not None else 0),
+            }
+            report['queues'][metadata_client.SERVICE_NAME] = queue
+
+            if queue['depth'] > self.limits['queue_depth']:
+                report['problems'].append('{service}_queue_depth'.format(
+                    service=metadata_client.SERVICE_NAME))
+            if queue['oldest_age'] > self.limits['queue_age']:
+                report['problems'].append('{service}_queue_age'.format(
+                    service=metadata_client.SERVICE_NAME))
+
+    def _probe_workers(self, report):
+        report['workers'] = (
+            len(Worker.all(connection=self.redis_client)) +
+            self.worker_registry.count())
+
+        if report['workers'] < self.limits['workers']:
+            report['problems'].append('workers')
+
+    def _probe_upstream(self, report):
+        report['upstream'] = {}
+
+        for service, counts in self.upstream_results.get_counts().items():
+            requests = counts['success'] + counts['failure']
+            error_rate = counts['failure'] / float(requests)
+            report['upstream'][service] = {
+                'requests': requests,
+                'error_rate': error_rate,
+            }
+
+            if (requests >= self.limits['upstream_requests'] and
+                    error_rate > self.limits['upstream_error_rate']):
+                report['problems'].append('{service}_upstream_errors'.format(
+                    service=service))
+
+    def _probe_pools(self, report):
+        report['pool_saturation'] = {
+            '{name}:{host}:{port}'.format(name=name, host=host, port=port):
+            pool.get_saturation()
+            for (name, host, port), pool in self.connection_pools.items()
+        }
+
+        if any(saturation > self.limits['pool_saturation']
+               for saturation in report['pool_saturation'].values()):
+            report['problems'].append('pool_saturation')
+
+    def probe(self):
+        report = {'checked_at': time.time(), 'problems': []}
+
+        try:
+            self._probe_redis(report)
+        except redis.RedisError:
+            statsd_client.incr('health_dead')
+            report['problems'].append('redis')
+            report['status'] = self.DEAD
+            return report
+
+        # With redis up, a probe that fails only leaves its part of the
+        # report out.
+        for probe in (self._probe_queues, self._probe_workers,
+                      self._probe_upstream, self._probe_pools):
+            try:
+                probe(report)
+            except Exception:
+                report['problems'].append(
+                    '{probe}_failed'.format(probe=probe.__name__[7:]))
+
+        if report['problems']:
+            statsd_client.incr('health_degraded')
+            report['status'] = self.DEGRADED
+        else:
+            report['status'] = self.OK
+
+        return report
+
+    def get_report(self):
+        # Until the background greenlet runs, or if it has stopped, the
+        # report is refreshed in the request instead.
+        if (self.report is None or
+                time.time() - self.report['checked_at'] > self.interval * 3):
+            self.report = self.probe()
+
+        return self.report
+
+    def run(self):
+        while True:
+            self.report = self.probe()
+            gevent.sleep(self.interval)
+
+    def start(self):
+        return gevent.spawn(self.run)
@@ -0,0 +1,57 @@
+import uuid
+
+import redis
+
+
+class RedisLock(object):
+    # Renewing and releasing only succeed while the key still holds our
+    # token, so an expired lock taken over by another process is left alone.
+    RENEW_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+        end
+        return 0
+    """
+
+    RELEASE_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    """
+
+    class LockException(Exception):
+        pass
+
+    def __init__(self, redis_client, key, timeout, token=None):
+        self.redis_client = redis_client
+        self.key = key
+        self.timeout = timeout
+        self.token = token or uuid.uuid4().hex
+        self._renew = redis_client.register_script(self.RENEW_SCRIPT)
+        self._release = redis_client.register_script(self.RELEASE_SCRIPT)
+
+    def acquire(self):
+        try:
+            return bool(self.redis_client.set(
+                self.key, self.token, px=int(self.timeout * 1000), nx=True))
+        except redis.RedisError:
+            raise self.LockException('Unable to acquire lock in redis.')
+
+    def renew(self):
+        try:
+            return bool(self._renew(
+                keys=[self.key],
+                args=[self.token, int(self.timeout * 1000)],
+            ))
+        except redis.RedisError:
+            raise self.LockException('Unable to renew lock in redis.')
+
+    def acquire_or_renew(self):
+        return self.renew() or self.acquire()
+
+    def release(self):
+        try:
+            return bool(self._release(keys=[self.key], args=[self.token]))
+        except redis.RedisError:
+            raise self.LockException('Unable to release lock in redis.')
@@ -1,4 +1,6 @@
+import Queue
 import json
+import threading
 import time
 import urllib
 import urlparse
@@ -7,8 +9,10 @@ import redis
 import requests
 import rratelimit
 
+from proxy.preprocess import URLPreprocessor
 from proxy.stats import statsd_client
-from proxy.tasks import fetch_embedly_data, fetch_mozilla_data
+from proxy.tasks import (
+    fetch_embedly_data, fetch_mozilla_data, fetch_provider_chain_data)
 from proxy.schema import EmbedlyURLSchema
 
 
@@ -20,19 +24,33 @@ def group_by(items, size):
 
 class MetadataClient(object):
     IN_JOB_QUEUE = 'in job queue'
+    IN_JOB_QUEUE_JSON = json.dumps(IN_JOB_QUEUE)
 
     class MetadataClientException(Exception):
         pass
 
     def __init__(self, redis_client, redis_data_timeout, redis_job_timeout,
-                 blocked_domains, job_queue, job_ttl, url_batch_size):
+                 blocked_domains, job_queue, job_ttl, url_batch_size,
+                 cache_redis_client=None, popularity=None,
+                 admission_policies=None, admission_timeout=None,
+                 url_queue=None, upstream_results=None, quota=None):
+        # The cache may be sharded across its own nodes, while the rate
+        # limiter stays with the job queue.
         self.redis_client = redis_client
+        self.cache_redis_client = cache_redis_client or redis_client
         self.redis_data_timeout = redis_data_timeout
         self.redis_job_timeout = redis_job_timeout
         self.schema = EmbedlyURLSchema(blocked_domains=blocked_domains)
+        self.preprocessor = URLPreprocessor(blocked_domains)
         self.job_queue = job_queue
         self.job_ttl = job_ttl
         self.url_batch_size = url_batch_size
+        self.popularity = popularity
+        self.admission_policies = admission_policies
+        self.admission_timeout = admission_timeout
+        self.url_queue = url_queue
+        self.upstream_results = upstream_results
+        self.quota = quota
         self.domain_limiter = rratelimit.SimpleLimiter(
             redis=self.redis_client,
             action='domain_limit',
@@ -43,45 +61,217 @@ class MetadataClient(object):
     def _get_cache_key(self, url):
         return u'{service}:{url}'.format(service=self.SERVICE_NAME, url=url)
 
-    def _get_cached_url(self, url):
+    def _record_requests(self, urls):
+        if self.popularity is not None:
+            self.popularity.record(
+                [self._get_cache_key(url) for url in urls])
+
+    def _get_request_counts(self, urls):
+        if self.popularity is None:
+            return None
+
+        counts = self.popularity.get_counts(
+            [self._get_cache_key(url) for url in urls])
+
+        return {url: counts[self._get_cache_key(url)] for url in urls}
+
+    def _get_admission_policy(self):
+        # Every URL has been requested at least once, so min_requests of 1
+        # admits them all and admission is off.
+        policy = (self.admission_policies or {}).get(self.SERVICE_NAME)
+
+        if policy is None or policy['min_requests'] <= 1:
+            return None
+
+        return policy
+
+    def _is_admitted(self, count):
+        # URLs are fetched and cached in full only once they have been
+        # requested min_requests times, so one-off URLs do not each take a
+        # cache entry for REDIS_DATA_TIMEOUT.
+        policy = self._get_admission_policy()
+
+        return (count is None or policy is None or
+                count >= policy['min_requests'])
+
+    def _get_cache_timeouts(self, urls):
+        counts = self._get_request_counts(urls)
+
+        if counts is None:
+            return {url: self.redis_data_timeout for url in urls}
+
+        return {
+            url: (self.popularity.get_timeout(counts[url])
+                  if self._is_admitted(counts[url])
+                  else min(self.admission_timeout,
+                           self.popularity.get_timeout(counts[url])))
+            for url in urls
+        }
+
+    def get_cached_url_with_ttl(self, url):
+        self._record_requests([url])
+
         cache_key = self._get_cache_key(url)
 
         try:
-            cached_data = self.redis_client.get(cache_key)
+            pipeline = self.cache_redis_client.pipeline(transaction=False)
+            pipeline.get(cache_key)
+            pipeline.ttl(cache_key)
+            cached_data, ttl = pipeline.execute()
         except redis.RedisError:
             raise self.MetadataClientException('Unable to read from redis.')
 
         if cached_data is not None:
             statsd_client.incr('redis_cache_hit')
-            try:
-                return json.loads(cached_data)
-            except ValueError:
-                raise self.MetadataClientException(
-                    ('Unable to load JSON data '
-                     'from cache for key: {key}').format(key=cache_key))
         else:
             statsd_client.incr('redis_cache_miss')
 
+        return cached_data, ttl
+
     def _set_cached_url(self, url, data, timeout):
         cache_key = self._get_cache_key(url)
 
         try:
-            self.redis_client.setex(cache_key, timeout, json.dumps(data))
+            self.cache_redis_client.setex(
+                cache_key, timeout, json.dumps(data))
             statsd_client.incr('redis_cache_write')
         except redis.RedisError:
             raise self.MetadataClientException('Unable to write to redis.')
 
-    def _queue_url_jobs(self, urls):
+    def _get_misses_key(self):
+        return 'MISSES:{service}'.format(service=self.SERVICE_NAME)
+
+    def _record_misses(self, urls):
+        # Only a URL's first miss is kept, so one queued again after a
+        # failed fetch is still timed from when it was first missed.
+        members = []
+        for url in urls:
+            members.extend([time.time(), url])
+
+        try:
+            self.redis_client.execute_command(
+                'ZADD', self._get_misses_key(), 'NX', *members)
+        except redis.RedisError:
+            statsd_client.incr('freshness_write_fail')
+
+    def _record_freshness(self, urls, started, fetched):
+        # Misses older than a sentinel's timeout were never filled, as
+        # filled URLs are removed here.
+        misses_key = self._get_misses_key()
+
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for url in urls:
+                pipeline.zscore(misses_key, url)
+            if urls:
+                pipeline.zrem(misses_key, *urls)
+            missed_at = pipeline.execute()[:len(urls)]
+
+            unfilled = self.redis_client.zremrangebyscore(
+                misses_key, '-inf', time.time() - self.redis_job_timeout)
+        except redis.RedisError:
+            statsd_client.incr('freshness_read_fail')
+            return
+
+        cached = time.time()
+        for missed in missed_at:
+            if missed is not None:
+                statsd_client.timing(
+                    '{service}_freshness_queue_wait'.format(
+                        service=self.SERVICE_NAME),
+                    int((started - missed) * 1000))
+                statsd_client.timing(
+                    '{service}_freshness_upstream'.format(
+                        service=self.SERVICE_NAME),
+                    int((fetched - started) * 1000))
+                statsd_client.timing(
+                    '{service}_freshness_total'.format(
+                        service=self.SERVICE_NAME),
+                    int((cached - missed) * 1000))
+
+        if unfilled:
+            statsd_client.incr('{service}_freshness_unfilled'.format(
+                service=self.SERVICE_NAME), unfilled)
+
+    def get_queue_size(self):
+        if self.url_queue is not None:
+            return self.url_queue.count(self.SERVICE_NAME)
+
+        return self.job_queue.count
+
+    def _get_queued_jobs_key(self):
+        return 'QUEUED_JOBS:{service}'.format(service=self.SERVICE_NAME)
+
+    def _record_queued_job(self, job):
+        # Jobs queued at the front and back meet in the middle of the queue,
+        # so when each was queued is kept in a sorted set to find the
+        # oldest.  Like the other queue metrics it is advisory.
+        try:
+            self.redis_client.zadd(
+                self._get_queued_jobs_key(), time.time(), job.id)
+        except redis.RedisError:
+            statsd_client.incr('queued_job_write_fail')
+
+    def remove_queued_job(self, job):
+        # Called by the fetch tasks as they start, with rq's current job.
+        if job is None:
+            return
+
+        try:
+            self.redis_client.zrem(self._get_queued_jobs_key(), job.id)
+        except redis.RedisError:
+            statsd_client.incr('queued_job_write_fail')
+
+    def get_oldest_queued_at(self):
+        if self.url_queue is not None:
+            return self.url_queue.get_oldest_queued_at(self.SERVICE_NAME)
+
+        if not self.job_queue.count:
+            return None
+
+        # rq drops jobs not started within their ttl, so they are dropped
+        # here too.
+        key = self._get_queued_jobs_key()
+        self.redis_client.zremrangebyscore(
+            key, '-inf', time.time() - self.job_ttl)
+        oldest = self.redis_client.zrange(key, 0, 0, withscores=True)
+
+        return oldest[0][1] if oldest else None
+
+    def _push_url_queue(self, urls, at_front=True):
+        # Queued URLs are batched by the queue's workers, not here.
+        urls = list(urls)
+
+        if not urls:
+            return
+
+        try:
+            self.url_queue.push(self.SERVICE_NAME, urls, at_front)
+            statsd_client.gauge('request_fetch_job_create', len(urls))
+
+            for queued_url in urls:
+                self._set_cached_url(
+                    queued_url, self.IN_JOB_QUEUE, self.redis_job_timeout)
+
+        except Exception:
+            statsd_client.incr('request_fetch_job_create_fail')
+        else:
+            self._record_misses(urls)
+
+    def _queue_url_jobs(self, urls, at_front=True):
+        if self.url_queue is not None:
+            return self._push_url_queue(urls, at_front)
+
         batched_urls = group_by(list(urls), self.url_batch_size)
 
         for url_batch in batched_urls:
             try:
-                self.job_queue.enqueue(
+                job = self.job_queue.enqueue(
                     self.TASK,
                     url_batch,
                     time.time(),
                     ttl=self.job_ttl,
-                    at_front=True,
+                    at_front=at_front,
                 )
                 statsd_client.gauge(
                     'request_fetch_job_create', len(url_batch))
@@ -94,27 +284,57 @@ class MetadataClient(object):
 
             except Exception:
                 statsd_client.incr('request_fetch_job_create_fail')
+            else:
+                self._record_misses(url_batch)
+                self._record_queued_job(job)
 
     def _remove_cached_keys(self, urls):
-        self.redis_client.delete(*[self._get_cache_key(url) for url in urls])
+        self.cache_redis_client.delete(
+            *[self._get_cache_key(url) for url in urls])
 
     def get_cached_urls(self, urls):
-        url_data = {}
+        urls = list(urls)
 
-        for url in urls:
-            cached_url_data = self._get_cached_url(url)
+        if not urls:
+            return {}
 
+        try:
+            cached_urls_data = self.cache_redis_client.mget(
+                [self._get_cache_key(url) for url in urls])
+        except redis.RedisError:
+            raise self.MetadataClientException('Unable to read from redis.')
+
+        # Cached values are validated before they are written so they are
+        # returned as raw JSON and spliced directly into responses.
+        url_data = {}
+
+        for url, cached_url_data in zip(urls, cached_urls_data):
             if cached_url_data is not None:
+                statsd_client.incr('redis_cache_hit')
                 url_data[url] = cached_url_data
+            else:
+                statsd_client.incr('redis_cache_miss')
 
         return url_data
 
+    def get_completed_urls(self, urls):
+        return {
+            url: url_data
+            for (url, url_data)
+            in self.get_cached_urls(urls).items()
+            if url_data != self.IN_JOB_QUEUE_JSON
+        }
+
     def _make_remote_request(self, urls):
         raise NotImplementedError
 
     def _parse_remote_data(self, remote_data):
         raise NotImplementedError
 
+    def _record_upstream_result(self, success):
+        if self.upstream_results is not None:
+            self.upstream_results.record(self.SERVICE_NAME, success)
+
     def _get_remote_urls_data(self, urls):
         statsd_client.gauge('{service}_request_url_count'.format(
             service=self.SERVICE_NAME), len(urls))
@@ -124,6 +344,7 @@ class MetadataClient(object):
             try:
                 response = self._make_remote_request(urls)
             except requests.RequestException, e:
+                self._record_upstream_result(False)
                 raise self.MetadataClientException(
                     ('Unable to communicate '
                      'with {service}: {error}').format(
@@ -132,6 +353,7 @@ class MetadataClient(object):
         if response.status_code != 200:
             statsd_client.incr('{service}_request_failure'.format(
                 service=self.SERVICE_NAME))
+            self._record_upstream_result(False)
             raise self.MetadataClientException(
                 ('Error status returned from '
                  '{service}: {error_code} {error_message}').format(
@@ -142,6 +364,7 @@ class MetadataClient(object):
 
         statsd_client.incr('{service}_request_success'.format(
             service=self.SERVICE_NAME))
+        self._record_upstream_result(True)
 
         remote_data = []
 
@@ -158,11 +381,15 @@ class MetadataClient(object):
 
         return self._parse_remote_data(urls, remote_data)
 
-    def _domain_limit_urls(self, urls):
+    def _domain_limit_urls(self, urls, netlocs=None):
         allowed_urls = []
+        netlocs = netlocs or {}
 
         for url in urls:
-            domain = urlparse.urlparse(url).netloc.encode('utf8')
+            domain = netlocs.get(url)
+            if domain is None:
+                domain = urlparse.urlparse(url).netloc
+            domain = domain.encode('utf8')
             if self.domain_limiter.checked_insert(domain):
                 allowed_urls.append(url)
             else:
@@ -170,9 +397,49 @@ class MetadataClient(object):
 
         return allowed_urls
 
-    def get_remote_urls(self, urls):
-        self._remove_cached_keys(urls)
+    def queue_urls(self, urls, at_front=True, netlocs=None, consumer=None,
+                   admission=True):
+        urls = list(urls)
+        counts = self._get_request_counts(urls) or {}
+
+        # URLs chosen to be warmed are queued whatever the admission policy.
+        policy = self._get_admission_policy() if admission else None
+        if policy is not None and counts:
+            admitted_urls = [
+                url for url in urls if self._is_admitted(counts[url])]
+            statsd_client.incr('{service}_admission_admitted'.format(
+                service=self.SERVICE_NAME), len(admitted_urls))
+            statsd_client.incr('{service}_admission_rejected'.format(
+                service=self.SERVICE_NAME), len(urls) - len(admitted_urls))
+
+            # Rejected URLs are either fetched and cached briefly, or left
+            # unfetched until they are requested again.
+            if policy['reject'] == 'skip':
+                urls = admitted_urls
+
+        # The URLs left to be queued for a consumer are taken from its quota
+        # before the domain limiter, so URLs the quota refuses do not use up
+        # their domains' slots.
+        if self.quota is not None and consumer is not None and urls:
+            self.quota.take(consumer, 'urls', len(urls))
+
+        allowed_urls = self._domain_limit_urls(urls, netlocs)
+
+        # Requested URLs all go ahead of warm-up at the back of the queue,
+        # and popular URLs are pushed last so they are fetched first.
+        if at_front and counts:
+            hot_urls = [
+                url for url in allowed_urls
+                if self.popularity.is_hot(counts[url])]
+            self._queue_url_jobs(
+                [url for url in allowed_urls if url not in hot_urls], True)
+            self._queue_url_jobs(hot_urls, True)
+        else:
+            self._queue_url_jobs(allowed_urls, at_front)
+
+        return allowed_urls
 
+    def _get_validated_urls_data(self, urls):
         remote_urls_data = self._get_remote_urls_data(urls)
         validated_urls_data = {}
 
@@ -182,34 +449,64 @@ class MetadataClient(object):
                 validated_data = self.schema.load(remote_data)
 
                 if not validated_data.errors:
-                    self._set_cached_url(
-                        original_url,
-                        validated_data.data,
-                        self.redis_data_timeout,
-                    )
-
                     validated_urls_data[original_url] = validated_data.data
 
         return validated_urls_data
 
-    def extract_urls_async(self, urls):
+    def get_remote_urls(self, urls):
+        started = time.time()
+
+        self._remove_cached_keys(urls)
+
+        validated_urls_data = self._get_validated_urls_data(urls)
+        timeouts = self._get_cache_timeouts(validated_urls_data.keys())
+        fetched = time.time()
+
+        for original_url, validated_data in validated_urls_data.items():
+            self._set_cached_url(
+                original_url,
+                validated_data,
+                timeouts[original_url],
+            )
+
+        self._record_freshness(validated_urls_data.keys(), started, fetched)
+
+        return validated_urls_data
+
+    def preprocess_urls(self, urls):
+        return self.preprocessor.preprocess(urls)
+
+    def extract_urls_async(self, urls, netlocs=None, consumer=None):
+        # netlocs, as returned by preprocess_urls, saves parsing the URLs
+        # again when they are rate limited.
+        self._record_requests(urls)
+
         all_cached_url_data = self.get_cached_urls(urls)
 
-        if self.IN_JOB_QUEUE in all_cached_url_data.values():
+        if self.IN_JOB_QUEUE_JSON in all_cached_url_data.values():
             statsd_client.incr('request_in_job_queue')
 
         cached_url_data = {
             url: url_data
             for (url, url_data)
             in all_cached_url_data.items()
-            if url_data != self.IN_JOB_QUEUE
+            if url_data != self.IN_JOB_QUEUE_JSON
         }
 
         uncached_urls = set(urls) - set(all_cached_url_data.keys())
 
+        # A consumer over its quota still gets the cached URLs, which are
+        # handed back on the exception as none of the rest were queued.
+        quota_exception = (
+            self.quota.QuotaException if self.quota is not None else ())
+
         if uncached_urls:
-            allowed_urls = self._domain_limit_urls(uncached_urls)
-            self._queue_url_jobs(allowed_urls)
+            try:
+                self.queue_urls(
+                    uncached_urls, netlocs=netlocs, consumer=consumer)
+            except quota_exception, e:
+                e.url_data = cached_url_data
+                raise
 
         return cached_url_data
 
@@ -268,3 +565,135 @@ class MozillaClient(MetadataClient):
             for url_data in remote_data['urls'].values()
             if url_data['original_url'] in urls
         }
+
+
+class ProviderChainClient(MetadataClient):
+    TASK = staticmethod(fetch_provider_chain_data)
+
+    def __init__(self, service_name, providers, latency_samples,
+                 hedge_min_samples, hedge_percentile, *args, **kwargs):
+        # Cached under the name of the endpoint it serves, so switching an
+        # endpoint to a chain keeps its cache.
+        self.SERVICE_NAME = service_name
+        self.providers = providers
+        self.latency_samples = latency_samples
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_percentile = hedge_percentile
+        super(ProviderChainClient, self).__init__(*args, **kwargs)
+
+    def _get_latency_key(self, provider):
+        return 'PROVIDER_LATENCY:{service}'.format(
+            service=provider.SERVICE_NAME)
+
+    def _record_latency(self, provider, latency):
+        # A sample that cannot be written only leaves the hedge delay a
+        # little staler, so the provider's results are still used.
+        latency_key = self._get_latency_key(provider)
+
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.lpush(latency_key, latency)
+            pipeline.ltrim(latency_key, 0, self.latency_samples - 1)
+            pipeline.execute()
+        except redis.RedisError:
+            statsd_client.incr('{service}_chain_latency_write_fail'.format(
+                service=provider.SERVICE_NAME))
+
+    def _get_hedge_delay(self, provider):
+        # Latencies are kept in redis as each job runs in its own process.
+        try:
+            latencies = self.redis_client.lrange(
+                self._get_latency_key(provider), 0, -1)
+        except redis.RedisError:
+            raise self.MetadataClientException('Unable to read from redis.')
+
+        if len(latencies) < self.hedge_min_samples:
+            return None
+
+        latencies = sorted(float(latency) for latency in latencies)
+        index = int(len(latencies) * self.hedge_percentile / 100.0)
+
+        return latencies[min(index, len(latencies) - 1)]
+
+    def _request_provider(self, provider, urls, results):
+        statsd_client.incr('{service}_chain_request'.format(
+            service=provider.SERVICE_NAME))
+        statsd_client.gauge('{service}_chain_request_urls'.format(
+            service=provider.SERVICE_NAME), len(urls))
+
+        started = time.time()
+
+        # Any failure is handed back, as an exception would otherwise only
+        # end this thread.
+        try:
+            urls_data = provider._get_validated_urls_data(urls)
+        except Exception, e:
+            statsd_client.incr('{service}_chain_failure'.format(
+                service=provider.SERVICE_NAME))
+            results.put((provider, None, e))
+        else:
+            self._record_latency(provider, time.time() - started)
+            results.put((provider, urls_data, None))
+
+    def _start_request(self, provider, urls, results):
+        request = threading.Thread(
+            target=self._request_provider, args=(provider, urls, results))
+        request.daemon = True
+        request.start()
+
+    def _get_validated_urls_data(self, urls):
+        # Each provider is sent the URLs the providers before it missed.
+        # When a request runs past the provider's observed latency
+        # percentile, the next provider is sent the same URLs and each URL
+        # is taken from whichever answers first.
+        remaining_urls = list(urls)
+        validated_urls_data = {}
+        pending_providers = list(self.providers)
+        in_flight = []
+        results = Queue.Queue()
+        error = None
+
+        while remaining_urls and (in_flight or pending_providers):
+            if not in_flight:
+                provider = pending_providers.pop(0)
+                self._start_request(provider, remaining_urls, results)
+                in_flight.append(provider)
+
+            hedge_delay = None
+            if len(in_flight) == 1 and pending_providers:
+                hedge_delay = self._get_hedge_delay(in_flight[0])
+
+            # Waiting with a timeout keeps the job timeout able to
+            # interrupt a hung provider.  A p95 of 0 still hedges.
+            try:
+                provider, urls_data, error = results.get(
+                    timeout=self.redis_job_timeout if hedge_delay is None
+                    else hedge_delay)
+            except Queue.Empty:
+                if hedge_delay is None:
+                    break
+
+                provider = pending_providers.pop(0)
+                statsd_client.incr('{service}_chain_hedge'.format(
+                    service=provider.SERVICE_NAME))
+                self._start_request(provider, remaining_urls, results)
+                in_flight.append(provider)
+                continue
+
+            in_flight.remove(provider)
+
+            if urls_data is not None:
+                won_urls = [url for url in remaining_urls if url in urls_data]
+                statsd_client.gauge('{service}_chain_wins'.format(
+                    service=provider.SERVICE_NAME), len(won_urls))
+
+                for url in won_urls:
+                    validated_urls_data[url] = urls_data[url]
+
+                remaining_urls = [
+                    url for url in remaining_urls if url not in urls_data]
+
+        if error is not None and not validated_urls_data:
+            raise self.MetadataClientException(error.message)
+
+        return validated_urls_data
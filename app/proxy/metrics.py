@@ -0,0 +1,193 @@
+import glob
+import json
+import mmap
+import os
+import re
+import struct
+
+
+HISTOGRAM_BUCKETS = (
+    5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)  # milliseconds
+
+
+def align(offset):
+    return (offset + 7) & ~7
+
+
+class MetricsFile(object):
+    # One process's metric values in an mmap'd file, as a used size header
+    # and then entries of a key and an 8 byte aligned double.  Only the
+    # owning process writes to the file, so updates take no lock, and an
+    # entry is written before the header grows to include it so readers in
+    # other processes never see a partial entry.
+
+    HEADER = struct.Struct('!Q')
+    KEY_LENGTH = struct.Struct('!I')
+    VALUE = struct.Struct('d')
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, path, initial_size=INITIAL_SIZE):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = max(os.fstat(self.fd).st_size, initial_size)
+        os.ftruncate(self.fd, size)
+        self.data = mmap.mmap(self.fd, size)
+
+        # A file left by an earlier process with the same pid is carried
+        # on, so its counts never go backwards.
+        self.offsets = {}
+        self.used = self.HEADER.size
+        for key, offset, _ in self.read_entries(self.data):
+            self.offsets[key] = offset
+            self.used = offset + self.VALUE.size
+
+    @classmethod
+    def read_entries(cls, data):
+        # A file another process has only just created may still be empty.
+        if len(data) < cls.HEADER.size:
+            return
+
+        used = max(cls.HEADER.unpack_from(data, 0)[0], cls.HEADER.size)
+        offset = cls.HEADER.size
+
+        while offset < used:
+            key_length = cls.KEY_LENGTH.unpack_from(data, offset)[0]
+            key_offset = offset + cls.KEY_LENGTH.size
+            key = tuple(json.loads(data[key_offset:key_offset + key_length]))
+            value_offset = align(key_offset + key_length)
+            yield key, value_offset, cls.VALUE.unpack_from(
+                data, value_offset)[0]
+            offset = value_offset + cls.VALUE.size
+
+    def _add_entry(self, key):
+        encoded_key = json.dumps(key)
+        key_offset = self.used + self.KEY_LENGTH.size
+        value_offset = align(key_offset + len(encoded_key))
+        used = value_offset + self.VALUE.size
+
+        if used > len(self.data):
+            size = len(self.data)
+            while used > size:
+                size *= 2
+            os.ftruncate(self.fd, size)
+            self.data.close()
+            self.data = mmap.mmap(self.fd, size)
+
+        self.KEY_LENGTH.pack_into(self.data, self.used, len(encoded_key))
+        self.data[key_offset:key_offset + len(encoded_key)] = encoded_key
+        self.VALUE.pack_into(self.data, value_offset, 0)
+        self.HEADER.pack_into(self.data, 0, used)
+
+        self.used = used
+        self.offsets[key] = value_offset
+        return value_offset
+
+    def inc(self, key, amount):
+        offset = self.offsets.get(key)
+        if offset is None:
+            offset = self._add_entry(key)
+
+        self.VALUE.pack_into(
+            self.data, offset,
+            self.VALUE.unpack_from(self.data, offset)[0] + amount)
+
+
+class SharedMetrics(object):
+    # Counters, gauge totals and timing histograms summed over every process
+    # writing to directory, such as the gunicorn workers of an instance.
+    # Each process writes its own file, opened again after a fork.
+
+    def __init__(self, directory, prefix):
+        self.directory = directory
+        self.prefix = prefix
+        self.pid = None
+        self.file = None
+
+    def _get_file(self):
+        pid = os.getpid()
+        if pid != self.pid:
+            self.file = MetricsFile(os.path.join(
+                self.directory, 'metrics_{pid}.db'.format(pid=pid)))
+            self.pid = pid
+
+        return self.file
+
+    def incr(self, name, count=1):
+        self._get_file().inc(('counter', name, ''), count)
+
+    def gauge(self, name, value):
+        # Gauges here mostly report how many URLs an event involved, so
+        # they are kept as a total and a count of events.
+        metrics_file = self._get_file()
+        metrics_file.inc(('summary', name, 'sum'), value)
+        metrics_file.inc(('summary', name, 'count'), 1)
+
+    def timing(self, name, milliseconds):
+        le = '+Inf'
+        for bucket in HISTOGRAM_BUCKETS:
+            if milliseconds <= bucket:
+                le = str(bucket)
+                break
+
+        metrics_file = self._get_file()
+        metrics_file.inc(('histogram', name, le), 1)
+        metrics_file.inc(('histogram', name, 'sum'), milliseconds)
+        metrics_file.inc(('histogram', name, 'count'), 1)
+
+    def read(self):
+        values = {}
+
+        for path in glob.glob(os.path.join(self.directory, 'metrics_*.db')):
+            with open(path, 'rb') as metrics_file:
+                data = metrics_file.read()
+
+            for key, _, value in MetricsFile.read_entries(data):
+                values[key] = values.get(key, 0) + value
+
+        return values
+
+    def clear(self):
+        for path in glob.glob(os.path.join(self.directory, 'metrics_*.db')):
+            os.remove(path)
+
+    def _get_metric_name(self, name, suffix=''):
+        return re.sub('[^a-zA-Z0-9_:]', '_', '{prefix}_{name}{suffix}'.format(
+            prefix=self.prefix, name=name, suffix=suffix))
+
+    def render(self):
+        # Prometheus text exposition format.
+        metrics = {}
+        for (kind, name, sample), value in self.read().items():
+            metrics.setdefault((name, kind), {})[sample] = value
+
+        lines = []
+        for (name, kind), samples in sorted(metrics.items()):
+            if kind == 'counter':
+                metric_name = self._get_metric_name(name, '_total')
+                lines.append('# TYPE {name} counter'.format(name=metric_name))
+                lines.append('{name} {value!r}'.format(
+                    name=metric_name, value=samples['']))
+            elif kind == 'summary':
+                metric_name = self._get_metric_name(name)
+                lines.append('# TYPE {name} summary'.format(name=metric_name))
+                for sample in ('sum', 'count'):
+                    lines.append('{name}_{sample} {value!r}'.format(
+                        name=metric_name, sample=sample,
+                        value=samples.get(sample, 0.0)))
+            else:
+                metric_name = self._get_metric_name(name, '_milliseconds')
+                lines.append(
+                    '# TYPE {name} histogram'.format(name=metric_name))
+
+                cumulative = 0.0
+                for le in [str(bucket) for bucket in HISTOGRAM_BUCKETS] + [
+                        '+Inf']:
+                    cumulative += samples.get(le, 0.0)
+                    lines.append('{name}_bucket{{le="{le}"}} {value!r}'.format(
+                        name=metric_name, le=le, value=cumulative))
+
+                for sample in ('sum', 'count'):
+                    lines.append('{name}_{sample} {value!r}'.format(
+                        name=metric_name, sample=sample,
+                        value=samples.get(sample, 0.0)))
+
+        return ''.join(line + '\n' for line in lines)
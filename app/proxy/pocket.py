@@ -1,9 +1,11 @@
+import hashlib
 import json
 import time
 
 import redis
 import requests
 
+from proxy.lock import RedisLock
 from proxy.stats import statsd_client
 from proxy.tasks import fetch_recommended_urls
 
@@ -18,11 +20,17 @@ class PocketClient(object):
         self.pocket_url = pocket_url
         self.redis_client = redis_client
         self.redis_key = 'POCKET_RECOMMENDED_URLS'
-        self.redis_in_flight_value = 'JOB_IN_FLIGHT'
+        self.redis_last_good_key = 'POCKET_RECOMMENDED_URLS_LAST_GOOD'
+        self.redis_version_key = 'POCKET_RECOMMENDED_URLS_VERSION'
+        self.redis_refresh_lock_key = 'POCKET_RECOMMENDED_URLS_REFRESH_LOCK'
         self.redis_data_timeout = redis_data_timeout
         self.job_queue = job_queue
         self.job_ttl = job_ttl
 
+        # The serialized last good list and its version, held in process so
+        # it is only reloaded from redis when the version changes.
+        self.snapshot = (None, '[]')
+
     def fetch_recommended_urls(self):
         with statsd_client.timer('pocket_request_timer'):
             try:
@@ -63,55 +71,152 @@ class PocketClient(object):
               'timestamp': int(recommended_url['published_timestamp']) * 1000,
             })
 
+        recommended_urls_json = json.dumps(recommended_urls)
+
+        # The last good list never expires so it can be served while Pocket
+        # is unavailable or a refresh is in flight.  Its version tells the
+        # web workers to reload their snapshot.
         try:
-            self.redis_client.setex(
+            pipeline = self.redis_client.pipeline()
+            pipeline.setex(
                 self.redis_key,
                 self.redis_data_timeout,
-                json.dumps(recommended_urls),
+                recommended_urls_json,
+            )
+            pipeline.set(self.redis_last_good_key, recommended_urls_json)
+            pipeline.set(
+                self.redis_version_key,
+                self.get_version(recommended_urls_json),
             )
+            pipeline.execute()
         except redis.RedisError:
             raise self.PocketException('Unable to write to redis.')
 
         return recommended_urls
 
-    def get_recommended_urls(self):
+    def needs_refresh(self, margin):
+        try:
+            ttl = self.redis_client.ttl(self.redis_key)
+        except redis.RedisError:
+            raise self.PocketException('Unable to read from redis.')
+
+        return ttl < margin
+
+    def get_version(self, recommended_urls_json):
+        return hashlib.sha1(recommended_urls_json).hexdigest()
+
+    def load_snapshot(self, version):
+        if version is None:
+            return (None, '[]')
+
         try:
-            recommended_urls = self.redis_client.get(self.redis_key)
+            recommended_urls = self.redis_client.get(self.redis_last_good_key)
         except redis.RedisError:
             raise self.PocketException('Unable to read from redis.')
 
         if recommended_urls is None:
-            recommended_urls = []
-            statsd_client.incr('redis_recommended_cache_miss')
+            statsd_client.incr('redis_recommended_last_good_miss')
+            return (None, '[]')
 
-            try:
-                self.job_queue.enqueue(
-                    fetch_recommended_urls,
-                    time.time(),
-                    ttl=self.job_ttl,
-                    at_front=True,
-                )
-            except Exception:
-                statsd_client.incr('request_recommended_job_create_fail')
-                raise self.PocketException(
-                    'Unable to start the pocket fetch job.')
+        # Parsed once per version to make sure only valid JSON is served.
+        try:
+            json.loads(recommended_urls)
+        except ValueError:
+            raise self.PocketException(
+                ('Unable to load JSON data from cache for key: {key}').format(
+                    key=self.redis_last_good_key))
 
-            statsd_client.incr('request_recommended_job_create')
+        statsd_client.incr('recommended_snapshot_load')
 
-            try:
-                self.redis_client.setex(
-                    self.redis_key, self.job_ttl, self.redis_in_flight_value)
-            except redis.RedisError:
-                raise self.PocketException('Unable to write to redis.')
+        # A fetch may have replaced the list since the version was read, so
+        # the version is taken from the list itself for the ETag to match
+        # the body served with it.
+        return (self.get_version(recommended_urls), recommended_urls)
 
-        else:
+    def get_refresh_lock(self, token=None):
+        # Held from queueing a fetch until it succeeds, so only one refresh
+        # runs at a time.  A failed queued fetch keeps the lock until it
+        # expires, which stops readers from queueing a retry per request.
+        return RedisLock(
+            self.redis_client, self.redis_refresh_lock_key, self.job_ttl,
+            token=token)
+
+    def queue_fetch(self):
+        refresh_lock = self.get_refresh_lock()
+
+        try:
+            if not refresh_lock.acquire():
+                statsd_client.incr('redis_recommended_in_flight')
+                return False
+        except refresh_lock.LockException, e:
+            raise self.PocketException(e.message)
+
+        try:
+            self.job_queue.enqueue(
+                fetch_recommended_urls,
+                time.time(),
+                refresh_lock.token,
+                ttl=self.job_ttl,
+                at_front=True,
+            )
+        except Exception:
+            statsd_client.incr('request_recommended_job_create_fail')
+            self.release_refresh_lock(refresh_lock.token)
+            raise self.PocketException(
+                'Unable to start the pocket fetch job.')
+
+        statsd_client.incr('request_recommended_job_create')
+
+        return True
+
+    def release_refresh_lock(self, token):
+        try:
+            self.get_refresh_lock(token).release()
+        except RedisLock.LockException, e:
+            raise self.PocketException(e.message)
+
+    def refresh_recommended_urls(self):
+        refresh_lock = self.get_refresh_lock()
+
+        try:
+            if not refresh_lock.acquire():
+                return False
+        except refresh_lock.LockException, e:
+            raise self.PocketException(e.message)
+
+        # The scheduler retries on its next tick, so the lock is released
+        # even when the fetch fails.
+        try:
+            self.fetch_recommended_urls()
+        finally:
+            self.release_refresh_lock(refresh_lock.token)
+
+        return True
+
+    def get_recommended_urls(self):
+        # Returns the version and serialized JSON list of the last good
+        # recommendations, queueing a fetch when they have expired.
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.get(self.redis_version_key)
+            pipeline.exists(self.redis_key)
+            version, is_cached = pipeline.execute()
+        except redis.RedisError:
+            raise self.PocketException('Unable to read from redis.')
+
+        if is_cached:
             statsd_client.incr('redis_recommended_cache_hit')
+        else:
+            statsd_client.incr('redis_recommended_cache_miss')
 
+            # The last good list is still served when a fetch cannot be
+            # queued, and the next request tries again.
             try:
-                recommended_urls = json.loads(recommended_urls)
-            except ValueError:
-                raise self.PocketException(
-                    ('Unable to load JSON data '
-                     'from cache for key: {key}').format(key=self.redis_key))
+                self.queue_fetch()
+            except self.PocketException:
+                statsd_client.incr('request_recommended_queue_fail')
 
-        return recommended_urls
+        if version != self.snapshot[0]:
+            self.snapshot = self.load_snapshot(version)
+
+        return self.snapshot
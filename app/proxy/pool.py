@@ -0,0 +1,71 @@
+import time
+
+import redis
+
+from proxy.stats import statsd_client
+
+
+class MonitoredConnectionPool(redis.BlockingConnectionPool):
+    # Callers wait for a free connection instead of opening one each, so a
+    # burst queues on max_connections rather than on redis maxclients.  The
+    # wait is on a threading based queue, which the gevent worker patches,
+    # so a waiting greenlet yields to the others.
+
+    def __init__(self, name, health_check_interval, wait_threshold=0,
+                 **kwargs):
+        self.name = name
+        self.health_check_interval = health_check_interval
+        self.wait_threshold = wait_threshold
+        super(MonitoredConnectionPool, self).__init__(**kwargs)
+
+    def make_connection(self):
+        connection = super(MonitoredConnectionPool, self).make_connection()
+        statsd_client.gauge('{name}_redis_pool_size'.format(
+            name=self.name), len(self._connections))
+        return connection
+
+    def get_connection(self, command_name, *keys, **options):
+        started = time.time()
+
+        try:
+            connection = super(MonitoredConnectionPool, self).get_connection(
+                command_name, *keys, **options)
+        except redis.ConnectionError:
+            statsd_client.incr('{name}_redis_checkout_timeout'.format(
+                name=self.name))
+            raise
+
+        # Every command checks out a connection, and nearly all find one
+        # free, so only the waits that queued on the pool are reported.
+        wait = int((time.time() - started) * 1000)
+        if wait > self.wait_threshold:
+            statsd_client.timing(
+                '{name}_redis_checkout_wait'.format(name=self.name), wait)
+
+        idle_since = getattr(connection, 'released_at', None)
+        if (idle_since is not None and
+                time.time() - idle_since > self.health_check_interval):
+            self.check_health(connection)
+
+        return connection
+
+    def check_health(self, connection):
+        # A connection dropped while idle, by redis timeout or a failover,
+        # is closed here so the command reconnects instead of failing.
+        try:
+            connection.send_command('PING')
+            if connection.read_response() != 'PONG':
+                raise redis.ConnectionError('Unexpected PING response.')
+        except (redis.ConnectionError, redis.TimeoutError):
+            statsd_client.incr('{name}_redis_health_check_fail'.format(
+                name=self.name))
+            connection.disconnect()
+
+    def get_saturation(self):
+        # The share of max_connections checked out.  Free slots are kept in
+        # the queue, as idle connections or placeholders for new ones.
+        return 1 - self.pool.qsize() / float(self.max_connections)
+
+    def release(self, connection):
+        connection.released_at = time.time()
+        super(MonitoredConnectionPool, self).release(connection)
@@ -0,0 +1,151 @@
+import hashlib
+import math
+import struct
+import time
+
+import redis
+
+from proxy.stats import statsd_client
+
+
+def get_sketch_width(requests, threshold):
+    # Each row adds requests / width to a key's count on average, so this
+    # width keeps a row's overestimate to a quarter of what would lift a
+    # key requested once to threshold, and by Markov's inequality a row
+    # errs that far less than 1 time in 10.  A key is only misread when
+    # every row does.  Redis only stores the counters that are used, so a
+    # wide sketch costs no more memory than a narrow one.
+    return int(math.ceil(
+        4 * math.e * requests / max(threshold - 1, 1)))
+
+
+class CountMinSketch(object):
+    # Approximate request counts per key in a fixed number of redis hash
+    # fields.  Each key is counted in one column of every row and its count
+    # is the smallest of those, which can only overestimate.  Counts are
+    # kept per window; a key's count is the current window plus the share
+    # of the previous window still inside the sliding window.
+
+    MAX_DEPTH = 8
+
+    def __init__(self, redis_client, name, width, depth, window,
+                 flush_size, flush_interval):
+        self.redis_client = redis_client
+        self.name = name
+        self.width = width
+        self.depth = min(depth, self.MAX_DEPTH)
+        self.window = window
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.flushed_at = time.time()
+
+    def _get_window_key(self, window):
+        return '{name}:{window}'.format(name=self.name, window=window)
+
+    def _get_fields(self, key):
+        columns = struct.unpack(
+            '!8I', hashlib.sha256(key.encode('utf8')).digest())
+
+        return [
+            '{row}:{column}'.format(row=row, column=column % self.width)
+            for row, column in enumerate(columns[:self.depth])
+        ]
+
+    def add(self, keys):
+        # Counts are buffered in the process and written in one pipeline,
+        # so the request path does not wait on redis for every request.
+        for key in keys:
+            for field in self._get_fields(key):
+                self.pending[field] = self.pending.get(field, 0) + 1
+
+        if (len(self.pending) >= self.flush_size or
+                time.time() - self.flushed_at >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        self.flushed_at = time.time()
+
+        if not pending:
+            return
+
+        window_key = self._get_window_key(int(time.time() / self.window))
+
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for field, count in pending.items():
+                pipeline.hincrby(window_key, field, count)
+            pipeline.expire(window_key, self.window * 2)
+            pipeline.execute()
+        except redis.RedisError:
+            statsd_client.incr('popularity_write_fail')
+
+    def get_counts(self, keys):
+        # Counts are advisory, so a redis failure counts every key as 0.
+        now = time.time()
+        window = int(now / self.window)
+        previous_weight = 1 - (now % self.window) / float(self.window)
+
+        fields_by_key = [(key, self._get_fields(key)) for key in keys]
+        fields = [
+            field for _, key_fields in fields_by_key for field in key_fields]
+
+        if not fields:
+            return {}
+
+        try:
+            current_counts = self.redis_client.hmget(
+                self._get_window_key(window), fields)
+            previous_counts = self.redis_client.hmget(
+                self._get_window_key(window - 1), fields)
+        except redis.RedisError:
+            statsd_client.incr('popularity_read_fail')
+            return {key: 0 for key in keys}
+
+        # Counts still buffered in this process are added in, so a key
+        # counts its own request before the next flush.
+        counts = [
+            int(current or 0) + self.pending.get(field, 0) +
+            int(previous or 0) * previous_weight
+            for field, current, previous
+            in zip(fields, current_counts, previous_counts)
+        ]
+
+        return {
+            key: int(min(counts[index * self.depth:(index + 1) * self.depth]))
+            for index, (key, _) in enumerate(fields_by_key)
+        }
+
+
+class PopularityPolicy(object):
+    # Chooses cache timeouts and queue priority from request counts.  Keys
+    # requested hot_count times a window are cached for the full timeout
+    # and fetched first; the timeout falls off logarithmically to
+    # min_timeout for keys requested once.  hot_count must be above 1.
+
+    def __init__(self, sketch, hot_count, min_timeout, max_timeout):
+        self.sketch = sketch
+        self.hot_count = hot_count
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+
+    def record(self, keys):
+        self.sketch.add(keys)
+
+    def get_timeout(self, count):
+        if count >= self.hot_count:
+            return self.max_timeout
+
+        if count <= 1:
+            return self.min_timeout
+
+        return int(self.min_timeout + (
+            self.max_timeout - self.min_timeout) *
+            math.log(count) / math.log(self.hot_count))
+
+    def get_counts(self, keys):
+        return self.sketch.get_counts(keys)
+
+    def is_hot(self, count):
+        return count >= self.hot_count
@@ -0,0 +1,100 @@
+import collections
+import re
+import socket
+import urlparse
+
+from proxy.stats import statsd_client
+
+
+# Underscores are not allowed in host names, but sites such as
+# foo_bar.tumblr.com use them in subdomains and resolve fine, so only
+# hosts that cannot be looked up at all are rejected.
+HOSTNAME_RE = re.compile(
+    r'^([a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9_])?\.)+'
+    r'[a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9_])?\.?$')
+
+
+class URLPreprocessor(object):
+    # Checks a request's URLs once, before any of them is looked up in the
+    # cache, rate limited or queued.  Repeated URLs are dropped, as are
+    # URLs that are not http(s) with a valid host, which no provider can
+    # fetch, and URLs on blocked domains or their subdomains.
+
+    SCHEMES = ('http', 'https')
+
+    def __init__(self, blocked_domains):
+        self.blocked_domains = [domain.lower() for domain in blocked_domains]
+
+    def _is_valid_host(self, hostname):
+        # Bracketed IPv6 addresses are the only hosts allowed a colon.
+        if ':' in hostname:
+            try:
+                socket.inet_pton(socket.AF_INET6, hostname)
+                return True
+            except socket.error:
+                return False
+
+        # Most hosts are ASCII, which is much cheaper to check than to
+        # encode as IDNA.
+        try:
+            hostname = hostname.encode('ascii')
+        except UnicodeError:
+            try:
+                hostname = hostname.encode('idna')
+            except UnicodeError:
+                return False
+
+        return bool(HOSTNAME_RE.match(hostname))
+
+    def _is_blocked(self, hostname):
+        hostname = hostname.rstrip('.')
+
+        return any(
+            hostname == domain or hostname.endswith('.' + domain)
+            for domain in self.blocked_domains
+        )
+
+    def _parse(self, url):
+        # Returns the parsed URL, or None when it cannot be fetched.
+        try:
+            parsed = urlparse.urlsplit(url)
+            parsed.port
+        except ValueError:
+            return None
+
+        if (parsed.scheme not in self.SCHEMES or
+                not parsed.hostname or
+                not self._is_valid_host(parsed.hostname)):
+            return None
+
+        return parsed
+
+    def preprocess(self, urls):
+        # Returns each URL to look up with its network location, in request
+        # order, so later stages need not parse it again.
+        netlocs = collections.OrderedDict()
+        duplicate = invalid = blocked = 0
+
+        for url in urls:
+            # JSON lists and objects cannot be looked up in netlocs.
+            if not isinstance(url, basestring):
+                invalid += 1
+            elif url in netlocs:
+                duplicate += 1
+            else:
+                parsed = self._parse(url)
+
+                if parsed is None:
+                    invalid += 1
+                elif self._is_blocked(parsed.hostname):
+                    blocked += 1
+                else:
+                    netlocs[url] = parsed.netloc
+
+        for stat, count in (('request_url_duplicate', duplicate),
+                            ('request_url_invalid', invalid),
+                            ('request_url_blocked', blocked)):
+            if count:
+                statsd_client.incr(stat, count)
+
+        return netlocs
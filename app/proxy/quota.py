@@ -0,0 +1,102 @@
+import math
+import time
+
+import redis
+
+from proxy.stats import statsd_client
+
+
+class ConsumerQuota(object):
+    # Token buckets per consumer in redis, one for the requests it makes and
+    # one for the uncached URLs it has queued for fetching.  Consumers are
+    # named by a configured API key, or else by the client address the
+    # trusted proxies forwarded.
+
+    KEY_HEADER = 'X-Api-Key'
+    ANONYMOUS = 'anonymous'
+
+    # Refills the bucket for the time since it was last taken from, then
+    # takes the tokens only if they are all there, so concurrent requests
+    # cannot overdraw it.  Returns the milliseconds until they would be.
+    # More tokens than the bucket holds wait for it to be full.
+    TAKE_SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local cost = math.min(tonumber(ARGV[3]), burst)
+        local now = tonumber(ARGV[4])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+        local tokens = tonumber(bucket[1]) or burst
+        local updated_at = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+        if tokens < cost then
+            return math.ceil((cost - tokens) / rate * 1000)
+        end
+        redis.call(
+            'HMSET', KEYS[1], 'tokens', tokens - cost, 'updated_at', now)
+        redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+        return 0
+    """
+
+    class QuotaException(Exception):
+
+        def __init__(self, retry_after):
+            super(ConsumerQuota.QuotaException, self).__init__(
+                'Quota exceeded, retry after {seconds} seconds.'.format(
+                    seconds=retry_after))
+            self.retry_after = retry_after
+            # The cached URLs of a request refused more fetches.
+            self.url_data = {}
+
+    def __init__(self, redis_client, limits, api_keys, proxy_hops=1):
+        self.redis_client = redis_client
+        self.limits = limits
+        self.api_keys = api_keys
+        self.proxy_hops = proxy_hops
+        self._take = redis_client.register_script(self.TAKE_SCRIPT)
+
+    def get_consumer(self, request):
+        name = self.api_keys.get(request.headers.get(self.KEY_HEADER))
+        if name is not None:
+            return 'key:{name}'.format(name=name)
+
+        # Each proxy appends the address it was connected from, so the
+        # client's is proxy_hops from the end.  Earlier addresses in the
+        # header may have been made up by the client.
+        addresses = [
+            address.strip() for address
+            in request.headers.get('X-Forwarded-For', '').split(',')
+            if address.strip()]
+        address = (
+            addresses[-min(self.proxy_hops, len(addresses))] if addresses
+            else request.remote_addr)
+        return 'addr:{address}'.format(address=address)
+
+    def _get_metric_name(self, consumer):
+        # Addresses are counted together rather than each given its own
+        # metrics.
+        kind, _, name = consumer.partition(':')
+        return name if kind == 'key' else self.ANONYMOUS
+
+    def take(self, consumer, bucket, tokens):
+        limit = self.limits[bucket]
+        metric_name = self._get_metric_name(consumer)
+
+        # Quotas protect the upstream services rather than the cache, so
+        # requests are still served while redis cannot be reached.
+        try:
+            wait = self._take(
+                keys=['QUOTA:{consumer}:{bucket}'.format(
+                    consumer=consumer, bucket=bucket)],
+                args=[limit['rate'], limit['burst'], tokens, time.time()],
+            )
+        except redis.RedisError:
+            statsd_client.incr('quota_check_fail')
+            return
+
+        if wait:
+            statsd_client.incr('{consumer}_quota_{bucket}_exceeded'.format(
+                consumer=metric_name, bucket=bucket))
+            raise self.QuotaException(int(math.ceil(wait / 1000.0)))
+
+        statsd_client.incr('{consumer}_quota_{bucket}'.format(
+            consumer=metric_name, bucket=bucket), tokens)
@@ -0,0 +1,41 @@
+import random
+
+import redis
+
+from proxy.stats import statsd_client
+
+
+class ReplicaRedis(object):
+    # Sends bulk cache reads to a read replica and every other command to
+    # the primary.
+
+    def __init__(self, primary, replicas):
+        self.primary = primary
+        self.replicas = replicas
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+    def mget(self, keys):
+        try:
+            values = random.choice(self.replicas).mget(keys)
+            statsd_client.incr('redis_replica_read')
+        except redis.RedisError:
+            statsd_client.incr('redis_replica_read_fail')
+            return self.primary.mget(keys)
+
+        # A lagging replica may not have a sentinel or result just written
+        # to the primary yet.  Confirming its misses on the primary keeps a
+        # queued URL from being queued again.
+        missed = [index for index, value in enumerate(values) if value is None]
+
+        if missed:
+            primary_values = self.primary.mget(
+                [keys[index] for index in missed])
+
+            for index, value in zip(missed, primary_values):
+                if value is not None:
+                    statsd_client.incr('redis_replica_lag_miss')
+                    values[index] = value
+
+        return values
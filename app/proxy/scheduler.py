@@ -0,0 +1,63 @@
+import signal
+import sys
+import time
+
+from proxy.stats import statsd_client
+
+
+class RecommendationsScheduler(object):
+    # One scheduler runs beside each worker.  Only the one holding the leader
+    # lock refreshes the recommendations, and another takes over when its
+    # lock expires.
+
+    def __init__(self, pocket_client, leader_lock, refresh_margin, interval):
+        self.pocket_client = pocket_client
+        self.leader_lock = leader_lock
+        self.refresh_margin = refresh_margin
+        self.interval = interval
+
+    def tick(self):
+        try:
+            is_leader = self.leader_lock.acquire_or_renew()
+        except self.leader_lock.LockException:
+            statsd_client.incr('scheduler_leader_lock_fail')
+            return False
+
+        if not is_leader:
+            return False
+
+        statsd_client.incr('scheduler_leader_tick')
+
+        try:
+            if (self.pocket_client.needs_refresh(self.refresh_margin) and
+                    self.pocket_client.refresh_recommended_urls()):
+                statsd_client.incr('scheduler_recommended_refresh')
+        except self.pocket_client.PocketException:
+            # The last good recommendations stay in place until Pocket
+            # recovers, so a failed refresh is retried on the next tick.
+            statsd_client.incr('scheduler_recommended_refresh_fail')
+
+        return True
+
+    def run(self):  # pragma: no cover
+        def stop(signum, frame):
+            sys.exit(0)
+
+        signal.signal(signal.SIGTERM, stop)
+
+        try:
+            while True:
+                self.tick()
+                time.sleep(self.interval)
+        finally:
+            self.leader_lock.release()
+
+
+def main():  # pragma: no cover
+    from proxy.app import get_recommendations_scheduler
+
+    get_recommendations_scheduler().run()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
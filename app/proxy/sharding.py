@@ -0,0 +1,170 @@
+import bisect
+import hashlib
+import threading
+
+from proxy.replicas import ReplicaRedis
+
+
+def run_concurrently(calls):
+    # Runs each (function, args) pair in its own thread, which the gevent
+    # worker patches into a greenlet, and returns the results in order.
+    if len(calls) == 1:
+        return [calls[0][0](*calls[0][1])]
+
+    results = [None] * len(calls)
+    errors = []
+
+    def run(index, function, args):
+        try:
+            results[index] = function(*args)
+        except Exception, e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=run, args=(index, function, args))
+        for index, (function, args) in enumerate(calls)
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return results
+
+
+def get_nodes(redis_client):
+    # The redis servers behind a cache client, for commands like SCAN that
+    # have to visit every node.  Replicas are skipped for the primary.
+    if isinstance(redis_client, ReplicaRedis):
+        redis_client = redis_client.primary
+
+    if isinstance(redis_client, ShardedRedis):
+        return [
+            redis_client.nodes[node] for node in sorted(redis_client.nodes)]
+
+    return [redis_client]
+
+
+class HashRing(object):
+
+    def __init__(self, nodes, replicas=160):
+        self.ring = sorted(
+            (self._hash(u'{node}-{replica}'.format(
+                node=node, replica=replica)), node)
+            for node in nodes
+            for replica in range(replicas)
+        )
+        self.hashes = [node_hash for node_hash, node in self.ring]
+
+    def _hash(self, key):
+        return int(hashlib.md5(key.encode('utf8')).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        index = bisect.bisect(self.hashes, self._hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class ShardedRedis(object):
+    # Routes the single key cache commands to one of several redis nodes by
+    # consistent hashing, so adding a node only moves a share of the keys.
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.ring = HashRing(sorted(nodes))
+
+    def get_node(self, key):
+        return self.nodes[self.ring.get_node(key)]
+
+    def group_keys(self, keys):
+        grouped_keys = {}
+
+        for key in keys:
+            grouped_keys.setdefault(self.ring.get_node(key), []).append(key)
+
+        return grouped_keys
+
+    def get(self, key):
+        return self.get_node(key).get(key)
+
+    def setex(self, key, timeout, value):
+        return self.get_node(key).setex(key, timeout, value)
+
+    def ttl(self, key):
+        return self.get_node(key).ttl(key)
+
+    def mget(self, keys):
+        grouped_keys = self.group_keys(keys).items()
+
+        values = {}
+        for (node, node_keys), node_values in zip(
+                grouped_keys, run_concurrently([
+                    (self.nodes[node].mget, (node_keys,))
+                    for node, node_keys in grouped_keys])):
+            values.update(zip(node_keys, node_values))
+
+        return [values[key] for key in keys]
+
+    def delete(self, *keys):
+        return sum(run_concurrently([
+            (self.nodes[node].delete, node_keys)
+            for node, node_keys in self.group_keys(keys).items()
+        ]))
+
+    def ping(self):
+        return all(run_concurrently([
+            (node.ping, ()) for node in self.nodes.values()]))
+
+    def pipeline(self, transaction=False):
+        return ShardedPipeline(self, transaction)
+
+
+class ShardedPipeline(object):
+    # Queues single key commands and runs one pipeline per node, each node
+    # concurrently.  A transaction is only atomic within a node.
+
+    def __init__(self, sharded_redis, transaction):
+        self.sharded_redis = sharded_redis
+        self.transaction = transaction
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue_command(key, *args, **kwargs):
+            self.commands.append((name, key, args, kwargs))
+            return self
+
+        return queue_command
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        node_commands = {}
+
+        for index, (name, key, args, kwargs) in enumerate(commands):
+            node = self.sharded_redis.ring.get_node(key)
+            node_commands.setdefault(node, []).append(
+                (index, name, key, args, kwargs))
+
+        def execute_node(node, queued_commands):
+            pipeline = self.sharded_redis.nodes[node].pipeline(
+                transaction=self.transaction)
+
+            for index, name, key, args, kwargs in queued_commands:
+                getattr(pipeline, name)(key, *args, **kwargs)
+
+            return pipeline.execute()
+
+        node_commands = node_commands.items()
+        results = [None] * len(commands)
+
+        for (_, queued_commands), node_results in zip(
+                node_commands, run_concurrently([
+                    (execute_node, node_queued_commands)
+                    for node_queued_commands in node_commands])):
+            for queued_command, result in zip(queued_commands, node_results):
+                results[queued_command[0]] = result
+
+        return results
@@ -0,0 +1,240 @@
+import argparse
+import struct
+import sys
+import time
+import zlib
+
+from proxy.metadata import MetadataClient
+from proxy.sharding import get_nodes
+
+SNAPSHOT_MAGIC = 'PROXYSNAP2'
+SERVICES = ('embedly', 'mozilla')
+
+# Each chunk is a length prefixed zlib block of records, each record a
+# length prefixed key and value and the remaining TTL in milliseconds, or -1
+# for a key without expiry.  Keys hold a requested URL of any length, so
+# their length takes as many bytes as a value's.
+CHUNK_HEADER = struct.Struct('!I')
+RECORD_HEADER = struct.Struct('!IIq')
+TIMESTAMP = struct.Struct('!d')
+
+
+def pack_records(records):
+    return zlib.compress(''.join(
+        RECORD_HEADER.pack(len(key), len(value), ttl) + key + value
+        for key, value, ttl in records))
+
+
+def unpack_records(chunk):
+    data = zlib.decompress(chunk)
+    position = 0
+
+    while position < len(data):
+        key_length, value_length, ttl = RECORD_HEADER.unpack_from(
+            data, position)
+        position += RECORD_HEADER.size
+        key = data[position:position + key_length]
+        position += key_length
+        value = data[position:position + value_length]
+        position += value_length
+        yield key, value, ttl
+
+
+def read_chunks(snapshot_file):
+    while True:
+        header = snapshot_file.read(CHUNK_HEADER.size)
+        if not header:
+            break
+
+        # A snapshot cut short, say by a full disk, is reported rather than
+        # restored up to wherever it was cut.
+        if len(header) < CHUNK_HEADER.size:
+            raise ValueError('Truncated snapshot.')
+
+        chunk_length, = CHUNK_HEADER.unpack(header)
+        chunk = snapshot_file.read(chunk_length)
+        if len(chunk) < chunk_length:
+            raise ValueError('Truncated snapshot.')
+
+        yield chunk
+
+
+class SnapshotExporter(object):
+    # Walks every cache node with SCAN, so neither redis nor this process
+    # ever holds more than a batch of keys, and writes one chunk per batch.
+
+    def __init__(self, cache_redis_client, services, batch_size,
+                 output=sys.stderr):
+        self.cache_redis_client = cache_redis_client
+        self.services = services
+        self.batch_size = batch_size
+        self.output = output
+        self.stats = {
+            'keys': 0,
+            'skipped': 0,
+            'bytes': 0,
+        }
+
+    def export_batch(self, node, keys, snapshot_file):
+        pipeline = node.pipeline(transaction=False)
+        for key in keys:
+            pipeline.get(key).pttl(key)
+        results = pipeline.execute()
+
+        records = []
+        for key, value, ttl in zip(keys, results[::2], results[1::2]):
+            # Sentinels are only meaningful to the cluster whose job queue
+            # holds the fetch, and keys may expire between SCAN and GET.
+            if value is None or value == MetadataClient.IN_JOB_QUEUE_JSON:
+                self.stats['skipped'] += 1
+            else:
+                records.append((key, value, ttl if ttl >= 0 else -1))
+
+        if records:
+            chunk = pack_records(records)
+            snapshot_file.write(CHUNK_HEADER.pack(len(chunk)) + chunk)
+            self.stats['keys'] += len(records)
+            self.stats['bytes'] += CHUNK_HEADER.size + len(chunk)
+
+    def export_node(self, node, service, snapshot_file):
+        batch = []
+        for key in node.scan_iter(
+                match='{service}:*'.format(service=service),
+                count=self.batch_size):
+            batch.append(key)
+
+            if len(batch) >= self.batch_size:
+                self.export_batch(node, batch, snapshot_file)
+                batch = []
+                self.report()
+
+        if batch:
+            self.export_batch(node, batch, snapshot_file)
+
+    def report(self):
+        self.output.write(
+            'keys={keys} skipped={skipped} bytes={bytes}\n'.format(
+                **self.stats))
+
+    def run(self, snapshot_file):
+        snapshot_file.write(SNAPSHOT_MAGIC + TIMESTAMP.pack(time.time()))
+
+        for node in get_nodes(self.cache_redis_client):
+            for service in self.services:
+                self.export_node(node, service, snapshot_file)
+
+        self.report()
+
+        return self.stats
+
+
+class SnapshotImporter(object):
+    # Restores a snapshot a chunk at a time with one pipeline per chunk.
+    # TTLs are shortened by the time since the export, so an entry expires
+    # in the new cluster when it would have in the old one.
+
+    def __init__(self, cache_redis_client, rate, overwrite,
+                 output=sys.stderr):
+        self.cache_redis_client = cache_redis_client
+        self.rate = rate
+        self.overwrite = overwrite
+        self.output = output
+        self.stats = {
+            'keys': 0,
+            'expired': 0,
+        }
+
+    def throttle(self, started):
+        if self.rate:
+            ahead = self.stats['keys'] / float(self.rate) - (
+                time.time() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def import_chunk(self, chunk, elapsed):
+        pipeline = self.cache_redis_client.pipeline(transaction=False)
+
+        for key, value, ttl in unpack_records(chunk):
+            if ttl < 0:
+                pipeline.set(key, value, nx=not self.overwrite)
+            elif ttl > elapsed:
+                pipeline.set(
+                    key, value, px=ttl - elapsed, nx=not self.overwrite)
+            else:
+                self.stats['expired'] += 1
+                continue
+
+            self.stats['keys'] += 1
+
+        pipeline.execute()
+
+    def report(self):
+        self.output.write(
+            'keys={keys} expired={expired}\n'.format(**self.stats))
+
+    def run(self, snapshot_file):
+        if snapshot_file.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError('Not a cache snapshot.')
+
+        exported_at, = TIMESTAMP.unpack(snapshot_file.read(TIMESTAMP.size))
+        started = time.time()
+
+        for chunk in read_chunks(snapshot_file):
+            elapsed = int((time.time() - exported_at) * 1000)
+            self.import_chunk(chunk, elapsed)
+            self.report()
+            self.throttle(started)
+
+        return self.stats
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Export the metadata cache to a snapshot file, or '
+                    'import one into another cluster.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    export_parser = subparsers.add_parser('export')
+    export_parser.add_argument('path')
+    export_parser.add_argument(
+        '--service', choices=SERVICES, action='append',
+        help='Only export this cache; may be repeated.')
+    export_parser.add_argument(
+        '--batch-size', type=int, default=1000,
+        help='Keys per SCAN call, pipeline and chunk.')
+
+    import_parser = subparsers.add_parser('import')
+    import_parser.add_argument('path')
+    import_parser.add_argument(
+        '--rate', type=float, default=5000,
+        help='Most keys written per second, 0 for no limit.')
+    import_parser.add_argument(
+        '--overwrite', action='store_true',
+        help='Replace keys that are already cached.')
+
+    return parser
+
+
+def main():  # pragma: no cover
+    from proxy.app import get_cache_redis_client
+
+    args = get_parser().parse_args()
+
+    if args.command == 'export':
+        with open(args.path, 'wb') as snapshot_file:
+            SnapshotExporter(
+                get_cache_redis_client(),
+                services=args.service or SERVICES,
+                batch_size=args.batch_size,
+            ).run(snapshot_file)
+    else:
+        with open(args.path, 'rb') as snapshot_file:
+            SnapshotImporter(
+                get_cache_redis_client(),
+                rate=args.rate,
+                overwrite=args.overwrite,
+            ).run(snapshot_file)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -2,5 +2,47 @@ import os
 
 import statsd
 
-statsd_client = statsd.StatsClient(
+from proxy.metrics import SharedMetrics
+
+
+class StatsClient(statsd.StatsClient):
+    # Also records every stat in the shared metrics served on /__metrics__,
+    # so numbers are not lost with dropped statsd packets.
+
+    def __init__(self, metrics=None, **kwargs):
+        super(StatsClient, self).__init__(**kwargs)
+        self.metrics = metrics
+
+    def _record(self, method, *args):
+        if self.metrics is None:
+            return
+
+        # Like sending to statsd, recording must never fail a request.
+        try:
+            getattr(self.metrics, method)(*args)
+        except EnvironmentError:
+            pass
+
+    def incr(self, stat, count=1, rate=1):
+        super(StatsClient, self).incr(stat, count, rate)
+        self._record('incr', stat, count)
+
+    def gauge(self, stat, value, rate=1, delta=False):
+        super(StatsClient, self).gauge(stat, value, rate, delta)
+        self._record('gauge', stat, value)
+
+    def timing(self, stat, delta, rate=1):
+        super(StatsClient, self).timing(stat, delta, rate)
+        self._record('timing', stat, delta)
+
+
+def get_metrics():
+    metrics_dir = os.environ.get('METRICS_DIR')
+
+    if metrics_dir:
+        return SharedMetrics(metrics_dir, prefix='embedly_proxy')
+
+
+statsd_client = StatsClient(
+    metrics=get_metrics(),
     host=os.environ.get('STATSD_HOST', 'localhost'), prefix='embedly_proxy')
@@ -1,11 +1,14 @@
 def fetch_embedly_data(urls, start_time, redis_client=None):
     import time
+    from rq import get_current_job
     from proxy.app import get_embedly_client
     from proxy.stats import statsd_client
 
     statsd_client.incr('task_fetch_url_start')
 
     embedly_client = get_embedly_client(redis_client=redis_client)
+    embedly_client.remove_queued_job(
+        get_current_job(connection=embedly_client.redis_client))
 
     url_data = embedly_client.get_remote_urls(urls)
 
@@ -17,12 +20,15 @@ def fetch_embedly_data(urls, start_time, redis_client=None):
 
 def fetch_mozilla_data(urls, start_time, redis_client=None):
     import time
+    from rq import get_current_job
     from proxy.app import get_mozilla_client
     from proxy.stats import statsd_client
 
     statsd_client.incr('task_fetch_mozilla_start')
 
     mozilla_client = get_mozilla_client(redis_client=redis_client)
+    mozilla_client.remove_queued_job(
+        get_current_job(connection=mozilla_client.redis_client))
 
     url_data = mozilla_client.get_remote_urls(urls)
 
@@ -32,7 +38,27 @@ def fetch_mozilla_data(urls, start_time, redis_client=None):
     statsd_client.timing('task_fetch_mozilla_time', job_time)
 
 
-def fetch_recommended_urls(start_time, redis_client=None):
+def fetch_provider_chain_data(urls, start_time, redis_client=None):
+    import time
+    from rq import get_current_job
+    from proxy.app import get_provider_chain_client
+    from proxy.stats import statsd_client
+
+    statsd_client.incr('task_fetch_chain_start')
+
+    chain_client = get_provider_chain_client(redis_client=redis_client)
+    chain_client.remove_queued_job(
+        get_current_job(connection=chain_client.redis_client))
+
+    url_data = chain_client.get_remote_urls(urls)
+
+    statsd_client.gauge('task_fetch_chain_cached', len(url_data.keys()))
+
+    job_time = int((time.time() - start_time) * 1000)
+    statsd_client.timing('task_fetch_chain_time', job_time)
+
+
+def fetch_recommended_urls(start_time, lock_token=None, redis_client=None):
     import time
     from proxy.app import get_pocket_client
     from proxy.stats import statsd_client
@@ -43,5 +69,8 @@ def fetch_recommended_urls(start_time, redis_client=None):
 
     pocket_client.fetch_recommended_urls()
 
+    if lock_token is not None:
+        pocket_client.release_refresh_lock(lock_token)
+
     job_time = int((time.time() - start_time) * 1000)
     statsd_client.timing('task_fetch_recommended_time', job_time)
@@ -1,4 +1,5 @@
 import copy
+import json
 from unittest import TestCase
 
 import mock
@@ -45,7 +46,13 @@ class AppTest(TestCase):
 
         self.mock_redis = mock.Mock()
         self.mock_redis.get.return_value = None
+        self.mock_redis.mget.side_effect = lambda keys: [
+            self.mock_redis.get(key) for key in keys]
         self.mock_redis.setex.return_value = None
+        self.mock_redis.hmget.side_effect = lambda key, fields: [
+            None for field in fields]
+        self.mock_redis.pipeline.return_value.execute.return_value = []
+        self.mock_redis.zremrangebyscore.return_value = 0
 
         self.mock_job_queue = mock.Mock()
 
@@ -78,3 +85,9 @@ class AppTest(TestCase):
             url: self.get_mock_url_data(url)
             for url in urls
         }
+
+    def load_url_data(self, url_data):
+        return {
+            url: json.loads(data)
+            for url, data in url_data.items()
+        }
@@ -0,0 +1,116 @@
+from unittest import TestCase
+
+import mock
+
+from proxy.analyze import CacheAnalyzer, get_bucket, get_parser
+from proxy.metadata import MetadataClient
+
+
+class FakeNode(object):
+
+    def __init__(self, values, ttls):
+        self.values = values
+        self.ttls = ttls
+
+    def dbsize(self):
+        return len(self.values)
+
+    def scan_iter(self, count):
+        return iter(sorted(self.values) + ['embedly:http://expired.com/'])
+
+    def pipeline(self, transaction):
+        node = self
+        results = []
+        pipeline = mock.Mock()
+
+        pipeline.strlen.side_effect = lambda key: results.append(
+            len(node.values.get(key, ''))) or pipeline
+        pipeline.pttl.side_effect = lambda key: results.append(
+            node.ttls.get(key, -1 if key in node.values else -2)) or pipeline
+        pipeline.getrange.side_effect = lambda key, start, end: results.append(
+            node.values.get(key, '')[start:end + 1]) or pipeline
+        pipeline.execute.side_effect = lambda: results
+        return pipeline
+
+
+class TestCacheAnalyzer(TestCase):
+
+    def setUp(self):
+        self.node = FakeNode(
+            values={
+                'embedly:http://example.com/1': 'a' * 100,
+                'embedly:http://example.com/2': 'a' * 300,
+                'embedly:http://other.com/': MetadataClient.IN_JOB_QUEUE_JSON,
+                'mozilla:http://example.com/1': 'a' * 1000,
+                'rq:queue:default': 'job',
+            },
+            ttls={
+                'embedly:http://example.com/1': 30 * 1000,
+                'embedly:http://example.com/2': 2 * 60 * 60 * 1000,
+                'embedly:http://other.com/': 60 * 60 * 1000,
+            },
+        )
+
+    def analyze(self, **kwargs):
+        options = {
+            'batch_size': 2,
+            'rate': 0,
+            'sample': 0,
+            'top_domains': 1,
+        }
+        options.update(kwargs)
+        return CacheAnalyzer(self.node, **options).run()
+
+    def test_report_per_service(self):
+        report = self.analyze()
+
+        self.assertEqual(report['scanned_keys'], 6)
+        self.assertEqual(report['total_keys'], 5)
+
+        embedly = report['services']['embedly']
+        self.assertEqual(embedly['keys'], 3)
+        self.assertEqual(embedly['sentinels'], 1)
+        self.assertEqual(embedly['bytes'], 400 + len(
+            MetadataClient.IN_JOB_QUEUE_JSON))
+        self.assertEqual(embedly['sizes'], {'<=128': 1, '<=512': 1})
+        self.assertEqual(
+            embedly['ttls'], {'<=60': 1, '<=3600': 1, '<=21600': 1})
+        self.assertEqual(embedly['no_ttl'], 0)
+        self.assertEqual(embedly['top_domains'], [
+            {'domain': 'example.com', 'keys': 2, 'bytes': 400}])
+
+        mozilla = report['services']['mozilla']
+        self.assertEqual(mozilla['keys'], 1)
+        self.assertEqual(mozilla['no_ttl'], 1)
+        self.assertEqual(mozilla['mean_bytes'], 1000)
+
+    def test_sample_is_scaled_to_keyspace(self):
+        report = self.analyze(sample=3)
+
+        self.assertEqual(report['scanned_keys'], 3)
+        self.assertEqual(report['services']['embedly']['keys'], 3)
+        self.assertEqual(report['services']['embedly']['estimated_keys'], 5)
+
+    def test_empty_keyspace(self):
+        self.node.values = {}
+
+        report = self.analyze()
+
+        self.assertEqual(report['services']['mozilla']['mean_bytes'], 0)
+        self.assertEqual(report['services']['mozilla']['estimated_keys'], 0)
+
+    def test_scan_is_rate_limited(self):
+        with mock.patch('proxy.analyze.time.sleep') as mock_sleep:
+            self.analyze(rate=1)
+
+        self.assertTrue(mock_sleep.called)
+
+    def test_buckets(self):
+        self.assertEqual(get_bucket([10, 100], 10), '<=10')
+        self.assertEqual(get_bucket([10, 100], 1000), '>100')
+
+    def test_parser_defaults(self):
+        args = get_parser().parse_args([])
+
+        self.assertEqual(args.sample, 0)
+        self.assertEqual(args.top_domains, 20)
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import time
 
@@ -5,7 +6,8 @@ import mock
 import redis
 from werkzeug.exceptions import HTTPException
 
-from proxy.api.views import get_metadata
+from proxy.api.views import (
+    STREAM_MIMETYPE, get_metadata, get_single_metadata)
 from proxy.tests.base import AppTest
 from proxy.tests.test_metadata import (
     EmbedlyClientTest, MozillaClientTest, MetadataClientTest)
@@ -36,6 +38,26 @@ class TestLBHeartbeat(AppTest):
         self.assertEqual(response.status_code, 200)
 
 
+class TestMetrics(AppTest):
+
+    def test_metrics_are_rendered(self):
+        with mock.patch('proxy.api.views.statsd_client') as mock_statsd:
+            mock_statsd.metrics.render.return_value = 'metric 1.0\n'
+            response = self.client.get('/__metrics__')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, 'metric 1.0\n')
+        self.assertEqual(
+            response.headers['Content-Type'], 'text/plain; version=0.0.4')
+
+    def test_not_found_without_shared_metrics(self):
+        with mock.patch('proxy.api.views.statsd_client') as mock_statsd:
+            mock_statsd.metrics = None
+            response = self.client.get('/__metrics__')
+
+        self.assertEqual(response.status_code, 404)
+
+
 class TestVersion(AppTest):
 
     def test_version_returns_git_info(self):
@@ -56,18 +78,24 @@ class TestGetMetadata(MetadataClientTest):
     def get_config(self, **kwargs):
         config = {
             'MAXIMUM_POST_URLS': 10,
+            'MAXIMUM_STREAM_URLS': 100,
+            'MAXIMUM_STREAM_WAIT': 5,
+            'STREAM_POLL_INTERVAL': 0.5,
         }
 
         config.update(**kwargs)
         return config
 
-    def get_mock_request(self, urls=[],
-                         content='', content_type='application/json'):
+    def get_mock_request(self, urls=[], content='',
+                         content_type='application/json', headers=None,
+                         args=None):
         mock_request = mock.Mock()
         mock_request.content_type = content_type
         mock_request.json = content or {
             'urls': urls,
         }
+        mock_request.headers = headers or {}
+        mock_request.args = args or {}
 
         return mock_request
 
@@ -134,6 +162,29 @@ class TestGetMetadata(MetadataClientTest):
 
         self.assertEqual(cm.exception.response.status_code, 400)
 
+    def test_repeated_invalid_and_blocked_urls_are_left_out(self):
+        def mock_cache_get(cache_key):
+            for url in self.sample_urls:
+                if url in cache_key:
+                    return json.dumps(self.get_mock_url_data(url))
+
+        self.mock_redis.get.side_effect = mock_cache_get
+        self.metadata_client.preprocessor.blocked_domains = ['embedly.com']
+
+        request = self.get_mock_request(urls=self.sample_urls + [
+            self.sample_urls[0],
+            'not a url',
+            'http://embedly.com/',
+        ])
+        response = get_metadata(
+            self.metadata_client, self.get_config(), request)
+
+        self.assertEqual(self.mock_redis.get.call_count, len(self.sample_urls))
+        self.assertEqual(json.loads(response.data), {
+            'urls': self.expected_response,
+            'error': '',
+        })
+
     def test_extract_returns_cached_data(self):
         cached_urls = self.sample_urls
 
@@ -164,6 +215,231 @@ class TestGetMetadata(MetadataClientTest):
         })
 
 
+class TestStreamMetadata(MetadataClientTest):
+
+    def get_config(self, **kwargs):
+        config = {
+            'MAXIMUM_POST_URLS': 1,
+            'MAXIMUM_STREAM_URLS': 3,
+            'MAXIMUM_STREAM_WAIT': 5,
+            'STREAM_POLL_INTERVAL': 0.5,
+        }
+
+        config.update(**kwargs)
+        return config
+
+    def get_mock_request(self, urls, wait=None):
+        mock_request = mock.Mock()
+        mock_request.content_type = 'application/json'
+        mock_request.json = {'urls': urls}
+        mock_request.headers = {'Accept': STREAM_MIMETYPE}
+        mock_request.args = {'wait': wait} if wait is not None else {}
+
+        return mock_request
+
+    def get_stream_lines(self, response):
+        return [json.loads(line) for line in response.response]
+
+    def fake_cache(self, urls):
+        def mock_cache_get(cache_key):
+            for url in urls:
+                if url in cache_key:
+                    return json.dumps(self.get_mock_url_data(url))
+
+        return mock_cache_get
+
+    def test_cached_urls_streamed_beyond_maximum_post_urls(self):
+        self.mock_redis.get.side_effect = self.fake_cache(self.sample_urls)
+
+        request = self.get_mock_request(self.sample_urls)
+        response = get_metadata(
+            self.metadata_client, self.get_config(), request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, STREAM_MIMETYPE)
+        self.assertEqual(self.get_stream_lines(response), [
+            {'url': url, 'data': self.get_mock_url_data(url)}
+            for url in self.sample_urls
+        ] + [{'error': ''}])
+
+    def test_rejects_calls_with_too_many_urls(self):
+        config = self.get_config(MAXIMUM_STREAM_URLS=1)
+        request = self.get_mock_request(self.sample_urls)
+
+        with self.assertRaises(HTTPException) as cm:
+            get_metadata(self.metadata_client, config, request)
+
+        self.assertEqual(cm.exception.response.status_code, 400)
+
+    def test_rejects_invalid_wait(self):
+        request = self.get_mock_request(self.sample_urls, wait='soon')
+
+        with self.assertRaises(HTTPException) as cm:
+            get_metadata(self.metadata_client, self.get_config(), request)
+
+        self.assertEqual(cm.exception.response.status_code, 400)
+
+    @mock.patch('proxy.api.views.time')
+    def test_fetched_urls_streamed_during_wait(self, mock_time):
+        mock_time.time.return_value = 0
+        mock_cache = {}
+
+        def mock_setex(key, time, value, *args, **kwargs):
+            mock_cache[key] = value
+
+        def mock_sleep(seconds):
+            # The job finishes during the first poll interval.
+            for url in self.sample_urls:
+                mock_cache[self.metadata_client._get_cache_key(url)] = (
+                    json.dumps(self.get_mock_url_data(url)))
+
+        self.mock_redis.get.side_effect = mock_cache.get
+        self.mock_redis.setex.side_effect = mock_setex
+        mock_time.sleep.side_effect = mock_sleep
+
+        request = self.get_mock_request(self.sample_urls, wait='2')
+        response = get_metadata(
+            self.metadata_client, self.get_config(), request)
+
+        self.assertEqual(self.get_stream_lines(response), [
+            {'url': url, 'data': self.get_mock_url_data(url)}
+            for url in self.sample_urls
+        ] + [{'error': ''}])
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 2)
+        mock_time.sleep.assert_called_once_with(0.5)
+
+    @mock.patch('proxy.api.views.time')
+    def test_wait_stops_at_deadline(self, mock_time):
+        mock_time.time.side_effect = [0, 0, 10]
+
+        request = self.get_mock_request(self.sample_urls, wait='60')
+        response = get_metadata(
+            self.metadata_client, self.get_config(), request)
+
+        self.assertEqual(self.get_stream_lines(response), [{'error': ''}])
+        self.assertEqual(mock_time.sleep.call_count, 1)
+
+    def test_redis_error_ends_stream_with_error(self):
+        self.mock_redis.get.side_effect = redis.RedisError()
+
+        request = self.get_mock_request(self.sample_urls)
+        response = get_metadata(
+            self.metadata_client, self.get_config(), request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_stream_lines(response), [
+            {'error': 'Unable to read from redis.'}])
+
+
+class TestGetSingleMetadata(MetadataClientTest):
+
+    def get_mock_request(self, url=None, headers=None):
+        mock_request = mock.Mock()
+        mock_request.args = {'url': url} if url else {}
+        mock_request.headers = headers or {}
+
+        return mock_request
+
+    def set_cached_value(self, value, ttl):
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            value, ttl]
+
+    def test_missing_url_returns_400(self):
+        with self.assertRaises(HTTPException) as cm:
+            get_single_metadata(
+                self.metadata_client, {}, self.get_mock_request())
+
+        self.assertEqual(cm.exception.response.status_code, 400)
+
+    def test_cached_url_returns_etag_and_max_age_from_ttl(self):
+        url = self.sample_urls[0]
+        cached_json = json.dumps(self.get_mock_url_data(url))
+        self.set_cached_value(cached_json, 3600)
+
+        response = get_single_metadata(
+            self.metadata_client, {}, self.get_mock_request(url))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.headers['Cache-Control'], 'public, max-age=3600')
+        self.assertEqual(
+            response.headers['ETag'],
+            '"{}"'.format(hashlib.sha1(cached_json).hexdigest()))
+        self.assertEqual(json.loads(response.data), {
+            'urls': {url: self.get_mock_url_data(url)},
+            'error': '',
+        })
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 0)
+
+    def test_matching_etag_returns_304_without_parsing(self):
+        url = self.sample_urls[0]
+        cached_json = json.dumps(self.get_mock_url_data(url))
+        etag = '"{}"'.format(hashlib.sha1(cached_json).hexdigest())
+        self.set_cached_value(cached_json, 3600)
+
+        request = self.get_mock_request(
+            url, headers={'If-None-Match': '"other", {}'.format(etag)})
+
+        with mock.patch('proxy.api.views.json.loads') as mock_loads:
+            response = get_single_metadata(
+                self.metadata_client, {}, request)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(mock_loads.call_count, 0)
+
+    def test_uncached_url_is_queued_and_not_cacheable(self):
+        self.set_cached_value(None, -2)
+
+        response = get_single_metadata(
+            self.metadata_client, {},
+            self.get_mock_request(self.sample_urls[0]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        self.assertNotIn('ETag', response.headers)
+        self.assertEqual(json.loads(response.data), {
+            'urls': {},
+            'error': '',
+        })
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 1)
+
+    def test_queued_url_is_not_queued_again(self):
+        self.set_cached_value(self.metadata_client.IN_JOB_QUEUE_JSON, 30)
+
+        response = get_single_metadata(
+            self.metadata_client, {},
+            self.get_mock_request(self.sample_urls[0]))
+
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 0)
+
+    def test_invalid_url_is_not_looked_up(self):
+        response = get_single_metadata(
+            self.metadata_client, {},
+            self.get_mock_request('ftp://example.com/'))
+
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(json.loads(response.data), {
+            'urls': {},
+            'error': '',
+        })
+        self.assertEqual(self.mock_redis.pipeline.call_count, 0)
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 0)
+
+    def test_redis_error_returns_500(self):
+        self.mock_redis.pipeline.return_value.execute.side_effect = (
+            redis.RedisError())
+
+        with self.assertRaises(HTTPException) as cm:
+            get_single_metadata(
+                self.metadata_client, {},
+                self.get_mock_request(self.sample_urls[0]))
+
+        self.assertEqual(cm.exception.response.status_code, 500)
+
+
 class TestEmbedlyMetadata(EmbedlyClientTest):
 
     def test_extract_returns_cached_data(self):
@@ -196,8 +472,40 @@ class TestEmbedlyMetadata(EmbedlyClientTest):
             'error': '',
         })
 
-    def test_request_method_must_be_post(self):
+    def test_extract_streams_cached_data(self):
+        self.mock_redis.get.return_value = json.dumps(
+            self.get_mock_url_data(self.sample_urls[0]))
+
+        response = self.client.post(
+            '/v2/extract',
+            data=json.dumps({'urls': self.sample_urls[:1]}),
+            content_type='application/json',
+            headers={'Accept': STREAM_MIMETYPE},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Accel-Buffering'], 'no')
+        self.assertEqual(response.data.splitlines()[-1], '{"error": ""}')
+
+    def test_get_request_requires_url(self):
         response = self.client.get('/v2/extract')
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_request_returns_cached_data(self):
+        url = self.sample_urls[0]
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            json.dumps(self.get_mock_url_data(url)), 100]
+
+        response = self.client.get('/v2/extract', query_string={'url': url})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {
+            'urls': {url: self.get_mock_url_data(url)},
+            'error': '',
+        })
+
+    def test_request_method_must_be_get_or_post(self):
+        response = self.client.put('/v2/extract')
         self.assertEqual(response.status_code, 405)
 
 
@@ -233,19 +541,39 @@ class TestMozillaMetadata(MozillaClientTest):
             'error': '',
         })
 
-    def test_request_method_must_be_post(self):
+    def test_get_request_requires_url(self):
         response = self.client.get('/v2/metadata')
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_request_returns_cached_data(self):
+        url = self.sample_urls[0]
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            json.dumps(self.get_mock_url_data(url)), 100]
+
+        response = self.client.get('/v2/metadata', query_string={'url': url})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {
+            'urls': {url: self.get_mock_url_data(url)},
+            'error': '',
+        })
+
+    def test_request_method_must_be_get_or_post(self):
+        response = self.client.put('/v2/metadata')
         self.assertEqual(response.status_code, 405)
 
 
 class TestPocket(PocketClientTest):
 
     def test_uncached_recommendations_returns_empty_queues_job(self):
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            None, False]
+
         response = self.client.get('/v2/recommendations')
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(self.mock_redis.get.call_count, 1)
-        self.assertEqual(self.mock_redis.setex.call_count, 1)
+        self.assertEqual(self.mock_redis.get.call_count, 0)
+        self.assertEqual(self.mock_redis.set.call_count, 1)
         self.assertEqual(self.mock_job_queue.enqueue.call_count, 1)
 
         response_data = json.loads(response.data)
@@ -253,6 +581,8 @@ class TestPocket(PocketClientTest):
             'urls': [],
             'error': '',
         })
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        self.assertNotIn('ETag', response.headers)
 
     def test_cached_recommendations_returned(self):
         recommendation_data = [{
@@ -263,7 +593,10 @@ class TestPocket(PocketClientTest):
             'timestamp': time.time(),
         }]
 
-        self.mock_redis.get.return_value = json.dumps(recommendation_data)
+        recommendation_json = json.dumps(recommendation_data)
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            hashlib.sha1(recommendation_json).hexdigest(), True]
+        self.mock_redis.get.return_value = recommendation_json
 
         response = self.client.get('/v2/recommendations')
 
@@ -277,9 +610,65 @@ class TestPocket(PocketClientTest):
             'urls': recommendation_data,
             'error': '',
         })
+        self.assertEqual(
+            response.headers['Cache-Control'], 'public, max-age=60')
+        self.assertEqual(
+            response.headers['ETag'],
+            '"{version}"'.format(
+                version=hashlib.sha1(recommendation_json).hexdigest()))
+
+    def test_snapshot_served_without_reloading(self):
+        recommendation_json = json.dumps([{
+            'url': 'http://www.example.com/recommended',
+            'timestamp': time.time(),
+        }])
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            hashlib.sha1(recommendation_json).hexdigest(), True]
+        self.mock_redis.get.return_value = recommendation_json
+
+        first_response = self.client.get('/v2/recommendations')
+        second_response = self.client.get('/v2/recommendations')
+
+        self.assertEqual(second_response.data, first_response.data)
+        self.assertEqual(self.mock_redis.get.call_count, 1)
+
+    def test_matching_etag_returns_304(self):
+        recommendation_json = json.dumps([{
+            'url': 'http://www.example.com/recommended',
+            'timestamp': time.time(),
+        }])
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            hashlib.sha1(recommendation_json).hexdigest(), True]
+        self.mock_redis.get.return_value = recommendation_json
+
+        etag = self.client.get('/v2/recommendations').headers['ETag']
+        response = self.client.get(
+            '/v2/recommendations', headers={'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_last_good_served_if_fetch_cannot_be_queued(self):
+        recommendation_json = json.dumps([{
+            'url': 'http://www.example.com/recommended',
+            'timestamp': time.time(),
+        }])
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            hashlib.sha1(recommendation_json).hexdigest(), False]
+        self.mock_redis.get.return_value = recommendation_json
+        self.mock_job_queue.enqueue.side_effect = Exception
+
+        response = self.client.get('/v2/recommendations')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            json.loads(response.data)['urls'],
+            json.loads(recommendation_json))
 
     def test_pocket_exception_returns_500(self):
-        self.mock_redis.get.side_effect = redis.RedisError()
+        self.mock_redis.pipeline.return_value.execute.side_effect = (
+            redis.RedisError())
 
         response = self.client.get('/v2/recommendations')
 
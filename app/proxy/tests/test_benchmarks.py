@@ -0,0 +1,59 @@
+import json
+from unittest import TestCase
+
+from benchmarks.memory_redis import MemoryRedis
+from benchmarks.wsgi import application
+
+
+class TestBenchmarkApp(TestCase):
+    # The load tests run the app on MemoryRedis by default, so it has to
+    # keep up with the commands the request path sends.
+
+    def setUp(self):
+        self.client = application.test_client()
+
+    def test_misses_are_queued(self):
+        response = self.client.post(
+            '/v2/metadata',
+            data=json.dumps({'urls': ['http://www.example.com/missing']}),
+            content_type='application/json',
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            json.loads(response.data), {'urls': {}, 'error': ''})
+
+    def test_single_miss_is_queued(self):
+        response = self.client.get(
+            '/v2/extract?url=http%3A%2F%2Fwww.example.com%2Fsingle')
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_heartbeat(self):
+        self.assertEqual(self.client.get('/__heartbeat__').status_code, 200)
+
+
+class TestMemoryRedis(TestCase):
+
+    def setUp(self):
+        self.redis_client = MemoryRedis()
+
+    def test_hashes(self):
+        self.redis_client.hincrby('hash', 'a', 2)
+        self.redis_client.hincrby('hash', 'a')
+
+        self.assertEqual(
+            self.redis_client.hmget('hash', ['a', 'b']), ['3', None])
+        self.assertEqual(self.redis_client.hgetall('hash'), {'a': '3'})
+
+    def test_sorted_sets(self):
+        self.redis_client.execute_command('ZADD', 'set', 'NX', 1, 'a', 2, 'b')
+        self.redis_client.execute_command('ZADD', 'set', 'NX', 5, 'a')
+        self.redis_client.zadd('set', 3, 'b', 4, 'c')
+
+        self.assertEqual(self.redis_client.zscore('set', 'a'), 1)
+        self.assertEqual(self.redis_client.zcount('set', 2, '+inf'), 2)
+        self.assertEqual(self.redis_client.zrem('set', 'c', 'd'), 1)
+        self.assertEqual(
+            self.redis_client.zremrangebyscore('set', '-inf', 1), 1)
+        self.assertEqual(self.redis_client.zscore('set', 'b'), 3)
@@ -0,0 +1,374 @@
+import json
+from unittest import TestCase
+
+import mock
+import redis
+import requests
+
+from proxy.app import get_embedly_client
+from proxy.health import HealthMonitor, UpstreamResults, WorkerRegistry
+from proxy.tests.base import AppTest
+from proxy.tests.test_metadata import MetadataClientTest
+from proxy.workqueue import URLQueue
+
+
+class HealthTest(TestCase):
+
+    def setUp(self):
+        mock_statsd_patcher = mock.patch('proxy.health.statsd_client')
+        self.mock_statsd = mock_statsd_patcher.start()
+        self.addCleanup(mock_statsd_patcher.stop)
+
+        mock_time_patcher = mock.patch(
+            'proxy.health.time.time', return_value=1000.0)
+        self.mock_time = mock_time_patcher.start()
+        self.addCleanup(mock_time_patcher.stop)
+
+        self.mock_redis = mock.Mock()
+
+
+class TestUpstreamResults(HealthTest):
+
+    def setUp(self):
+        super(TestUpstreamResults, self).setUp()
+
+        self.upstream_results = UpstreamResults(self.mock_redis, window=60)
+
+    def test_results_are_counted_per_window(self):
+        self.upstream_results.record('embedly', True)
+        self.upstream_results.record('embedly', False)
+
+        pipeline = self.mock_redis.pipeline.return_value
+        self.assertEqual(pipeline.hincrby.call_args_list, [
+            mock.call('UPSTREAM_RESULTS:16', 'embedly:success', 1),
+            mock.call('UPSTREAM_RESULTS:16', 'embedly:failure', 1),
+        ])
+        pipeline.expire.assert_called_with('UPSTREAM_RESULTS:16', 120)
+
+    def test_counts_cover_the_previous_window(self):
+        windows = {
+            'UPSTREAM_RESULTS:16': {
+                'embedly:success': '3', 'embedly:failure': '1'},
+            'UPSTREAM_RESULTS:15': {
+                'embedly:success': '2', 'mozilla:failure': '4'},
+        }
+        self.mock_redis.hgetall.side_effect = windows.get
+
+        self.assertEqual(self.upstream_results.get_counts(), {
+            'embedly': {'success': 5, 'failure': 1},
+            'mozilla': {'success': 0, 'failure': 4},
+        })
+
+    def test_write_failure(self):
+        self.mock_redis.pipeline.return_value.execute.side_effect = (
+            redis.RedisError)
+
+        self.upstream_results.record('embedly', True)
+
+        self.mock_statsd.incr.assert_called_once_with(
+            'upstream_results_write_fail')
+
+
+class TestWorkerRegistry(HealthTest):
+
+    def setUp(self):
+        super(TestWorkerRegistry, self).setUp()
+
+        self.registry = WorkerRegistry(self.mock_redis, timeout=30)
+        self.pipeline = self.mock_redis.pipeline.return_value
+
+    def test_beats_are_written_a_few_times_a_timeout(self):
+        self.registry.beat()
+        self.mock_time.return_value = 1005.0
+        self.registry.beat()
+        self.mock_time.return_value = 1010.0
+        self.registry.beat()
+
+        self.assertEqual(self.pipeline.zadd.call_args_list, [
+            mock.call('WORKER_HEARTBEATS', 1000.0, self.registry.name),
+            mock.call('WORKER_HEARTBEATS', 1010.0, self.registry.name),
+        ])
+        self.pipeline.zremrangebyscore.assert_called_with(
+            'WORKER_HEARTBEATS', '-inf', 980.0)
+
+    def test_beat_failure_is_retried(self):
+        self.pipeline.execute.side_effect = [redis.RedisError, []]
+
+        self.registry.beat()
+        self.registry.beat()
+
+        self.assertEqual(self.pipeline.execute.call_count, 2)
+        self.mock_statsd.incr.assert_called_once_with('worker_heartbeat_fail')
+
+    def test_count_recent_beats(self):
+        self.mock_redis.zcount.return_value = 2
+
+        self.assertEqual(self.registry.count(), 2)
+        self.mock_redis.zcount.assert_called_once_with(
+            'WORKER_HEARTBEATS', 970.0, '+inf')
+
+
+class TestHealthMonitor(HealthTest):
+
+    def setUp(self):
+        super(TestHealthMonitor, self).setUp()
+
+        mock_workers_patcher = mock.patch(
+            'proxy.health.Worker.all', return_value=[mock.Mock()])
+        self.mock_workers = mock_workers_patcher.start()
+        self.addCleanup(mock_workers_patcher.stop)
+
+        self.metadata_client = mock.Mock()
+        self.metadata_client.SERVICE_NAME = 'embedly'
+        self.metadata_client.get_queue_size.return_value = 10
+        self.metadata_client.get_oldest_queued_at.return_value = 990.0
+
+        self.worker_registry = mock.Mock()
+        self.worker_registry.count.return_value = 2
+
+        self.upstream_results = mock.Mock()
+        self.upstream_results.get_counts.return_value = {
+            'embedly': {'success': 90, 'failure': 10},
+        }
+
+        self.pool = mock.Mock()
+        self.pool.get_saturation.return_value = 0.5
+
+        self.monitor = HealthMonitor(
+            self.mock_redis,
+            self.mock_redis,
+            [self.metadata_client],
+            self.worker_registry,
+            self.upstream_results,
+            {('primary', 'localhost', 6379): self.pool},
+            interval=5,
+            limits={
+                'pool_saturation': 0.9,
+                'queue_age': 60,
+                'queue_depth': 100,
+                'redis_latency_ms': 100,
+                'upstream_error_rate': 0.25,
+                'upstream_requests': 20,
+                'workers': 1,
+            },
+        )
+
+    def test_healthy_report(self):
+        self.assertEqual(self.monitor.probe(), {
+            'checked_at': 1000.0,
+            'status': 'ok',
+            'problems': [],
+            'redis_latency_ms': 0,
+            'queues': {'embedly': {'depth': 10, 'oldest_age': 10}},
+            'workers': 3,
+            'upstream': {'embedly': {'requests': 100, 'error_rate': 0.1}},
+            'pool_saturation': {'primary:localhost:6379': 0.5},
+        })
+
+    def test_dead_without_redis(self):
+        self.mock_redis.ping.side_effect = redis.ConnectionError
+
+        report = self.monitor.probe()
+
+        self.assertEqual(report['status'], 'dead')
+        self.assertEqual(report['problems'], ['redis'])
+        self.mock_statsd.incr.assert_called_once_with('health_dead')
+
+    def test_degraded_past_limits(self):
+        self.mock_time.side_effect = [1000.0, 1000.0, 1000.2, 1000.2, 1000.2]
+        self.metadata_client.get_queue_size.return_value = 1000
+        self.metadata_client.get_oldest_queued_at.return_value = 100.0
+        self.mock_workers.return_value = []
+        self.worker_registry.count.return_value = 0
+        self.upstream_results.get_counts.return_value = {
+            'embedly': {'success': 50, 'failure': 50},
+            'mozilla': {'success': 0, 'failure': 5},
+        }
+        self.pool.get_saturation.return_value = 1
+
+        report = self.monitor.probe()
+
+        self.assertEqual(report['status'], 'degraded')
+        self.assertEqual(report['problems'], [
+            'redis_latency',
+            'embedly_queue_depth',
+            'embedly_queue_age',
+            'workers',
+            'embedly_upstream_errors',
+            'pool_saturation',
+        ])
+        self.mock_statsd.incr.assert_called_once_with('health_degraded')
+
+    def test_empty_queue_has_no_age(self):
+        self.metadata_client.get_oldest_queued_at.return_value = None
+
+        report = self.monitor.probe()
+
+        self.assertEqual(report['queues']['embedly']['oldest_age'], 0)
+
+    def test_failed_probes_degrade(self):
+        self.metadata_client.get_queue_size.side_effect = (
+            URLQueue.URLQueueException)
+        self.upstream_results.get_counts.side_effect = redis.RedisError
+
+        report = self.monitor.probe()
+
+        self.assertEqual(report['status'], 'degraded')
+        self.assertEqual(
+            report['problems'], ['queues_failed', 'upstream_failed'])
+        self.assertEqual(report['workers'], 3)
+
+    def test_report_is_cached(self):
+        report = self.monitor.get_report()
+
+        self.mock_time.return_value = 1015.0
+        self.assertIs(self.monitor.get_report(), report)
+
+        self.mock_time.return_value = 1016.0
+        self.assertIsNot(self.monitor.get_report(), report)
+
+    def test_run_refreshes_the_report(self):
+        with mock.patch('proxy.health.gevent.sleep',
+                        side_effect=[None, StopIteration]) as mock_sleep:
+            with self.assertRaises(StopIteration):
+                self.monitor.run()
+
+        mock_sleep.assert_called_with(5)
+        self.assertEqual(self.mock_redis.ping.call_count, 4)
+        self.assertEqual(self.monitor.report['status'], 'ok')
+
+    def test_start(self):
+        with mock.patch('proxy.health.gevent.spawn') as mock_spawn:
+            self.monitor.start()
+
+        mock_spawn.assert_called_once_with(self.monitor.run)
+
+
+class TestMetadataClientHealth(MetadataClientTest):
+
+    def test_oldest_job_is_read_from_the_queued_times(self):
+        self.mock_job_queue.count = 2
+        self.mock_redis.zrange.return_value = [('job-id', 100.0)]
+
+        with mock.patch('proxy.metadata.time.time', return_value=1000.0):
+            self.assertEqual(
+                self.metadata_client.get_oldest_queued_at(), 100.0)
+
+        self.mock_redis.zremrangebyscore.assert_called_once_with(
+            'QUEUED_JOBS:test-service', '-inf', 990.0)
+        self.mock_redis.zrange.assert_called_once_with(
+            'QUEUED_JOBS:test-service', 0, 0, withscores=True)
+
+    def test_empty_or_missing_jobs_have_no_age(self):
+        self.mock_job_queue.count = 0
+        self.assertEqual(self.metadata_client.get_oldest_queued_at(), None)
+
+        self.mock_job_queue.count = 1
+        self.mock_redis.zrange.return_value = []
+        self.assertEqual(self.metadata_client.get_oldest_queued_at(), None)
+
+    def test_queued_jobs_are_recorded_until_started(self):
+        job = self.mock_job_queue.enqueue.return_value
+        job.id = 'job-id'
+
+        with mock.patch('proxy.metadata.time.time', return_value=100.0):
+            self.metadata_client.queue_urls(self.sample_urls)
+        self.metadata_client.remove_queued_job(job)
+        self.metadata_client.remove_queued_job(None)
+
+        self.mock_redis.zadd.assert_called_once_with(
+            'QUEUED_JOBS:test-service', 100.0, 'job-id')
+        self.mock_redis.zrem.assert_called_once_with(
+            'QUEUED_JOBS:test-service', 'job-id')
+
+    @mock.patch('proxy.metadata.statsd_client')
+    def test_queued_job_write_failures_are_counted(self, mock_statsd):
+        self.mock_redis.zadd.side_effect = redis.RedisError
+        self.mock_redis.zrem.side_effect = redis.RedisError
+
+        self.metadata_client.queue_urls(self.sample_urls)
+        self.metadata_client.remove_queued_job(
+            self.mock_job_queue.enqueue.return_value)
+
+        self.assertEqual(
+            mock_statsd.incr.call_args_list.count(
+                mock.call('queued_job_write_fail')), 2)
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 1)
+
+    def test_oldest_url_on_the_url_queue(self):
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            2, [(json.dumps(['b', 10.0]), 10.0)]]
+        self.metadata_client.url_queue = URLQueue(self.mock_redis)
+
+        self.assertEqual(self.metadata_client.get_oldest_queued_at(), 10.0)
+        self.mock_redis.pipeline.return_value.zrange.assert_called_with(
+            'URL_QUEUE_TIMES:test-service', 0, 0, withscores=True)
+
+    def test_url_queue_read_failure(self):
+        self.mock_redis.pipeline.return_value.execute.side_effect = (
+            redis.RedisError)
+
+        with self.assertRaises(URLQueue.URLQueueException):
+            URLQueue(self.mock_redis).get_oldest_queued_at('embedly')
+
+    def test_upstream_results_are_recorded(self):
+        upstream_results = mock.Mock()
+        self.metadata_client.upstream_results = upstream_results
+
+        self.metadata_client.get_remote_urls(self.sample_urls)
+
+        self.metadata_client._make_remote_request.side_effect = None
+        self.metadata_client._make_remote_request.return_value = (
+            self.get_mock_response(status=500))
+        with self.assertRaises(self.metadata_client.MetadataClientException):
+            self.metadata_client.get_remote_urls(self.sample_urls)
+
+        self.metadata_client._make_remote_request.side_effect = (
+            requests.RequestException())
+        with self.assertRaises(self.metadata_client.MetadataClientException):
+            self.metadata_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(upstream_results.record.call_args_list, [
+            mock.call('test-service', True),
+            mock.call('test-service', False),
+            mock.call('test-service', False),
+        ])
+
+
+class TestHealthEndpoints(AppTest):
+
+    def setUp(self):
+        super(TestHealthEndpoints, self).setUp()
+
+        self.app.health_monitor = mock.Mock()
+        self.app.health_monitor.DEAD = HealthMonitor.DEAD
+
+    def get_health(self, status):
+        self.app.health_monitor.get_report.return_value = {
+            'status': status, 'problems': []}
+        return self.client.get('/__health__')
+
+    def test_status_codes(self):
+        self.assertEqual(self.get_health('ok').status_code, 200)
+        self.assertEqual(self.get_health('degraded').status_code, 429)
+        self.assertEqual(self.get_health('dead').status_code, 503)
+
+    def test_report_is_returned(self):
+        response = self.get_health('ok')
+
+        self.assertEqual(
+            json.loads(response.data), {'status': 'ok', 'problems': []})
+
+    def test_heartbeat_fails_only_when_dead(self):
+        self.assertEqual(self.get_health('degraded').status_code, 429)
+        self.assertEqual(self.client.get('/__heartbeat__').status_code, 200)
+
+        self.get_health('dead')
+        self.assertEqual(self.client.get('/__heartbeat__').status_code, 500)
+
+    def test_clients_share_the_upstream_results_key(self):
+        embedly_client = get_embedly_client(
+            self.mock_redis, self.mock_job_queue)
+
+        self.assertEqual(
+            embedly_client.upstream_results.redis_client, self.mock_redis)
@@ -0,0 +1,82 @@
+import mock
+import redis
+
+from proxy.lock import RedisLock
+from proxy.tests.base import AppTest
+
+
+class RedisLockTest(AppTest):
+
+    def setUp(self):
+        super(RedisLockTest, self).setUp()
+
+        self.mock_renew = mock.Mock()
+        self.mock_release = mock.Mock()
+        self.mock_redis.register_script.side_effect = [
+            self.mock_renew, self.mock_release]
+
+        self.lock = RedisLock(self.mock_redis, 'LOCK_KEY', 1.5, token='abc')
+
+
+class TestRedisLock(RedisLockTest):
+
+    def test_acquire_sets_token_only_if_not_held(self):
+        self.mock_redis.set.return_value = True
+
+        self.assertTrue(self.lock.acquire())
+        self.mock_redis.set.assert_called_once_with(
+            'LOCK_KEY', 'abc', px=1500, nx=True)
+
+    def test_acquire_fails_if_held(self):
+        self.mock_redis.set.return_value = None
+
+        self.assertFalse(self.lock.acquire())
+
+    def test_renew_extends_only_our_token(self):
+        self.mock_renew.return_value = 1
+
+        self.assertTrue(self.lock.renew())
+        self.mock_renew.assert_called_once_with(
+            keys=['LOCK_KEY'], args=['abc', 1500])
+
+    def test_acquire_or_renew_acquires_when_not_held(self):
+        self.mock_renew.return_value = 0
+        self.mock_redis.set.return_value = True
+
+        self.assertTrue(self.lock.acquire_or_renew())
+        self.assertEqual(self.mock_redis.set.call_count, 1)
+
+    def test_acquire_or_renew_does_not_acquire_when_renewed(self):
+        self.mock_renew.return_value = 1
+
+        self.assertTrue(self.lock.acquire_or_renew())
+        self.assertEqual(self.mock_redis.set.call_count, 0)
+
+    def test_release_deletes_only_our_token(self):
+        self.mock_release.return_value = 0
+
+        self.assertFalse(self.lock.release())
+        self.mock_release.assert_called_once_with(
+            keys=['LOCK_KEY'], args=['abc'])
+
+    def test_token_is_generated(self):
+        self.mock_redis.register_script.side_effect = None
+
+        lock = RedisLock(self.mock_redis, 'LOCK_KEY', 1)
+        other_lock = RedisLock(self.mock_redis, 'LOCK_KEY', 1)
+
+        self.assertNotEqual(lock.token, other_lock.token)
+
+    def test_redis_errors_raise_lock_exception(self):
+        self.mock_redis.set.side_effect = redis.RedisError
+        self.mock_renew.side_effect = redis.RedisError
+        self.mock_release.side_effect = redis.RedisError
+
+        with self.assertRaises(RedisLock.LockException):
+            self.lock.acquire()
+
+        with self.assertRaises(RedisLock.LockException):
+            self.lock.renew()
+
+        with self.assertRaises(RedisLock.LockException):
+            self.lock.release()
@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 import random
 import json
+import os
+import threading
+import time
 
 import mock
 import redis
 import requests
 
-from proxy.metadata import EmbedlyClient, MetadataClient, MozillaClient
+from proxy.app import get_provider_chain_client
+from proxy.metadata import (
+    EmbedlyClient, MetadataClient, MozillaClient, ProviderChainClient)
 from proxy.tests.base import AppTest
 
 
@@ -92,7 +97,10 @@ class TestMetadataClientExtractURLsAsync(MetadataClientTest):
             (len(uncached_urls)/self.app.config['URL_BATCH_SIZE']) + 1,
         )
 
-        self.assertEqual(cached_url_data, self.get_response_data([cached_url]))
+        self.assertEqual(
+            self.load_url_data(cached_url_data),
+            self.get_response_data([cached_url]),
+        )
 
     def test_url_queried_multiple_times_starts_only_one_job(self):
         mock_cache = {}
@@ -153,7 +161,7 @@ class TestMetadataClientExtractURLsAsync(MetadataClientTest):
         self.assertEqual(self.mock_redis.setex.call_count, 0)
         self.assertEqual(self.mock_job_queue.enqueue.call_count, 1)
 
-        self.assertEqual(cached_url_data, {
+        self.assertEqual(self.load_url_data(cached_url_data), {
             url: self.get_mock_url_data(url) for url in cached_urls
         })
 
@@ -177,18 +185,33 @@ class TestMetadataClientExtractURLsAsync(MetadataClientTest):
         self.assertEqual(
             self.mock_job_queue.enqueue.call_args[0][1], [allowed_domain])
 
+    def test_preprocessed_urls_are_not_parsed_again(self):
+        netlocs = self.metadata_client.preprocess_urls(
+            self.sample_urls + self.sample_urls)
 
-class TestMetadataClientGetCachedURLs(MetadataClientTest):
+        with mock.patch('proxy.metadata.urlparse.urlparse') as mock_urlparse:
+            self.metadata_client.extract_urls_async(netlocs.keys(), netlocs)
+
+        self.assertEqual(mock_urlparse.call_count, 0)
+        self.assertEqual(self.mock_redis.get.call_count, 2)
+        self.assertEqual(
+            sorted(call[0][0] for call in
+                   self.mock_domain_limiter.checked_insert.call_args_list),
+            ['example.com', 'www.example.com'])
 
-    def test_invalid_json_in_cache_raises_exception(self):
 
-        def mocked_lookup(key):
-            return '\invalid json'
+class TestMetadataClientGetCachedURLs(MetadataClientTest):
 
-        self.mock_redis.get.side_effect = mocked_lookup
+    def test_cached_json_is_returned_without_parsing(self):
+        cached_json = json.dumps(self.get_mock_url_data(self.sample_urls[0]))
+        self.mock_redis.get.return_value = cached_json
 
-        with self.assertRaises(MetadataClient.MetadataClientException):
-            self.metadata_client.get_cached_urls(self.sample_urls)
+        with mock.patch('proxy.metadata.json.loads') as mock_loads:
+            extracted_urls = self.metadata_client.get_cached_urls(
+                self.sample_urls[:1])
+
+        self.assertEqual(mock_loads.call_count, 0)
+        self.assertEqual(extracted_urls, {self.sample_urls[0]: cached_json})
 
     def test_redis_get_error_raises_exception(self):
         self.mock_redis.get.side_effect = redis.RedisError
@@ -222,7 +245,8 @@ class TestMetadataClientGetCachedURLs(MetadataClientTest):
             for url in self.sample_urls
         }
 
-        self.assertEqual(extracted_urls, expected_response)
+        self.assertEqual(
+            self.load_url_data(extracted_urls), expected_response)
 
 
 class TestMetadataClientGetRemoteURLs(MetadataClientTest):
@@ -352,6 +376,235 @@ class TestMetadataClientGetRemoteURLs(MetadataClientTest):
         self.assertEqual(mock_cache.keys(), [existing_url_key])
 
 
+class TestMetadataClientPopularity(MetadataClientTest):
+
+    def setUp(self):
+        super(TestMetadataClientPopularity, self).setUp()
+
+        self.hot_url = self.sample_urls[0]
+        self.cold_url = self.sample_urls[1]
+        self.hot_key = self.metadata_client._get_cache_key(self.hot_url)
+        self.cold_key = self.metadata_client._get_cache_key(self.cold_url)
+
+        self.mock_statsd = self.patch_statsd()
+
+        self.counts = {self.hot_key: 100, self.cold_key: 1}
+        self.mock_popularity = mock.Mock()
+        self.mock_popularity.get_counts.side_effect = lambda keys: {
+            key: self.counts[key] for key in keys}
+        self.mock_popularity.get_timeout.side_effect = lambda count: count
+        self.mock_popularity.is_hot.side_effect = lambda count: count > 10
+        self.metadata_client.popularity = self.mock_popularity
+        self.metadata_client.admission_timeout = 10
+
+    def patch_statsd(self):
+        mock_statsd_patcher = mock.patch('proxy.metadata.statsd_client')
+        self.addCleanup(mock_statsd_patcher.stop)
+        return mock_statsd_patcher.start()
+
+    def set_admission_policy(self, min_requests, reject):
+        self.metadata_client.admission_policies = {
+            self.metadata_client.SERVICE_NAME: {
+                'min_requests': min_requests,
+                'reject': reject,
+            },
+        }
+
+    def get_queued_urls(self):
+        return [
+            enqueue_call[0][1]
+            for enqueue_call in self.mock_job_queue.enqueue.call_args_list]
+
+    def test_requests_are_recorded(self):
+        self.metadata_client.extract_urls_async(self.sample_urls)
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            None, -2]
+        self.metadata_client.get_cached_url_with_ttl(self.hot_url)
+
+        self.mock_popularity.record.assert_has_calls([
+            mock.call([self.hot_key, self.cold_key]),
+            mock.call([self.hot_key]),
+        ])
+
+    def test_popular_urls_are_queued_first(self):
+        self.metadata_client.queue_urls(self.sample_urls)
+
+        self.assertEqual(self.mock_job_queue.enqueue.call_args_list, [
+            mock.call(mock.ANY, [self.cold_url], mock.ANY, ttl=10,
+                      at_front=True),
+            mock.call(mock.ANY, [self.hot_url], mock.ANY, ttl=10,
+                      at_front=True),
+        ])
+
+    def test_cache_timeout_follows_popularity(self):
+        self.metadata_client.get_remote_urls(self.sample_urls)
+
+        self.mock_redis.setex.assert_has_calls([
+            mock.call(self.hot_key, 100, mock.ANY),
+            mock.call(self.cold_key, 1, mock.ANY),
+        ], any_order=True)
+
+    def test_urls_not_admitted_are_cached_briefly(self):
+        self.set_admission_policy(2, 'short')
+        self.counts[self.cold_key] = 1
+        self.mock_popularity.get_timeout.side_effect = lambda count: 1000
+
+        self.metadata_client.queue_urls(self.sample_urls)
+        self.metadata_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(
+            self.get_queued_urls(), [[self.cold_url], [self.hot_url]])
+        self.mock_redis.setex.assert_has_calls([
+            mock.call(self.hot_key, 1000, mock.ANY),
+            mock.call(self.cold_key, 10, mock.ANY),
+        ], any_order=True)
+        self.mock_statsd.incr.assert_any_call(
+            'test-service_admission_admitted', 1)
+        self.mock_statsd.incr.assert_any_call(
+            'test-service_admission_rejected', 1)
+
+    def test_urls_not_admitted_are_skipped(self):
+        self.set_admission_policy(2, 'skip')
+
+        queued_urls = self.metadata_client.queue_urls(self.sample_urls)
+
+        self.assertEqual(queued_urls, [self.hot_url])
+        self.assertEqual(self.get_queued_urls(), [[self.hot_url]])
+
+    def test_admission_off_at_one_request(self):
+        self.set_admission_policy(1, 'skip')
+        self.counts[self.cold_key] = 0
+        self.mock_popularity.get_timeout.side_effect = lambda count: 1000
+
+        self.metadata_client.queue_urls(self.sample_urls)
+        self.metadata_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(
+            self.get_queued_urls(), [[self.cold_url], [self.hot_url]])
+        self.mock_redis.setex.assert_has_calls([
+            mock.call(self.hot_key, 1000, mock.ANY),
+            mock.call(self.cold_key, 1000, mock.ANY),
+        ], any_order=True)
+
+    def test_warmed_urls_are_queued_whatever_the_policy(self):
+        self.set_admission_policy(2, 'skip')
+
+        queued_urls = self.metadata_client.queue_urls(
+            self.sample_urls, at_front=False, admission=False)
+
+        self.assertEqual(queued_urls, self.sample_urls)
+
+    def test_admission_off_for_other_services(self):
+        self.metadata_client.admission_policies = {'other': {
+            'min_requests': 1000, 'reject': 'skip'}}
+
+        self.metadata_client.queue_urls(self.sample_urls)
+
+        self.assertEqual(
+            self.get_queued_urls(), [[self.cold_url], [self.hot_url]])
+        self.assertNotIn(
+            mock.call('test-service_admission_rejected', 0),
+            self.mock_statsd.incr.call_args_list)
+
+
+class TestMetadataClientFreshness(MetadataClientTest):
+
+    def setUp(self):
+        super(TestMetadataClientFreshness, self).setUp()
+
+        mock_statsd_patcher = mock.patch('proxy.metadata.statsd_client')
+        self.mock_statsd = mock_statsd_patcher.start()
+        self.addCleanup(mock_statsd_patcher.stop)
+
+        self.mock_pipeline = self.mock_redis.pipeline.return_value
+
+    def get_timings(self):
+        return {
+            timing_call[0][0]: timing_call[0][1]
+            for timing_call in self.mock_statsd.timing.call_args_list
+            if 'freshness' in timing_call[0][0]
+        }
+
+    def test_first_misses_are_recorded_with_sentinels(self):
+        self.metadata_client.queue_urls(self.sample_urls)
+
+        self.mock_redis.execute_command.assert_called_once_with(
+            'ZADD', 'MISSES:test-service', 'NX',
+            mock.ANY, self.sample_urls[0], mock.ANY, self.sample_urls[1])
+
+    def test_misses_are_recorded_on_the_url_queue(self):
+        self.metadata_client.url_queue = mock.Mock()
+
+        self.metadata_client.queue_urls(self.sample_urls)
+
+        self.assertEqual(self.mock_redis.execute_command.call_count, 1)
+
+    def test_misses_are_not_recorded_when_queueing_fails(self):
+        self.mock_job_queue.enqueue.side_effect = redis.RedisError
+
+        self.metadata_client.queue_urls(self.sample_urls)
+
+        self.assertEqual(self.mock_redis.execute_command.call_count, 0)
+
+    def test_miss_write_failure(self):
+        self.mock_redis.execute_command.side_effect = redis.RedisError
+
+        self.metadata_client.queue_urls(self.sample_urls)
+
+        self.assertEqual(self.mock_redis.setex.call_count, 2)
+        self.mock_statsd.incr.assert_any_call('freshness_write_fail')
+
+    def test_time_to_fresh_is_recorded(self):
+        missed = time.time() - 10
+        self.mock_pipeline.execute.return_value = [missed, missed, 2]
+
+        self.metadata_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(self.mock_pipeline.zscore.call_count, 2)
+        zrem_args = self.mock_pipeline.zrem.call_args[0]
+        self.assertEqual(zrem_args[0], 'MISSES:test-service')
+        self.assertEqual(set(zrem_args[1:]), set(self.sample_urls))
+
+        timings = self.get_timings()
+        self.assertEqual(self.mock_statsd.timing.call_count, 6)
+        self.assertTrue(
+            10000 <= timings['test-service_freshness_queue_wait'] < 11000)
+        self.assertTrue(0 <= timings['test-service_freshness_upstream'] < 1000)
+        self.assertTrue(
+            timings['test-service_freshness_queue_wait'] <=
+            timings['test-service_freshness_total'] < 11000)
+
+    def test_urls_fetched_without_a_miss_are_not_timed(self):
+        self.mock_pipeline.execute.return_value = [None, None, 0]
+
+        self.metadata_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(self.get_timings(), {})
+
+    def test_unfilled_misses_are_counted(self):
+        self.mock_redis.zremrangebyscore.return_value = 3
+        self.metadata_client._make_remote_request.side_effect = (
+            lambda urls: self.get_mock_response(content='[]'))
+        self.metadata_client._parse_remote_data.side_effect = (
+            lambda urls, remote_data: {})
+
+        self.metadata_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(self.mock_pipeline.zrem.call_count, 0)
+        self.mock_redis.zremrangebyscore.assert_called_once_with(
+            'MISSES:test-service', '-inf', mock.ANY)
+        self.mock_statsd.incr.assert_any_call(
+            'test-service_freshness_unfilled', 3)
+
+    def test_read_failure(self):
+        self.mock_pipeline.execute.side_effect = redis.RedisError
+
+        extracted_urls = self.metadata_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(extracted_urls, self.expected_response)
+        self.mock_statsd.incr.assert_any_call('freshness_read_fail')
+
+
 class EmbedlyClientTest(MetadataClientTest):
 
     def get_metadata_client(self):
@@ -444,3 +697,219 @@ class TestMozillaClient(MozillaClientTest):
         self.assertIn(unmodified_url, extracted_urls)
         self.assertNotIn(original_modified_url, extracted_urls)
         self.assertNotIn(mozilla_modified_url, extracted_urls)
+
+
+class ProviderChainClientTest(MetadataClientTest):
+
+    def get_provider(self, service_name, urls_data=None):
+        provider = mock.Mock()
+        provider.SERVICE_NAME = service_name
+        provider.MetadataClientException = (
+            MetadataClient.MetadataClientException)
+        provider._get_validated_urls_data.side_effect = (
+            lambda urls: {
+                url: data for url, data in (urls_data or {}).items()
+                if url in urls
+            })
+        return provider
+
+    def get_chain_client(self, providers, **kwargs):
+        chain_kwargs = self.get_metadata_client_kwargs()
+        chain_kwargs.update(kwargs)
+
+        return ProviderChainClient(
+            'chain', providers, 200, 20, 95, **chain_kwargs)
+
+    def setUp(self):
+        super(ProviderChainClientTest, self).setUp()
+
+        self.mock_redis.lrange.return_value = []
+        self.first_provider = self.get_provider('first')
+        self.second_provider = self.get_provider('second')
+        self.chain_client = self.get_chain_client(
+            [self.first_provider, self.second_provider])
+
+
+class TestProviderChainClient(ProviderChainClientTest):
+
+    def test_first_provider_answers_all_urls(self):
+        self.first_provider = self.get_provider(
+            'first', self.expected_response)
+        self.chain_client.providers[0] = self.first_provider
+
+        remote_data = self.chain_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(remote_data, self.expected_response)
+        self.assertEqual(
+            self.second_provider._get_validated_urls_data.call_count, 0)
+        self.assertEqual(
+            self.mock_redis.setex.call_count, len(self.sample_urls))
+        self.assertEqual(
+            self.chain_client._get_cache_key(self.sample_urls[0]),
+            u'chain:{url}'.format(url=self.sample_urls[0]))
+
+    def test_missed_urls_fall_back_to_next_provider(self):
+        first_url, second_url = self.sample_urls
+        self.chain_client.providers = [
+            self.get_provider('first', {
+                first_url: self.expected_response[first_url]}),
+            self.get_provider('second', self.expected_response),
+        ]
+
+        remote_data = self.chain_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(remote_data, self.expected_response)
+        self.chain_client.providers[1]._get_validated_urls_data.\
+            assert_called_once_with([second_url])
+
+    def test_failed_provider_falls_back_to_next_provider(self):
+        self.first_provider._get_validated_urls_data.side_effect = (
+            MetadataClient.MetadataClientException)
+        self.chain_client.providers[1] = self.get_provider(
+            'second', self.expected_response)
+
+        remote_data = self.chain_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(remote_data, self.expected_response)
+
+    def test_all_providers_failing_raises_exception(self):
+        self.first_provider._get_validated_urls_data.side_effect = (
+            MetadataClient.MetadataClientException)
+        self.second_provider._get_validated_urls_data.side_effect = (
+            ValueError)
+
+        with self.assertRaises(MetadataClient.MetadataClientException):
+            self.chain_client.get_remote_urls(self.sample_urls)
+
+    def test_urls_missed_by_all_providers_are_omitted(self):
+        remote_data = self.chain_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(remote_data, {})
+        self.assertEqual(
+            self.second_provider._get_validated_urls_data.call_count, 1)
+
+    def test_provider_latency_is_recorded(self):
+        self.chain_client.get_remote_urls(self.sample_urls)
+
+        mock_pipeline = self.mock_redis.pipeline.return_value
+        mock_pipeline.lpush.assert_any_call(
+            'PROVIDER_LATENCY:first', mock.ANY)
+        mock_pipeline.ltrim.assert_any_call(
+            'PROVIDER_LATENCY:first', 0, 199)
+
+    @mock.patch('proxy.metadata.statsd_client')
+    def test_latency_write_failure_keeps_the_result(self, mock_statsd):
+        self.mock_redis.pipeline.return_value.execute.side_effect = (
+            redis.RedisError)
+        self.chain_client.providers[0] = self.get_provider(
+            'first', self.expected_response)
+
+        remote_data = self.chain_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(remote_data, self.expected_response)
+        self.assertEqual(
+            self.second_provider._get_validated_urls_data.call_count, 0)
+        mock_statsd.incr.assert_any_call('first_chain_latency_write_fail')
+
+    def test_latency_read_failure_raises_exception(self):
+        self.mock_redis.lrange.side_effect = redis.RedisError
+
+        with self.assertRaises(MetadataClient.MetadataClientException):
+            self.chain_client.get_remote_urls(self.sample_urls)
+
+    def test_hung_provider_times_out(self):
+        released = threading.Event()
+        self.addCleanup(released.set)
+        self.first_provider._get_validated_urls_data.side_effect = (
+            lambda urls: released.wait())
+        self.chain_client.providers = [self.first_provider]
+        self.chain_client.redis_job_timeout = 0.01
+
+        remote_data = self.chain_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(remote_data, {})
+
+
+class TestProviderChainClientHedging(ProviderChainClientTest):
+
+    def setUp(self):
+        super(TestProviderChainClientHedging, self).setUp()
+
+        self.released = threading.Event()
+        self.addCleanup(self.released.set)
+
+        def slow_provider(urls):
+            self.released.wait()
+            return self.expected_response
+
+        self.first_provider._get_validated_urls_data.side_effect = (
+            slow_provider)
+        self.chain_client.providers[1] = self.get_provider(
+            'second', self.expected_response)
+
+    def test_slow_provider_is_hedged_after_percentile_latency(self):
+        self.mock_redis.lrange.return_value = ['0.001'] * 19 + ['0.01']
+
+        remote_data = self.chain_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(remote_data, self.expected_response)
+        self.mock_redis.lrange.assert_called_with(
+            'PROVIDER_LATENCY:first', 0, -1)
+        self.chain_client.providers[1]._get_validated_urls_data.\
+            assert_called_once_with(self.sample_urls)
+
+    def test_provider_hedged_straight_away_at_zero_latency(self):
+        self.mock_redis.lrange.return_value = ['0.0'] * 20
+        self.chain_client.redis_job_timeout = 5
+
+        started = time.time()
+        remote_data = self.chain_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(remote_data, self.expected_response)
+        self.assertLess(time.time() - started, 1)
+
+    def test_provider_not_hedged_without_enough_samples(self):
+        self.mock_redis.lrange.return_value = ['0.001'] * 19
+        threading.Timer(0.05, self.released.set).start()
+
+        remote_data = self.chain_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(remote_data, self.expected_response)
+        self.assertEqual(
+            self.chain_client.providers[1]._get_validated_urls_data.call_count,
+            0)
+
+
+class TestProviderChainClientProviders(ProviderChainClientTest):
+
+    def test_mozilla_only_by_default(self):
+        chain_client = get_provider_chain_client(
+            redis_client=self.mock_redis, job_queue=self.mock_job_queue)
+
+        self.assertEqual(
+            [provider.SERVICE_NAME for provider in chain_client.providers],
+            ['mozilla'])
+
+    def test_chain_fetches_from_mozilla_then_embedly(self):
+        first_url, second_url = self.sample_urls
+        self.mock_requests_post.return_value = self.get_mock_response(
+            content=json.dumps({'urls': {
+                first_url: self.get_mock_url_data(first_url)}}))
+        self.mock_requests_get.return_value = self.get_mock_response(
+            content=json.dumps(self.get_mock_urls_data([second_url])))
+
+        with mock.patch.dict(
+                os.environ, {'METADATA_PROVIDERS': 'mozilla,embedly'}):
+            chain_client = get_provider_chain_client(
+                redis_client=self.mock_redis, job_queue=self.mock_job_queue)
+        self.mock_redis.pipeline.return_value.execute.return_value = []
+
+        remote_data = chain_client.get_remote_urls(self.sample_urls)
+
+        self.assertEqual(remote_data, self.expected_response)
+        self.assertEqual(
+            [provider.SERVICE_NAME for provider in chain_client.providers],
+            ['mozilla', 'embedly'])
+        self.assertEqual(
+            chain_client._get_cache_key(first_url),
+            u'mozilla:{url}'.format(url=first_url))
@@ -0,0 +1,179 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import mock
+
+from proxy.metrics import MetricsFile, SharedMetrics
+from proxy.stats import StatsClient, get_metrics
+
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.metrics = SharedMetrics(self.directory, 'embedly_proxy')
+
+    def in_process(self, pid):
+        return mock.patch('proxy.metrics.os.getpid', return_value=pid)
+
+
+class TestMetricsFile(MetricsTest):
+
+    def test_values_are_kept_after_the_file_grows(self):
+        path = os.path.join(self.directory, 'metrics_1.db')
+        metrics_file = MetricsFile(path, initial_size=64)
+
+        for index in range(20):
+            metrics_file.inc(('counter', 'stat_{}'.format(index), ''), index)
+        metrics_file.inc(('counter', 'stat_1', ''), 0.5)
+
+        self.assertGreater(os.path.getsize(path), 64)
+        values = {
+            key: value for key, _, value
+            in MetricsFile.read_entries(open(path, 'rb').read())}
+        self.assertEqual(len(values), 20)
+        self.assertEqual(values[('counter', 'stat_1', '')], 1.5)
+        self.assertEqual(values[('counter', 'stat_19', '')], 19)
+
+    def test_existing_file_is_carried_on(self):
+        path = os.path.join(self.directory, 'metrics_1.db')
+        MetricsFile(path).inc(('counter', 'stat', ''), 2)
+
+        metrics_file = MetricsFile(path)
+        metrics_file.inc(('counter', 'stat', ''), 1)
+        metrics_file.inc(('counter', 'other', ''), 1)
+
+        self.assertEqual(self.metrics.read(), {
+            ('counter', 'stat', ''): 3,
+            ('counter', 'other', ''): 1,
+        })
+
+    def test_empty_file_has_no_entries(self):
+        open(os.path.join(self.directory, 'metrics_1.db'), 'wb').close()
+
+        self.assertEqual(self.metrics.read(), {})
+
+
+class TestSharedMetrics(MetricsTest):
+
+    def test_values_are_summed_across_processes(self):
+        with self.in_process(1):
+            self.metrics.incr('redis_cache_hit')
+            self.metrics.incr('redis_cache_hit', 2)
+
+        with self.in_process(2):
+            self.metrics.incr('redis_cache_hit')
+            self.metrics.gauge('request_fetch_job_create', 5)
+
+        with self.in_process(1):
+            self.metrics.gauge('request_fetch_job_create', 3)
+
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+        self.assertEqual(self.metrics.read(), {
+            ('counter', 'redis_cache_hit', ''): 4,
+            ('summary', 'request_fetch_job_create', 'sum'): 8,
+            ('summary', 'request_fetch_job_create', 'count'): 2,
+        })
+
+    def test_render(self):
+        self.metrics.incr('heartbeat.pass')
+        self.metrics.gauge('request_fetch_job_create', 5)
+        self.metrics.timing('embedly_request_timer', 3)
+        self.metrics.timing('embedly_request_timer', 40.5)
+        self.metrics.timing('embedly_request_timer', 20000)
+
+        expected_lines = [
+            '# TYPE embedly_proxy_embedly_request_timer_milliseconds '
+            'histogram',
+            'embedly_proxy_embedly_request_timer_milliseconds_bucket'
+            '{le="5"} 1.0',
+            'embedly_proxy_embedly_request_timer_milliseconds_bucket'
+            '{le="10"} 1.0',
+            'embedly_proxy_embedly_request_timer_milliseconds_bucket'
+            '{le="25"} 1.0',
+            'embedly_proxy_embedly_request_timer_milliseconds_bucket'
+            '{le="50"} 2.0',
+            'embedly_proxy_embedly_request_timer_milliseconds_bucket'
+            '{le="100"} 2.0',
+            'embedly_proxy_embedly_request_timer_milliseconds_bucket'
+            '{le="250"} 2.0',
+            'embedly_proxy_embedly_request_timer_milliseconds_bucket'
+            '{le="500"} 2.0',
+            'embedly_proxy_embedly_request_timer_milliseconds_bucket'
+            '{le="1000"} 2.0',
+            'embedly_proxy_embedly_request_timer_milliseconds_bucket'
+            '{le="2500"} 2.0',
+            'embedly_proxy_embedly_request_timer_milliseconds_bucket'
+            '{le="5000"} 2.0',
+            'embedly_proxy_embedly_request_timer_milliseconds_bucket'
+            '{le="10000"} 2.0',
+            'embedly_proxy_embedly_request_timer_milliseconds_bucket'
+            '{le="+Inf"} 3.0',
+            'embedly_proxy_embedly_request_timer_milliseconds_sum 20043.5',
+            'embedly_proxy_embedly_request_timer_milliseconds_count 3.0',
+            '# TYPE embedly_proxy_heartbeat_pass_total counter',
+            'embedly_proxy_heartbeat_pass_total 1.0',
+            '# TYPE embedly_proxy_request_fetch_job_create summary',
+            'embedly_proxy_request_fetch_job_create_sum 5.0',
+            'embedly_proxy_request_fetch_job_create_count 1.0',
+        ]
+
+        self.assertEqual(
+            self.metrics.render(),
+            ''.join(line + '\n' for line in expected_lines))
+
+    def test_clear(self):
+        self.metrics.incr('redis_cache_hit')
+
+        self.metrics.clear()
+
+        self.assertEqual(self.metrics.render(), '')
+
+
+class TestStatsClient(MetricsTest):
+
+    def setUp(self):
+        super(TestStatsClient, self).setUp()
+
+        self.client = StatsClient(metrics=self.metrics, prefix='embedly_proxy')
+        self.client._send = mock.Mock()
+
+    def test_stats_are_sent_and_recorded(self):
+        self.client.incr('redis_cache_miss')
+        self.client.gauge('request_fetch_job_create', 5)
+        with self.client.timer('embedly_request_timer'):
+            pass
+
+        self.assertEqual(self.client._send.call_count, 3)
+        values = self.metrics.read()
+        self.assertEqual(values[('counter', 'redis_cache_miss', '')], 1)
+        self.assertEqual(
+            values[('summary', 'request_fetch_job_create', 'sum')], 5)
+        self.assertEqual(
+            values[('histogram', 'embedly_request_timer', 'count')], 1)
+
+    def test_recording_failure_is_ignored(self):
+        self.metrics.directory = os.path.join(self.directory, 'missing')
+
+        self.client.incr('redis_cache_miss')
+
+        self.assertEqual(self.client._send.call_count, 1)
+
+    def test_metrics_are_off_by_default(self):
+        client = StatsClient()
+        client._send = mock.Mock()
+
+        client.incr('redis_cache_miss')
+
+        self.assertEqual(client.metrics, None)
+
+    def test_metrics_dir(self):
+        with mock.patch.dict(os.environ, {'METRICS_DIR': self.directory}):
+            self.assertEqual(get_metrics().directory, self.directory)
+
+        with mock.patch.dict(os.environ, {'METRICS_DIR': ''}):
+            self.assertEqual(get_metrics(), None)
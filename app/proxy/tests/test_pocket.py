@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import json
 import time
 
+import mock
 import redis
 import requests
 
 from proxy.pocket import PocketClient
+from proxy.tasks import fetch_recommended_urls
 from proxy.tests.base import AppTest
 
 
@@ -72,7 +75,18 @@ class TestPocketClientFetchRecommendedUrls(PocketClientTest):
         recommended_urls = self.pocket_client.fetch_recommended_urls()
 
         self.assertEqual(recommended_urls, self.sample_recommended_urls)
-        self.assertEqual(self.mock_redis.setex.call_count, 1)
+
+        recommended_urls_json = json.dumps(self.sample_recommended_urls)
+        mock_pipeline = self.mock_redis.pipeline.return_value
+        mock_pipeline.setex.assert_called_once_with(
+            self.pocket_client.redis_key, 10, recommended_urls_json)
+        mock_pipeline.set.assert_any_call(
+            self.pocket_client.redis_last_good_key, recommended_urls_json)
+        mock_pipeline.set.assert_any_call(
+            self.pocket_client.redis_version_key,
+            hashlib.sha1(recommended_urls_json).hexdigest(),
+        )
+        self.assertEqual(mock_pipeline.execute.call_count, 1)
 
     def test_pocket_client_raises_exception_if_request_fails(self):
         self.mock_requests_get.side_effect = requests.RequestException
@@ -104,53 +118,221 @@ class TestPocketClientFetchRecommendedUrls(PocketClientTest):
         self.mock_requests_get.return_value = self.get_mock_response(
             content=json.dumps(self.sample_pocket_data))
 
-        self.mock_redis.setex.side_effect = redis.RedisError
+        self.mock_redis.pipeline.return_value.execute.side_effect = (
+            redis.RedisError)
 
         with self.assertRaises(self.pocket_client.PocketException):
             self.pocket_client.fetch_recommended_urls()
 
 
+class TestPocketClientNeedsRefresh(PocketClientTest):
+
+    def test_needs_refresh_when_ttl_below_margin(self):
+        self.mock_redis.ttl.return_value = 60
+
+        self.assertTrue(self.pocket_client.needs_refresh(120))
+        self.assertFalse(self.pocket_client.needs_refresh(30))
+
+    def test_needs_refresh_when_missing(self):
+        self.mock_redis.ttl.return_value = -2
+
+        self.assertTrue(self.pocket_client.needs_refresh(120))
+
+    def test_needs_refresh_raises_exception_if_redis_fails(self):
+        self.mock_redis.ttl.side_effect = redis.RedisError
+
+        with self.assertRaises(PocketClient.PocketException):
+            self.pocket_client.needs_refresh(120)
+
+
 class TestPocketClientGetRecommendedUrls(PocketClientTest):
 
-    def test_pocket_client_returns_cached_url_data(self):
-        self.mock_redis.get.return_value = json.dumps(
-            self.sample_recommended_urls)
+    def setUp(self):
+        super(TestPocketClientGetRecommendedUrls, self).setUp()
 
-        recommended_urls = self.pocket_client.get_recommended_urls()
+        self.recommended_urls_json = json.dumps(self.sample_recommended_urls)
+        self.version = hashlib.sha1(self.recommended_urls_json).hexdigest()
+        self.mock_redis.get.return_value = self.recommended_urls_json
+        self.mock_pipeline = self.mock_redis.pipeline.return_value
 
-        self.assertEqual(recommended_urls, self.sample_recommended_urls)
-        self.assertEqual(self.mock_redis.get.call_count, 1)
+    def test_pocket_client_returns_cached_snapshot(self):
+        self.mock_pipeline.execute.return_value = [self.version, True]
+
+        snapshot = self.pocket_client.get_recommended_urls()
+
+        self.assertEqual(snapshot, (self.version, self.recommended_urls_json))
+        self.mock_redis.get.assert_called_once_with(
+            self.pocket_client.redis_last_good_key)
         self.assertEqual(self.mock_job_queue.enqueue.call_count, 0)
 
-    def test_pocket_client_queues_task_if_no_cached_data_found(self):
-        self.mock_redis.get.return_value = None
+    def test_pocket_client_reuses_snapshot_until_version_changes(self):
+        self.mock_pipeline.execute.return_value = [self.version, True]
+
+        self.pocket_client.get_recommended_urls()
+        snapshot = self.pocket_client.get_recommended_urls()
+
+        self.assertEqual(snapshot, (self.version, self.recommended_urls_json))
+        self.assertEqual(self.mock_redis.get.call_count, 1)
 
-        recommended_urls = self.pocket_client.get_recommended_urls()
+        self.mock_pipeline.execute.return_value = [
+            hashlib.sha1('[]').hexdigest(), True]
+        self.mock_redis.get.return_value = '[]'
 
-        self.assertEqual(recommended_urls, [])
+        snapshot = self.pocket_client.get_recommended_urls()
+
+        self.assertEqual(snapshot, (hashlib.sha1('[]').hexdigest(), '[]'))
+        self.assertEqual(self.mock_redis.get.call_count, 2)
+
+    def test_snapshot_version_matches_the_list_read(self):
+        # The list was replaced between reading the version and the list.
+        self.mock_pipeline.execute.return_value = ['stale version', True]
+
+        snapshot = self.pocket_client.get_recommended_urls()
+
+        self.assertEqual(snapshot, (self.version, self.recommended_urls_json))
+
+    def test_pocket_client_drops_snapshot_if_version_removed(self):
+        self.mock_pipeline.execute.return_value = [self.version, True]
+        self.pocket_client.get_recommended_urls()
+
+        self.mock_pipeline.execute.return_value = [None, True]
+        snapshot = self.pocket_client.get_recommended_urls()
+
+        self.assertEqual(snapshot, (None, '[]'))
         self.assertEqual(self.mock_redis.get.call_count, 1)
+
+    def test_pocket_client_queues_task_if_no_cached_data_found(self):
+        self.mock_pipeline.execute.return_value = [None, False]
+
+        snapshot = self.pocket_client.get_recommended_urls()
+
+        self.assertEqual(snapshot, (None, '[]'))
+        self.assertEqual(self.mock_redis.get.call_count, 0)
+        self.mock_redis.set.assert_called_once_with(
+            self.pocket_client.redis_refresh_lock_key, mock.ANY,
+            px=10000, nx=True)
+        lock_token = self.mock_redis.set.call_args[0][1]
+        self.mock_job_queue.enqueue.assert_called_once_with(
+            fetch_recommended_urls, mock.ANY, lock_token,
+            ttl=10, at_front=True)
+
+    def test_pocket_client_does_not_queue_task_if_refresh_in_flight(self):
+        self.mock_pipeline.execute.return_value = [self.version, False]
+        self.mock_redis.set.return_value = None
+
+        snapshot = self.pocket_client.get_recommended_urls()
+
+        self.assertEqual(snapshot, (self.version, self.recommended_urls_json))
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 0)
+        self.assertEqual(self.mock_redis.setex.call_count, 0)
+
+    def test_pocket_client_serves_last_good_urls_if_expired(self):
+        self.mock_pipeline.execute.return_value = [self.version, False]
+
+        snapshot = self.pocket_client.get_recommended_urls()
+
+        self.assertEqual(snapshot, (self.version, self.recommended_urls_json))
         self.assertEqual(self.mock_job_queue.enqueue.call_count, 1)
 
-    def test_pocket_client_raises_exception_if_redis_fails(self):
-        self.mock_redis.get.side_effect = redis.RedisError
+    def test_pocket_client_returns_empty_if_last_good_missing(self):
+        self.mock_pipeline.execute.return_value = [self.version, True]
+        self.mock_redis.get.return_value = None
+
+        snapshot = self.pocket_client.get_recommended_urls()
+
+        self.assertEqual(snapshot, (None, '[]'))
+
+    def test_pocket_client_raises_exception_if_last_good_json_invalid(self):
+        self.mock_pipeline.execute.return_value = [self.version, True]
+        self.mock_redis.get.return_value = ';invalid json'
 
         with self.assertRaises(PocketClient.PocketException):
             self.pocket_client.get_recommended_urls()
 
-    def test_pocket_client_raises_exception_if_job_queue_fails(self):
-        self.mock_job_queue.enqueue.side_effect = Exception
+    def test_pocket_client_raises_exception_if_last_good_read_fails(self):
+        self.mock_pipeline.execute.return_value = [self.version, True]
+        self.mock_redis.get.side_effect = redis.RedisError
 
         with self.assertRaises(PocketClient.PocketException):
             self.pocket_client.get_recommended_urls()
 
-    def test_pocket_client_raises_exception_if_cached_json_invalid(self):
-        self.mock_redis.get.return_value = ';invalid json'
+    def test_pocket_client_raises_exception_if_redis_fails(self):
+        self.mock_pipeline.execute.side_effect = redis.RedisError
 
         with self.assertRaises(PocketClient.PocketException):
             self.pocket_client.get_recommended_urls()
 
-    def test_pocket_client_raises_exception_if_unable_to_write_to_redis(self):
-        self.mock_redis.setex.side_effect = redis.RedisError
+    def test_pocket_client_releases_lock_if_job_queue_fails(self):
+        self.mock_pipeline.execute.return_value = [self.version, False]
+        self.mock_job_queue.enqueue.side_effect = Exception
+
+        snapshot = self.pocket_client.get_recommended_urls()
+
+        self.assertEqual(snapshot, (self.version, self.recommended_urls_json))
+
+        lock_token = self.mock_redis.set.call_args[0][1]
+        self.mock_redis.register_script.return_value.assert_called_with(
+            keys=[self.pocket_client.redis_refresh_lock_key],
+            args=[lock_token],
+        )
+
+    @mock.patch('proxy.pocket.statsd_client')
+    def test_pocket_client_serves_last_good_urls_if_unable_to_lock(
+            self, mock_statsd):
+        self.mock_pipeline.execute.return_value = [self.version, False]
+        self.mock_redis.set.side_effect = redis.RedisError
+
+        snapshot = self.pocket_client.get_recommended_urls()
+
+        self.assertEqual(snapshot, (self.version, self.recommended_urls_json))
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 0)
+        mock_statsd.incr.assert_any_call('request_recommended_queue_fail')
+
+
+class TestPocketClientRefreshRecommendedUrls(PocketClientTest):
+
+    def setUp(self):
+        super(TestPocketClientRefreshRecommendedUrls, self).setUp()
+
+        self.mock_requests_get.return_value = self.get_mock_response(
+            content=json.dumps(self.sample_pocket_data))
+        self.mock_release = self.mock_redis.register_script.return_value
+
+    def test_refresh_fetches_and_releases_lock(self):
+        self.assertTrue(self.pocket_client.refresh_recommended_urls())
+
+        self.assertEqual(self.mock_requests_get.call_count, 1)
+        lock_token = self.mock_redis.set.call_args[0][1]
+        self.mock_release.assert_called_once_with(
+            keys=[self.pocket_client.redis_refresh_lock_key],
+            args=[lock_token],
+        )
+
+    def test_refresh_skipped_if_already_in_flight(self):
+        self.mock_redis.set.return_value = None
+
+        self.assertFalse(self.pocket_client.refresh_recommended_urls())
+
+        self.assertEqual(self.mock_requests_get.call_count, 0)
+
+    def test_refresh_releases_lock_if_fetch_fails(self):
+        self.mock_requests_get.side_effect = requests.RequestException
 
         with self.assertRaises(PocketClient.PocketException):
-            self.pocket_client.get_recommended_urls()
+            self.pocket_client.refresh_recommended_urls()
+
+        self.assertEqual(self.mock_release.call_count, 1)
+
+    def test_refresh_raises_exception_if_unable_to_lock(self):
+        self.mock_redis.set.side_effect = redis.RedisError
+
+        with self.assertRaises(PocketClient.PocketException):
+            self.pocket_client.refresh_recommended_urls()
+
+        self.assertEqual(self.mock_requests_get.call_count, 0)
+
+    def test_refresh_raises_exception_if_unable_to_release(self):
+        self.mock_release.side_effect = redis.RedisError
+
+        with self.assertRaises(PocketClient.PocketException):
+            self.pocket_client.refresh_recommended_urls()
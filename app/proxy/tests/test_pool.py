@@ -0,0 +1,150 @@
+import threading
+import time
+
+import mock
+import redis
+
+from proxy.app import get_redis_connection_pool
+from proxy.pool import MonitoredConnectionPool
+from proxy.tests.base import AppTest
+
+
+class MonitoredConnectionPoolTest(AppTest):
+
+    def setUp(self):
+        super(MonitoredConnectionPoolTest, self).setUp()
+
+        mock_statsd_patcher = mock.patch('proxy.pool.statsd_client')
+        self.mock_statsd = mock_statsd_patcher.start()
+        self.addCleanup(mock_statsd_patcher.stop)
+
+        self.mock_connection_class = mock.Mock()
+        self.mock_connection_class.side_effect = self.make_mock_connection
+
+        self.pool = MonitoredConnectionPool(
+            name='test',
+            health_check_interval=30,
+            max_connections=2,
+            timeout=0.01,
+            connection_class=self.mock_connection_class,
+        )
+
+    def make_mock_connection(self, **kwargs):
+        connection = mock.Mock(spec=redis.Connection)
+        connection.pid = self.pool.pid
+        connection.read_response.return_value = 'PONG'
+        return connection
+
+    def idle_connection(self, connection, seconds):
+        connection.released_at = time.time() - seconds
+
+
+class TestMonitoredConnectionPool(MonitoredConnectionPoolTest):
+
+    def test_connections_are_reused(self):
+        connection = self.pool.get_connection('GET')
+        self.pool.release(connection)
+
+        self.assertEqual(self.pool.get_connection('GET'), connection)
+        self.assertEqual(self.mock_connection_class.call_count, 1)
+        self.mock_statsd.gauge.assert_called_once_with(
+            'test_redis_pool_size', 1)
+
+    @mock.patch('proxy.pool.time')
+    def test_free_checkouts_are_not_timed(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        self.pool.wait_threshold = 1
+
+        self.pool.release(self.pool.get_connection('GET'))
+        self.pool.get_connection('GET')
+
+        self.assertEqual(self.mock_statsd.timing.call_count, 0)
+
+    def test_waits_over_the_threshold_are_timed(self):
+        self.pool.wait_threshold = 1
+        connection = self.pool.get_connection('GET')
+        self.pool.get_connection('GET')
+        released = threading.Timer(0.005, self.pool.release, [connection])
+        released.start()
+        self.addCleanup(released.cancel)
+
+        self.assertEqual(self.pool.get_connection('GET'), connection)
+
+        self.mock_statsd.timing.assert_called_once_with(
+            'test_redis_checkout_wait', mock.ANY)
+        self.assertGreater(self.mock_statsd.timing.call_args[0][1], 1)
+
+    def test_saturation(self):
+        self.assertEqual(self.pool.get_saturation(), 0)
+
+        connection = self.pool.get_connection('GET')
+        self.pool.get_connection('GET')
+        self.assertEqual(self.pool.get_saturation(), 1)
+
+        self.pool.release(connection)
+        self.assertEqual(self.pool.get_saturation(), 0.5)
+
+    def test_checkout_times_out_when_pool_is_exhausted(self):
+        self.pool.get_connection('GET')
+        self.pool.get_connection('GET')
+
+        with self.assertRaises(redis.ConnectionError):
+            self.pool.get_connection('GET')
+
+        self.assertEqual(self.mock_connection_class.call_count, 2)
+        self.mock_statsd.incr.assert_called_once_with(
+            'test_redis_checkout_timeout')
+
+    def test_recently_used_connection_is_not_checked(self):
+        connection = self.pool.get_connection('GET')
+        self.pool.release(connection)
+
+        self.pool.get_connection('GET')
+
+        self.assertEqual(connection.send_command.call_count, 0)
+
+    def test_idle_connection_is_checked(self):
+        connection = self.pool.get_connection('GET')
+        self.pool.release(connection)
+        self.idle_connection(connection, 60)
+
+        self.pool.get_connection('GET')
+
+        connection.send_command.assert_called_once_with('PING')
+        self.assertEqual(connection.disconnect.call_count, 0)
+
+    def test_dead_idle_connection_is_disconnected(self):
+        connection = self.pool.get_connection('GET')
+        self.pool.release(connection)
+        self.idle_connection(connection, 60)
+        connection.read_response.side_effect = redis.ConnectionError
+
+        self.assertEqual(self.pool.get_connection('GET'), connection)
+
+        self.assertEqual(connection.disconnect.call_count, 1)
+        self.mock_statsd.incr.assert_called_once_with(
+            'test_redis_health_check_fail')
+
+    def test_unexpected_ping_response_disconnects(self):
+        connection = self.pool.get_connection('GET')
+        self.pool.release(connection)
+        self.idle_connection(connection, 60)
+        connection.read_response.return_value = 'LOADING'
+
+        self.pool.get_connection('GET')
+
+        self.assertEqual(connection.disconnect.call_count, 1)
+
+
+class TestGetRedisConnectionPool(AppTest):
+
+    def test_pool_is_bounded_with_timeouts(self):
+        pool = get_redis_connection_pool('primary', 'redis', 6380)
+
+        self.assertEqual(pool.max_connections, 50)
+        self.assertEqual(pool.timeout, 1)
+        self.assertEqual(pool.wait_threshold, 1)
+        self.assertEqual(pool.connection_kwargs['host'], 'redis')
+        self.assertEqual(pool.connection_kwargs['port'], 6380)
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 2)
+        self.assertEqual(pool.connection_kwargs['socket_connect_timeout'], 1)
@@ -0,0 +1,191 @@
+import os
+from unittest import TestCase
+
+import mock
+import redis
+
+from proxy.app import get_popularity_policy
+from proxy.popularity import (
+    CountMinSketch, PopularityPolicy, get_sketch_width)
+from proxy.tests.base import AppTest
+
+
+class FakeRedis(object):
+    # Just enough hash commands to hold a sketch.
+
+    def __init__(self):
+        self.hashes = {}
+        self.expires = {}
+
+    def hmget(self, key, fields):
+        values = self.hashes.get(key, {})
+        return [values.get(field) for field in fields]
+
+    def pipeline(self, transaction):
+        pipeline = mock.Mock()
+        pipeline.hincrby.side_effect = self.hincrby
+        pipeline.expire.side_effect = self.expires.__setitem__
+        return pipeline
+
+    def hincrby(self, key, field, count):
+        values = self.hashes.setdefault(key, {})
+        values[field] = str(int(values.get(field, 0)) + count)
+
+
+class CountMinSketchTest(TestCase):
+
+    def setUp(self):
+        mock_time_patcher = mock.patch('proxy.popularity.time.time')
+        self.mock_time = mock_time_patcher.start()
+        self.mock_time.return_value = 1000.0
+        self.addCleanup(mock_time_patcher.stop)
+
+        self.redis = FakeRedis()
+        self.sketch = CountMinSketch(
+            self.redis, 'POPULARITY', width=64, depth=4, window=100,
+            flush_size=1000, flush_interval=60)
+
+        mock_statsd_patcher = mock.patch('proxy.popularity.statsd_client')
+        self.mock_statsd = mock_statsd_patcher.start()
+        self.addCleanup(mock_statsd_patcher.stop)
+
+
+class TestCountMinSketch(CountMinSketchTest):
+
+    def test_counts_are_buffered_until_flushed(self):
+        self.sketch.add(['a', 'a', 'b'])
+
+        self.assertEqual(self.redis.hashes, {})
+        self.assertEqual(self.sketch.get_counts(['a']), {'a': 2})
+
+        self.sketch.flush()
+
+        self.assertEqual(self.sketch.get_counts(['a', 'b', 'c']), {
+            'a': 2, 'b': 1, 'c': 0})
+        self.assertEqual(self.redis.expires, {'POPULARITY:10': 200})
+
+    def test_flush_after_interval(self):
+        self.sketch.add(['a'])
+        self.mock_time.return_value += 60
+        self.sketch.add(['a'])
+
+        self.assertEqual(self.sketch.get_counts(['a']), {'a': 2})
+
+    def test_flush_when_buffer_is_full(self):
+        self.sketch.flush_size = 4
+        self.sketch.add(['a'])
+
+        self.assertEqual(self.sketch.get_counts(['a']), {'a': 1})
+
+    def test_empty_flush_writes_nothing(self):
+        self.redis.pipeline = mock.Mock()
+
+        self.sketch.flush()
+
+        self.assertEqual(self.redis.pipeline.call_count, 0)
+
+    def test_previous_window_decays(self):
+        self.sketch.add(['a'] * 10)
+        self.sketch.flush()
+
+        self.mock_time.return_value = 1125.0
+
+        self.assertEqual(self.sketch.get_counts(['a']), {'a': 7})
+
+        self.mock_time.return_value = 1200.0
+
+        self.assertEqual(self.sketch.get_counts(['a']), {'a': 0})
+
+    def test_no_keys(self):
+        self.assertEqual(self.sketch.get_counts([]), {})
+
+    def test_read_failure_counts_zero(self):
+        self.redis.hmget = mock.Mock(side_effect=redis.RedisError)
+
+        self.assertEqual(self.sketch.get_counts(['a']), {'a': 0})
+        self.mock_statsd.incr.assert_called_once_with('popularity_read_fail')
+
+    def test_write_failure_drops_counts(self):
+        self.redis.pipeline = mock.Mock(side_effect=redis.RedisError)
+        self.sketch.add(['a'])
+
+        self.sketch.flush()
+
+        self.assertEqual(self.sketch.pending, {})
+        self.mock_statsd.incr.assert_called_once_with('popularity_write_fail')
+
+
+class TestPopularityPolicy(CountMinSketchTest):
+
+    def setUp(self):
+        super(TestPopularityPolicy, self).setUp()
+
+        self.policy = PopularityPolicy(
+            self.sketch, hot_count=10, min_timeout=100, max_timeout=1000)
+
+    def test_timeouts_grow_with_popularity(self):
+        self.policy.record(['hot'] * 10 + ['warm'] * 3 + ['once'])
+
+        counts = self.policy.get_counts(['hot', 'warm', 'once', 'new'])
+
+        self.assertEqual(self.policy.get_timeout(counts['hot']), 1000)
+        self.assertTrue(100 < self.policy.get_timeout(counts['warm']) < 1000)
+        self.assertEqual(self.policy.get_timeout(counts['once']), 100)
+        self.assertEqual(self.policy.get_timeout(counts['new']), 100)
+
+    def test_hot_keys(self):
+        self.assertTrue(self.policy.is_hot(10))
+        self.assertFalse(self.policy.is_hot(9))
+
+    def test_unseen_keys_stay_cold_under_load(self):
+        # 20000 requests a window over 4000 URLs, each cache hit counted.
+        self.sketch.width = get_sketch_width(20000, self.policy.hot_count)
+        self.sketch.flush_size = float('inf')
+        for index in range(4000):
+            self.sketch.add(['http://example.com/{}'.format(index)] * 5)
+        self.sketch.flush()
+
+        counts = self.policy.get_counts(
+            ['http://example.org/{}'.format(index) for index in range(1000)])
+
+        self.assertFalse(any(self.policy.is_hot(count)
+                             for count in counts.values()))
+        self.assertLess(max(counts.values()), self.policy.hot_count / 2)
+
+
+class TestGetPopularityPolicy(AppTest):
+
+    def test_policy_spans_the_data_timeouts(self):
+        policy = get_popularity_policy(self.mock_redis)
+
+        self.assertEqual(policy.min_timeout, 60 * 60)
+        self.assertEqual(policy.max_timeout, 24 * 60 * 60)
+        self.assertEqual(policy.sketch.redis_client, self.mock_redis)
+
+    def test_sketch_is_sized_for_the_hot_count(self):
+        self.assertEqual(get_sketch_width(200000, 20), 114454)
+        self.assertEqual(get_sketch_width(1000, 2), 10874)
+
+        with mock.patch.dict(os.environ, {'POPULARITY_REQUESTS': '1000'}):
+            policy = get_popularity_policy(self.mock_redis)
+
+        self.assertEqual(policy.sketch.width, get_sketch_width(1000, 20))
+
+    def test_one_off_urls_stay_unadmitted_under_load(self):
+        with mock.patch.dict(os.environ, {
+                'MOZILLA_ADMISSION_MIN_REQUESTS': '2',
+                'POPULARITY_REQUESTS': '20000'}):
+            policy = get_popularity_policy(FakeRedis())
+
+        self.assertEqual(policy.sketch.width, get_sketch_width(20000, 2))
+
+        policy.sketch.flush_size = float('inf')
+        for index in range(4000):
+            policy.record(['http://example.com/{}'.format(index)] * 5)
+        one_off_urls = [
+            'http://example.org/{}'.format(index) for index in range(1000)]
+        policy.record(one_off_urls)
+        policy.sketch.flush()
+
+        self.assertEqual(
+            set(policy.get_counts(one_off_urls).values()), set([1]))
@@ -0,0 +1,85 @@
+from unittest import TestCase
+
+import mock
+
+from proxy.preprocess import URLPreprocessor
+
+
+class TestURLPreprocessor(TestCase):
+
+    def setUp(self):
+        mock_statsd_patcher = mock.patch('proxy.preprocess.statsd_client')
+        self.mock_statsd = mock_statsd_patcher.start()
+        self.addCleanup(mock_statsd_patcher.stop)
+
+        self.preprocessor = URLPreprocessor(['Embedly.com'])
+
+    def test_urls_are_kept_in_order_with_their_netlocs(self):
+        netlocs = self.preprocessor.preprocess([
+            'https://www.example.com/b',
+            'http://Example.com:8080/a?q=1',
+            u'http://\u4f8b\u5b50.\u6d4b\u8bd5/',
+            'http://127.0.0.1/',
+            'http://[::1]:8000/',
+            'http://example.com./',
+            'http://foo_bar.tumblr.com/post/1',
+        ])
+
+        self.assertEqual(netlocs.items(), [
+            ('https://www.example.com/b', 'www.example.com'),
+            ('http://Example.com:8080/a?q=1', 'Example.com:8080'),
+            (u'http://\u4f8b\u5b50.\u6d4b\u8bd5/',
+             u'\u4f8b\u5b50.\u6d4b\u8bd5'),
+            ('http://127.0.0.1/', '127.0.0.1'),
+            ('http://[::1]:8000/', '[::1]:8000'),
+            ('http://example.com./', 'example.com.'),
+            ('http://foo_bar.tumblr.com/post/1', 'foo_bar.tumblr.com'),
+        ])
+        self.assertEqual(self.mock_statsd.incr.call_count, 0)
+
+    def test_duplicates_are_dropped(self):
+        netlocs = self.preprocessor.preprocess([
+            'http://example.com/a',
+            'http://example.com/b',
+            'http://example.com/a',
+            'http://example.com/a',
+        ])
+
+        self.assertEqual(
+            netlocs.keys(), ['http://example.com/a', 'http://example.com/b'])
+        self.mock_statsd.incr.assert_called_once_with(
+            'request_url_duplicate', 2)
+
+    def test_invalid_urls_are_dropped(self):
+        netlocs = self.preprocessor.preprocess([
+            'example.com/no-scheme',
+            'ftp://example.com/',
+            'javascript:alert(1)',
+            'http:///path',
+            'http://localhost/',
+            'http://exa mple.com/',
+            'http://-example.com/',
+            'http://example.com:port/',
+            'http://[::1/',
+            'http://[::g]/',
+            'http://{}.com/'.format('a' * 64),
+            u'http://{}.com/'.format(u'\u4e2d' * 64),
+            ['http://example.com/'],
+            {'url': 'http://example.com/'},
+            1,
+        ])
+
+        self.assertEqual(netlocs.items(), [])
+        self.mock_statsd.incr.assert_called_once_with(
+            'request_url_invalid', 15)
+
+    def test_blocked_domains_and_subdomains_are_dropped(self):
+        netlocs = self.preprocessor.preprocess([
+            'http://embedly.com/',
+            'https://i.EMBEDLY.com./image.jpg',
+            'http://notembedly.com/',
+        ])
+
+        self.assertEqual(netlocs.keys(), ['http://notembedly.com/'])
+        self.mock_statsd.incr.assert_called_once_with(
+            'request_url_blocked', 2)
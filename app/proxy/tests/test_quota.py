@@ -0,0 +1,264 @@
+import importlib
+import json
+import os
+import sys
+from unittest import TestCase
+
+import mock
+import redis
+from werkzeug.exceptions import HTTPException
+
+from proxy.api.views import STREAM_MIMETYPE, get_metadata, get_single_metadata
+from proxy.app import get_embedly_client
+from proxy.quota import ConsumerQuota
+from proxy.tests.test_metadata import MetadataClientTest
+
+
+LIMITS = {
+    'requests': {'rate': 5, 'burst': 50},
+    'urls': {'rate': 10, 'burst': 200},
+}
+
+
+def get_mock_request(headers=None, remote_addr='10.0.0.1', urls=None,
+                     args=None):
+    mock_request = mock.Mock()
+    mock_request.content_type = 'application/json'
+    mock_request.json = {'urls': urls or []}
+    mock_request.headers = headers or {}
+    mock_request.remote_addr = remote_addr
+    mock_request.args = args or {}
+
+    return mock_request
+
+
+class TestConsumerQuota(TestCase):
+
+    def setUp(self):
+        mock_statsd_patcher = mock.patch('proxy.quota.statsd_client')
+        self.mock_statsd = mock_statsd_patcher.start()
+        self.addCleanup(mock_statsd_patcher.stop)
+
+        mock_time_patcher = mock.patch(
+            'proxy.quota.time.time', return_value=1000.0)
+        mock_time_patcher.start()
+        self.addCleanup(mock_time_patcher.stop)
+
+        self.mock_redis = mock.Mock()
+        self.mock_take = self.mock_redis.register_script.return_value
+        self.mock_take.return_value = 0
+
+        self.quota = ConsumerQuota(self.mock_redis, LIMITS, {'abc': 'firefox'})
+
+    def test_consumer_by_api_key(self):
+        self.assertEqual(self.quota.get_consumer(get_mock_request(
+            headers={'X-Api-Key': 'abc', 'X-Forwarded-For': '10.0.0.2'})),
+            'key:firefox')
+
+    def test_consumer_by_address_nginx_forwarded(self):
+        self.assertEqual(self.quota.get_consumer(get_mock_request(
+            headers={'X-Api-Key': 'made-up',
+                     'X-Forwarded-For': '1.2.3.4, 10.0.0.2'})),
+            'addr:10.0.0.2')
+        self.assertEqual(
+            self.quota.get_consumer(get_mock_request()), 'addr:10.0.0.1')
+
+    def test_consumer_behind_a_load_balancer(self):
+        self.quota.proxy_hops = 2
+
+        self.assertEqual(self.quota.get_consumer(get_mock_request(
+            headers={'X-Forwarded-For': '1.2.3.4, 10.0.0.2, 10.0.0.3'})),
+            'addr:10.0.0.2')
+        self.assertEqual(self.quota.get_consumer(get_mock_request(
+            headers={'X-Forwarded-For': '10.0.0.3'})), 'addr:10.0.0.3')
+
+    def test_tokens_are_taken_in_one_call(self):
+        self.quota.take('key:firefox', 'urls', 3)
+
+        self.mock_take.assert_called_once_with(
+            keys=['QUOTA:key:firefox:urls'], args=[10, 200, 3, 1000.0])
+        self.mock_statsd.incr.assert_called_once_with(
+            'firefox_quota_urls', 3)
+
+    def test_exceeded_quota_says_when_to_retry(self):
+        self.mock_take.return_value = 1200
+
+        with self.assertRaises(ConsumerQuota.QuotaException) as cm:
+            self.quota.take('addr:10.0.0.1', 'requests', 1)
+
+        self.assertEqual(cm.exception.retry_after, 2)
+        self.assertEqual(
+            cm.exception.message, 'Quota exceeded, retry after 2 seconds.')
+        self.mock_statsd.incr.assert_called_once_with(
+            'anonymous_quota_requests_exceeded')
+
+    def test_quota_is_not_enforced_without_redis(self):
+        self.mock_take.side_effect = redis.RedisError
+
+        self.quota.take('key:firefox', 'requests', 1)
+
+        self.mock_statsd.incr.assert_called_once_with('quota_check_fail')
+
+
+class TestQuotaEndpoints(MetadataClientTest):
+
+    def setUp(self):
+        super(TestQuotaEndpoints, self).setUp()
+
+        self.mock_take = mock.Mock(return_value=0)
+        self.mock_redis.register_script.return_value = self.mock_take
+        self.metadata_client.quota = ConsumerQuota(
+            self.mock_redis, LIMITS, {'abc': 'firefox'})
+
+        self.config = {
+            'MAXIMUM_POST_URLS': 10,
+            'MAXIMUM_STREAM_URLS': 100,
+            'MAXIMUM_STREAM_WAIT': 0,
+            'STREAM_POLL_INTERVAL': 0,
+        }
+
+    def test_requests_and_uncached_urls_are_taken(self):
+        get_metadata(self.metadata_client, self.config, get_mock_request(
+            headers={'X-Api-Key': 'abc'}, urls=self.sample_urls))
+
+        self.assertEqual(self.mock_take.call_args_list, [
+            mock.call(keys=['QUOTA:key:firefox:requests'], args=mock.ANY),
+            mock.call(keys=['QUOTA:key:firefox:urls'], args=mock.ANY),
+        ])
+        self.assertEqual(self.mock_take.call_args[1]['args'][2], 2)
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 1)
+
+    def test_only_urls_left_to_queue_are_taken(self):
+        counts = dict(zip(self.sample_urls, [1, 5]))
+        self.metadata_client.popularity = mock.Mock()
+        self.metadata_client.popularity.get_counts.side_effect = (
+            lambda keys: {key: counts[key.partition(':')[2]] for key in keys})
+        self.metadata_client.popularity.is_hot.return_value = False
+        self.metadata_client.admission_policies = {
+            'test-service': {'min_requests': 2, 'reject': 'skip'}}
+
+        get_metadata(self.metadata_client, self.config, get_mock_request(
+            headers={'X-Api-Key': 'abc'}, urls=self.sample_urls))
+
+        self.assertEqual(self.mock_take.call_args[1]['args'][2], 1)
+
+    def test_urls_over_quota_do_not_use_domain_slots(self):
+        self.mock_take.side_effect = [0, 3000]
+
+        get_metadata(self.metadata_client, self.config, get_mock_request(
+            urls=self.sample_urls))
+
+        self.assertEqual(self.mock_domain_limiter.checked_insert.call_count, 0)
+
+    def test_request_over_quota_returns_429(self):
+        self.mock_take.return_value = 200
+
+        with self.assertRaises(HTTPException) as cm:
+            get_metadata(self.metadata_client, self.config, get_mock_request(
+                urls=self.sample_urls))
+
+        response = cm.exception.response
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(self.mock_redis.get.call_count, 0)
+
+    def cache_url(self, url):
+        cached_key = self.metadata_client._get_cache_key(url)
+        self.mock_redis.get.side_effect = (
+            lambda key: '{}' if key == cached_key else None)
+
+    def test_urls_over_quota_are_not_queued(self):
+        self.cache_url(self.sample_urls[0])
+        self.mock_take.side_effect = [0, 3000]
+
+        response = get_metadata(
+            self.metadata_client, self.config, get_mock_request(
+                urls=self.sample_urls))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Retry-After'], '3')
+        self.assertEqual(json.loads(response.data), {
+            'urls': {self.sample_urls[0]: {}},
+            'error': 'Quota exceeded, retry after 3 seconds.',
+        })
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 0)
+
+    def test_stream_over_quota_still_sends_cached_urls(self):
+        self.cache_url(self.sample_urls[1])
+        self.mock_take.side_effect = [0, 3000]
+        self.config['MAXIMUM_POST_URLS'] = 1
+
+        response = get_metadata(
+            self.metadata_client, self.config, get_mock_request(
+                headers={'Accept': STREAM_MIMETYPE}, urls=self.sample_urls))
+
+        self.assertEqual(
+            [json.loads(line) for line in response.response], [
+                {'url': self.sample_urls[1], 'data': {}},
+                {'error': 'Quota exceeded, retry after 3 seconds.'},
+            ])
+        self.assertEqual(self.mock_take.call_count, 2)
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 0)
+
+    def test_single_url_over_quota_returns_429(self):
+        self.mock_take.side_effect = [0, 3000]
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            None, -2]
+
+        with self.assertRaises(HTTPException) as cm:
+            get_single_metadata(
+                self.metadata_client, {},
+                get_mock_request(args={'url': self.sample_urls[0]}))
+
+        self.assertEqual(cm.exception.response.status_code, 429)
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 0)
+
+    def test_quota_is_off_by_default(self):
+        self.assertEqual(get_embedly_client(
+            self.mock_redis, self.mock_job_queue).quota, None)
+
+        with mock.patch.dict(os.environ, {
+                'CONSUMER_QUOTA': '1',
+                'CONSUMER_API_KEYS': 'firefox:abc,pocket:def'}):
+            quota = get_embedly_client(
+                self.mock_redis, self.mock_job_queue).quota
+
+        self.assertEqual(quota.api_keys, {'abc': 'firefox', 'def': 'pocket'})
+        self.assertEqual(quota.limits, LIMITS)
+        self.assertEqual(quota.proxy_hops, 1)
+
+
+class TestQuotaUnderGunicorn(TestCase):
+    # gunicorn runs wsgi with --pythonpath proxy, so the app and the
+    # modules it imports are loaded outside the proxy package.
+
+    def setUp(self):
+        proxy_path = os.path.dirname(os.path.dirname(__file__))
+        loaded_modules = set(sys.modules)
+        sys.path.insert(0, proxy_path)
+
+        def unload():
+            sys.path.remove(proxy_path)
+            for name in set(sys.modules) - loaded_modules:
+                del sys.modules[name]
+
+        self.addCleanup(unload)
+
+        with mock.patch.dict(os.environ, {'CONSUMER_QUOTA': '1'}):
+            app_module = importlib.import_module('app')
+            self.mock_redis = mock.Mock()
+            self.mock_redis.info.return_value = {'redis_version': '3.2.0'}
+            self.app = app_module.create_app(
+                redis_client=self.mock_redis, job_queue=mock.Mock())
+
+    def test_request_over_quota_returns_429(self):
+        self.mock_redis.register_script.return_value.return_value = 2000
+
+        response = self.app.test_client().post(
+            '/v2/extract',
+            data=json.dumps({'urls': ['http://example.com/']}),
+            content_type='application/json',
+        )
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '2')
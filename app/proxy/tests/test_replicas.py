@@ -0,0 +1,95 @@
+import os
+
+import mock
+import redis
+
+from proxy.app import get_cache_redis_client, get_embedly_client
+from proxy.replicas import ReplicaRedis
+from proxy.sharding import ShardedRedis
+from proxy.tests.base import AppTest
+
+
+class ReplicaRedisTest(AppTest):
+
+    def setUp(self):
+        super(ReplicaRedisTest, self).setUp()
+
+        self.mock_replica = mock.Mock()
+        self.replica_redis = ReplicaRedis(
+            self.mock_redis, [self.mock_replica])
+
+        self.mock_redis.mget.side_effect = None
+        self.mock_redis.mget.return_value = []
+
+
+class TestReplicaRedis(ReplicaRedisTest):
+
+    def test_reads_are_sent_to_a_replica(self):
+        self.mock_replica.mget.return_value = ['a', 'b']
+
+        self.assertEqual(self.replica_redis.mget(['1', '2']), ['a', 'b'])
+        self.assertEqual(self.mock_redis.mget.call_count, 0)
+
+    def test_replica_misses_are_confirmed_on_primary(self):
+        self.mock_replica.mget.return_value = ['a', None, None]
+        self.mock_redis.mget.return_value = ['"in job queue"', None]
+
+        values = self.replica_redis.mget(['1', '2', '3'])
+
+        self.assertEqual(values, ['a', '"in job queue"', None])
+        self.mock_redis.mget.assert_called_once_with(['2', '3'])
+
+    def test_replica_failure_falls_back_to_primary(self):
+        self.mock_replica.mget.side_effect = redis.ConnectionError
+        self.mock_redis.mget.return_value = ['a']
+
+        self.assertEqual(self.replica_redis.mget(['1']), ['a'])
+
+    def test_writes_are_sent_to_primary(self):
+        self.replica_redis.setex('1', 10, 'a')
+        self.replica_redis.delete('1')
+
+        self.mock_redis.setex.assert_called_once_with('1', 10, 'a')
+        self.mock_redis.delete.assert_called_once_with('1')
+        self.assertEqual(self.mock_replica.setex.call_count, 0)
+
+    def test_lagging_replica_does_not_requeue_urls(self):
+        embedly_client = get_embedly_client(
+            self.mock_redis, self.mock_job_queue, self.replica_redis)
+        self.mock_replica.mget.return_value = [None]
+        self.mock_redis.mget.return_value = [embedly_client.IN_JOB_QUEUE_JSON]
+
+        cached_urls = embedly_client.extract_urls_async(
+            ['http://example.com/'])
+
+        self.assertEqual(cached_urls, {})
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 0)
+
+
+class TestGetCacheReplicaClient(AppTest):
+
+    def test_replicas_of_shared_redis(self):
+        with mock.patch.dict(os.environ, {
+                'REDIS_REPLICA_URLS': 'replica1;replica2:6380'}):
+            cache_redis_client = get_cache_redis_client(self.mock_redis)
+
+        self.assertEqual(cache_redis_client.primary, self.mock_redis)
+        self.assertEqual(
+            [replica.connection_pool.connection_kwargs['host']
+             for replica in cache_redis_client.replicas],
+            ['replica1', 'replica2'])
+
+    def test_replicas_of_sharded_cache_use_the_same_ring(self):
+        with mock.patch.dict(os.environ, {
+                'REDIS_CACHE_URLS': 'cache1,cache2',
+                'REDIS_REPLICA_URLS': 'replica1,replica2'}):
+            cache_redis_client = get_cache_redis_client(self.mock_redis)
+
+        self.assertIsInstance(cache_redis_client.primary, ShardedRedis)
+        replica = cache_redis_client.replicas[0]
+        self.assertEqual(
+            replica.nodes['cache2'].connection_pool.connection_kwargs['host'],
+            'replica2')
+        self.assertEqual(
+            replica.ring.get_node('key'),
+            cache_redis_client.primary.ring.get_node('key'))
@@ -0,0 +1,86 @@
+import mock
+
+from proxy.app import get_recommendations_scheduler
+from proxy.lock import RedisLock
+from proxy.pocket import PocketClient
+from proxy.scheduler import RecommendationsScheduler
+from proxy.tests.base import AppTest
+
+
+class RecommendationsSchedulerTest(AppTest):
+
+    def setUp(self):
+        super(RecommendationsSchedulerTest, self).setUp()
+
+        self.mock_pocket_client = mock.Mock()
+        self.mock_pocket_client.PocketException = PocketClient.PocketException
+        self.mock_pocket_client.needs_refresh.return_value = True
+
+        self.mock_lock = mock.Mock()
+        self.mock_lock.LockException = RedisLock.LockException
+        self.mock_lock.acquire_or_renew.return_value = True
+
+        self.scheduler = RecommendationsScheduler(
+            self.mock_pocket_client, self.mock_lock, 180, 30)
+
+
+class TestRecommendationsScheduler(RecommendationsSchedulerTest):
+
+    def test_leader_refreshes_before_expiry(self):
+        self.assertTrue(self.scheduler.tick())
+
+        self.mock_pocket_client.needs_refresh.assert_called_once_with(180)
+        self.assertEqual(
+            self.mock_pocket_client.refresh_recommended_urls.call_count, 1)
+
+    def test_leader_skips_refresh_when_fresh(self):
+        self.mock_pocket_client.needs_refresh.return_value = False
+
+        self.assertTrue(self.scheduler.tick())
+
+        self.assertEqual(
+            self.mock_pocket_client.refresh_recommended_urls.call_count, 0)
+
+    def test_leader_skips_refresh_already_in_flight(self):
+        self.mock_pocket_client.refresh_recommended_urls.return_value = False
+
+        self.assertTrue(self.scheduler.tick())
+
+        self.assertEqual(
+            self.mock_pocket_client.refresh_recommended_urls.call_count, 1)
+
+    def test_follower_does_not_refresh(self):
+        self.mock_lock.acquire_or_renew.return_value = False
+
+        self.assertFalse(self.scheduler.tick())
+
+        self.assertEqual(self.mock_pocket_client.needs_refresh.call_count, 0)
+        self.assertEqual(
+            self.mock_pocket_client.refresh_recommended_urls.call_count, 0)
+
+    def test_lock_failure_does_not_refresh(self):
+        self.mock_lock.acquire_or_renew.side_effect = RedisLock.LockException
+
+        self.assertFalse(self.scheduler.tick())
+
+        self.assertEqual(
+            self.mock_pocket_client.refresh_recommended_urls.call_count, 0)
+
+    def test_pocket_failure_is_retried_next_tick(self):
+        self.mock_pocket_client.refresh_recommended_urls.side_effect = (
+            PocketClient.PocketException)
+
+        self.assertTrue(self.scheduler.tick())
+        self.assertTrue(self.scheduler.tick())
+
+        self.assertEqual(
+            self.mock_pocket_client.refresh_recommended_urls.call_count, 2)
+
+    def test_scheduler_factory_uses_leader_lock(self):
+        scheduler = get_recommendations_scheduler(
+            redis_client=self.mock_redis, job_queue=self.mock_job_queue)
+
+        self.assertEqual(
+            scheduler.leader_lock.key,
+            'POCKET_RECOMMENDED_URLS_SCHEDULER_LEADER')
+        self.assertEqual(scheduler.pocket_client.redis_client, self.mock_redis)
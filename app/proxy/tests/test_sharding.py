@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import os
+from unittest import TestCase
+
+import mock
+import redis
+
+from proxy.app import get_cache_redis_client
+from proxy.sharding import HashRing, ShardedRedis, run_concurrently
+from proxy.tests.base import AppTest
+
+
+class TestRunConcurrently(TestCase):
+
+    def test_results_are_returned_in_order(self):
+        results = run_concurrently([
+            (lambda value: value * 2, (value,)) for value in range(5)])
+
+        self.assertEqual(results, [0, 2, 4, 6, 8])
+
+    def test_single_call_runs_inline(self):
+        self.assertEqual(run_concurrently([(len, ('abc',))]), [3])
+
+    def test_errors_are_raised(self):
+        def fail():
+            raise redis.RedisError()
+
+        with self.assertRaises(redis.RedisError):
+            run_concurrently([(fail, ()), (lambda: 1, ())])
+
+
+class TestHashRing(TestCase):
+
+    def setUp(self):
+        self.keys = [u'mozilla:http://example.com/{}'.format(i)
+                     for i in range(1000)]
+
+    def test_keys_are_spread_across_nodes(self):
+        ring = HashRing(['a', 'b', 'c'])
+
+        counts = {}
+        for key in self.keys:
+            node = ring.get_node(key)
+            counts[node] = counts.get(node, 0) + 1
+
+        self.assertEqual(sorted(counts), ['a', 'b', 'c'])
+        self.assertTrue(all(count > 200 for count in counts.values()))
+
+    def test_adding_a_node_only_moves_its_share_of_keys(self):
+        ring = HashRing(['a', 'b', 'c'])
+        larger_ring = HashRing(['a', 'b', 'c', 'd'])
+
+        moved = [
+            key for key in self.keys
+            if ring.get_node(key) != larger_ring.get_node(key)
+        ]
+
+        self.assertTrue(all(
+            larger_ring.get_node(key) == 'd' for key in moved))
+        self.assertLess(len(moved), len(self.keys) / 2)
+
+    def test_unicode_keys(self):
+        ring = HashRing(['a', 'b'])
+
+        self.assertIn(ring.get_node(u'embedly:http://example.com/中'),
+                      ['a', 'b'])
+
+
+class TestShardedRedis(TestCase):
+
+    def setUp(self):
+        self.stores = {'a': {}, 'b': {}}
+        self.nodes = {
+            name: self.get_mock_node(store)
+            for name, store in self.stores.items()
+        }
+        self.sharded_redis = ShardedRedis(self.nodes)
+        self.keys = ['key{}'.format(i) for i in range(20)]
+
+        for key in self.keys:
+            self.sharded_redis.setex(key, 10, 'value-' + key)
+
+    def get_mock_node(self, store):
+        node = mock.Mock()
+        node.get.side_effect = store.get
+        node.setex.side_effect = (
+            lambda key, timeout, value: store.__setitem__(key, value))
+        node.ttl.return_value = 10
+        node.mget.side_effect = lambda keys: [store.get(key) for key in keys]
+        node.delete.side_effect = (
+            lambda *keys: len([store.pop(key) for key in keys]))
+        node.ping.return_value = True
+
+        def pipeline(transaction):
+            node_pipeline = mock.Mock()
+            node_pipeline.commands = []
+            node_pipeline.get.side_effect = (
+                lambda key: node_pipeline.commands.append(store.get(key)))
+            node_pipeline.ttl.side_effect = (
+                lambda key: node_pipeline.commands.append(10))
+            node_pipeline.execute.side_effect = (
+                lambda: node_pipeline.commands)
+            return node_pipeline
+
+        node.pipeline.side_effect = pipeline
+        return node
+
+    def test_keys_are_written_to_their_node(self):
+        for key in self.keys:
+            node = self.sharded_redis.ring.get_node(key)
+            self.assertEqual(self.stores[node][key], 'value-' + key)
+
+        self.assertTrue(all(self.stores.values()))
+        self.assertEqual(
+            sum(len(store) for store in self.stores.values()),
+            len(self.keys))
+
+    def test_get_and_ttl_read_from_key_node(self):
+        self.assertEqual(self.sharded_redis.get('key1'), 'value-key1')
+        self.assertEqual(self.sharded_redis.ttl('key1'), 10)
+
+    def test_mget_is_split_per_node(self):
+        keys = self.keys + ['missing']
+
+        values = self.sharded_redis.mget(keys)
+
+        self.assertEqual(
+            values, ['value-' + key for key in self.keys] + [None])
+        self.assertEqual(self.nodes['a'].mget.call_count, 1)
+        self.assertEqual(self.nodes['b'].mget.call_count, 1)
+
+    def test_delete_is_split_per_node(self):
+        self.assertEqual(self.sharded_redis.delete(*self.keys), len(self.keys))
+        self.assertFalse(any(self.stores.values()))
+
+    def test_ping_checks_every_node(self):
+        self.assertTrue(self.sharded_redis.ping())
+
+        self.nodes['b'].ping.side_effect = redis.ConnectionError
+
+        with self.assertRaises(redis.ConnectionError):
+            self.sharded_redis.ping()
+
+    def test_pipeline_results_are_returned_in_order(self):
+        pipeline = self.sharded_redis.pipeline(transaction=False)
+        for key in self.keys:
+            pipeline.get(key).ttl(key)
+
+        results = pipeline.execute()
+
+        self.assertEqual(results, [
+            result for key in self.keys for result in ('value-' + key, 10)])
+        self.assertEqual(pipeline.commands, [])
+
+
+class TestGetCacheRedisClient(AppTest):
+
+    def test_cache_shares_redis_without_cache_nodes(self):
+        self.assertEqual(
+            get_cache_redis_client(self.mock_redis), self.mock_redis)
+
+    def test_cache_nodes_are_sharded(self):
+        with mock.patch.dict(
+                os.environ, {'REDIS_CACHE_URLS': 'cache1,cache2:6380'}):
+            cache_redis_client = get_cache_redis_client(self.mock_redis)
+
+        self.assertEqual(
+            sorted(cache_redis_client.nodes), ['cache1', 'cache2:6380'])
+        self.assertEqual(
+            cache_redis_client.nodes['cache2:6380'].connection_pool.
+            connection_kwargs['port'], 6380)
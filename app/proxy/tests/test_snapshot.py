@@ -0,0 +1,228 @@
+import StringIO
+import time
+from unittest import TestCase
+
+import mock
+
+from proxy.metadata import MetadataClient
+from proxy.replicas import ReplicaRedis
+from proxy.sharding import ShardedRedis, get_nodes
+from proxy.snapshot import (
+    SNAPSHOT_MAGIC, SnapshotExporter, SnapshotImporter, get_parser)
+
+
+class FakeNode(object):
+    # Just enough of a redis client to export from and import into.
+
+    def __init__(self, values=None, ttls=None):
+        self.values = dict(values or {})
+        self.ttls = dict(ttls or {})
+        self.pipelines = 0
+
+    def scan_iter(self, match, count):
+        prefix = match.rstrip('*')
+        return iter(sorted(
+            key for key in self.values if key.startswith(prefix)))
+
+    def pipeline(self, transaction):
+        self.pipelines += 1
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    def __init__(self, node):
+        self.node = node
+        self.results = []
+
+    def get(self, key):
+        self.results.append(self.node.values.get(key))
+        return self
+
+    def pttl(self, key):
+        self.results.append(self.node.ttls.get(key, -1))
+        return self
+
+    def set(self, key, value, px=None, nx=False):
+        if nx and key in self.node.values:
+            self.results.append(None)
+        else:
+            self.node.values[key] = value
+            self.node.ttls[key] = px if px is not None else -1
+            self.results.append(True)
+        return self
+
+    def execute(self):
+        results, self.results = self.results, []
+        return results
+
+
+class SnapshotTest(TestCase):
+
+    def setUp(self):
+        self.source = FakeNode(
+            values={
+                'embedly:http://example.com/1': '{"url": 1}',
+                'embedly:http://example.com/2': '{"url": 2}',
+                'embedly:http://example.com/3': (
+                    MetadataClient.IN_JOB_QUEUE_JSON),
+                'mozilla:http://example.com/1': '{"url": 1}',
+                'mozilla:http://example.com/2': '{"url": 2}',
+                'POCKET_RECOMMENDED_URLS': '[]',
+            },
+            ttls={
+                'embedly:http://example.com/1': 60000,
+                'embedly:http://example.com/2': 60000,
+                'embedly:http://example.com/3': 60000,
+                'mozilla:http://example.com/1': 60000,
+            },
+        )
+
+    def export(self, services=('embedly', 'mozilla'), batch_size=2):
+        snapshot_file = StringIO.StringIO()
+        stats = SnapshotExporter(
+            self.source, services, batch_size, output=StringIO.StringIO(),
+        ).run(snapshot_file)
+        snapshot_file.seek(0)
+        return stats, snapshot_file
+
+    def restore(self, snapshot_file, target, rate=0, overwrite=False):
+        return SnapshotImporter(
+            target, rate, overwrite, output=StringIO.StringIO(),
+        ).run(snapshot_file)
+
+
+class TestSnapshotExporter(SnapshotTest):
+
+    def test_export_skips_sentinels_and_other_keys(self):
+        stats, snapshot_file = self.export()
+
+        self.assertEqual(stats['keys'], 4)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(stats['bytes'], len(snapshot_file.getvalue()) - 18)
+        self.assertTrue(snapshot_file.getvalue().startswith(SNAPSHOT_MAGIC))
+
+    def test_export_is_chunked_by_batch(self):
+        self.export(batch_size=2)
+
+        self.assertEqual(self.source.pipelines, 3)
+
+    def test_export_single_service(self):
+        stats, _ = self.export(services=['mozilla'])
+
+        self.assertEqual(stats['keys'], 2)
+
+    def test_keys_of_any_length_round_trip(self):
+        long_key = 'embedly:http://example.com/{}'.format('a' * 70000)
+        self.source.values = {long_key: '{}'}
+        _, snapshot_file = self.export()
+        target = FakeNode()
+
+        self.restore(snapshot_file, target)
+
+        self.assertEqual(target.values, {long_key: '{}'})
+
+    def test_keys_expired_after_scan_are_skipped(self):
+        self.source.scan_iter = mock.Mock(
+            return_value=iter(['embedly:http://example.com/gone']))
+
+        stats, _ = self.export(services=['embedly'])
+
+        self.assertEqual(stats['keys'], 0)
+        self.assertEqual(stats['skipped'], 1)
+
+
+class TestSnapshotImporter(SnapshotTest):
+
+    def test_import_restores_values_and_ttls(self):
+        _, snapshot_file = self.export()
+        target = FakeNode()
+
+        stats = self.restore(snapshot_file, target)
+
+        self.assertEqual(stats, {'keys': 4, 'expired': 0})
+        self.assertEqual(
+            target.values['embedly:http://example.com/1'], '{"url": 1}')
+        self.assertTrue(
+            50000 < target.ttls['embedly:http://example.com/1'] <= 60000)
+        self.assertEqual(target.ttls['mozilla:http://example.com/2'], -1)
+        self.assertNotIn('embedly:http://example.com/3', target.values)
+        self.assertNotIn('POCKET_RECOMMENDED_URLS', target.values)
+
+    def test_import_skips_keys_expired_since_export(self):
+        _, snapshot_file = self.export()
+        target = FakeNode()
+
+        with mock.patch('proxy.snapshot.time.time',
+                        return_value=time.time() + 120):
+            stats = self.restore(snapshot_file, target)
+
+        self.assertEqual(stats, {'keys': 1, 'expired': 3})
+        self.assertEqual(target.values.keys(), [
+            'mozilla:http://example.com/2'])
+
+    def test_import_keeps_existing_keys_unless_overwriting(self):
+        _, snapshot_file = self.export()
+        target = FakeNode(values={'mozilla:http://example.com/2': 'new'})
+
+        self.restore(snapshot_file, target)
+
+        self.assertEqual(target.values['mozilla:http://example.com/2'], 'new')
+
+        snapshot_file.seek(0)
+        self.restore(snapshot_file, target, overwrite=True)
+
+        self.assertEqual(
+            target.values['mozilla:http://example.com/2'], '{"url": 2}')
+
+    def test_import_is_rate_limited(self):
+        _, snapshot_file = self.export()
+
+        with mock.patch('proxy.snapshot.time.sleep') as mock_sleep:
+            self.restore(snapshot_file, FakeNode(), rate=1)
+
+        self.assertTrue(mock_sleep.called)
+
+    def test_import_rejects_other_files(self):
+        with self.assertRaises(ValueError):
+            self.restore(StringIO.StringIO('urls.txt'), FakeNode())
+
+    def test_import_rejects_truncated_snapshots(self):
+        _, snapshot_file = self.export()
+        snapshot = snapshot_file.getvalue()
+
+        for length in (len(snapshot) - 1, 20):
+            with self.assertRaises(ValueError) as cm:
+                self.restore(
+                    StringIO.StringIO(snapshot[:length]), FakeNode())
+
+            self.assertEqual(cm.exception.message, 'Truncated snapshot.')
+
+
+class TestGetNodes(TestCase):
+
+    def test_single_node(self):
+        node = FakeNode()
+
+        self.assertEqual(get_nodes(node), [node])
+
+    def test_sharded_nodes_behind_replicas(self):
+        nodes = {'b': FakeNode(), 'a': FakeNode()}
+        cache_redis_client = ReplicaRedis(ShardedRedis(nodes), [FakeNode()])
+
+        self.assertEqual(
+            get_nodes(cache_redis_client), [nodes['a'], nodes['b']])
+
+
+class TestParser(TestCase):
+
+    def test_commands(self):
+        parser = get_parser()
+
+        args = parser.parse_args(['export', 'cache.snap'])
+        self.assertEqual(args.command, 'export')
+        self.assertEqual(args.service, None)
+
+        args = parser.parse_args(['import', 'cache.snap', '--overwrite'])
+        self.assertTrue(args.overwrite)
+        self.assertEqual(args.rate, 5000)
@@ -2,8 +2,10 @@ import time
 import json
 
 from proxy.tasks import (
-    fetch_embedly_data, fetch_mozilla_data, fetch_recommended_urls)
+    fetch_embedly_data, fetch_mozilla_data, fetch_provider_chain_data,
+    fetch_recommended_urls)
 from proxy.tests.test_metadata import MozillaClientTest, EmbedlyClientTest
+from proxy.pocket import PocketClient
 from proxy.tests.test_pocket import PocketClientTest
 
 
@@ -43,6 +45,25 @@ class TestFetchMozillaDataTask(MozillaClientTest):
             self.mock_redis.setex.call_count, len(self.sample_urls))
 
 
+class TestFetchProviderChainDataTask(MozillaClientTest):
+
+    def test_task_fetches_data_and_caches(self):
+        mozilla_data = self.get_mock_urls_data(self.sample_urls)
+
+        self.mock_requests_post.return_value = self.get_mock_response(
+            content=json.dumps(mozilla_data))
+        self.mock_redis.lrange.return_value = []
+
+        fetch_provider_chain_data(
+            self.sample_urls, time.time(), redis_client=self.mock_redis)
+
+        self.assertEqual(self.mock_requests_post.call_count, 1)
+        self.assertEqual(self.mock_requests_get.call_count, 0)
+        self.assertEqual(self.mock_redis.delete.call_count, 1)
+        self.assertEqual(
+            self.mock_redis.setex.call_count, len(self.sample_urls))
+
+
 class TestFetchRecommendedUrlsTask(PocketClientTest):
 
     def test_task_fetches_data_and_caches(self):
@@ -53,4 +74,27 @@ class TestFetchRecommendedUrlsTask(PocketClientTest):
 
         self.assertEqual(self.mock_requests_get.call_count, 1)
         self.assertEqual(self.mock_redis.get.call_count, 0)
-        self.assertEqual(self.mock_redis.setex.call_count, 1)
+        mock_pipeline = self.mock_redis.pipeline.return_value
+        self.assertEqual(mock_pipeline.setex.call_count, 1)
+        self.assertEqual(mock_pipeline.execute.call_count, 1)
+
+    def test_task_releases_refresh_lock(self):
+        self.mock_requests_get.return_value = self.get_mock_response(
+            content=json.dumps(self.sample_pocket_data))
+
+        fetch_recommended_urls(
+            time.time(), 'token', redis_client=self.mock_redis)
+
+        self.mock_redis.register_script.return_value.assert_called_with(
+            keys=['POCKET_RECOMMENDED_URLS_REFRESH_LOCK'], args=['token'])
+
+    def test_task_keeps_refresh_lock_if_fetch_fails(self):
+        self.mock_requests_get.return_value = self.get_mock_response(
+            status=500)
+
+        with self.assertRaises(PocketClient.PocketException):
+            fetch_recommended_urls(
+                time.time(), 'token', redis_client=self.mock_redis)
+
+        self.assertEqual(
+            self.mock_redis.register_script.return_value.call_count, 0)
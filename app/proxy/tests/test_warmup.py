@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import StringIO
+
+import mock
+
+from proxy.app import get_embedly_client
+from proxy.tests.base import AppTest
+from proxy.warmup import CacheWarmer, canonicalize_url, get_parser
+
+
+class TestCanonicalizeUrl(AppTest):
+
+    def test_scheme_and_host_are_lowercased(self):
+        self.assertEqual(
+            canonicalize_url(' HTTP://WWW.Example.COM/Path?Q=A#Frag\n'),
+            u'http://www.example.com/Path?Q=A#Frag')
+
+    def test_rest_of_url_is_kept(self):
+        self.assertEqual(
+            canonicalize_url('https://example.com?'),
+            u'https://example.com?')
+        self.assertEqual(
+            canonicalize_url(u'http://example.com/中'.encode('utf8')),
+            u'http://example.com/中')
+
+    def test_invalid_lines_are_skipped(self):
+        for line in ['', '  \n', '# comment', 'ftp://example.com/',
+                     'example.com/page', 'http:///path', '\xff\xfe']:
+            self.assertIsNone(canonicalize_url(line))
+
+
+class CacheWarmerTest(AppTest):
+
+    def setUp(self):
+        super(CacheWarmerTest, self).setUp()
+
+        mock_sleep_patcher = mock.patch('proxy.warmup.time.sleep')
+        self.mock_sleep = mock_sleep_patcher.start()
+        self.addCleanup(mock_sleep_patcher.stop)
+
+        self.mock_domain_limiter.checked_insert.return_value = True
+        self.mock_job_queue.count = 0
+
+        self.embedly_client = get_embedly_client(
+            self.mock_redis, self.mock_job_queue)
+        self.output = StringIO.StringIO()
+
+    def get_warmer(self, **kwargs):
+        warmer_kwargs = {
+            'batch_size': 2,
+            'rate': 0,
+            'max_queue_size': 10,
+            'limit_retries': 2,
+            'progress_interval': 0,
+            'output': self.output,
+        }
+        warmer_kwargs.update(kwargs)
+
+        return CacheWarmer(self.embedly_client, **warmer_kwargs)
+
+    def get_lines(self, count):
+        return ['http://example.com/{}\n'.format(i) for i in range(count)]
+
+
+class TestCacheWarmer(CacheWarmerTest):
+
+    def test_uncached_urls_are_queued_at_back_in_batches(self):
+        stats = self.get_warmer().run(self.get_lines(5))
+
+        self.assertEqual(stats['lines'], 5)
+        self.assertEqual(stats['queued'], 5)
+        self.assertEqual(self.mock_redis.mget.call_count, 3)
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 3)
+        self.assertFalse(
+            self.mock_job_queue.enqueue.call_args[1]['at_front'])
+
+    def test_cached_and_invalid_lines_are_not_queued(self):
+        self.mock_redis.get.side_effect = lambda key: (
+            '{}' if key.endswith('/0') else None)
+
+        stats = self.get_warmer(batch_size=4).run(
+            self.get_lines(2) + ['not a url\n', 'HTTP://example.com/1\n'])
+
+        self.assertEqual(stats['cached'], 1)
+        self.assertEqual(stats['invalid'], 1)
+        self.assertEqual(stats['queued'], 1)
+
+    def test_blocked_and_unusable_hosts_are_not_queued(self):
+        stats = self.get_warmer(batch_size=4).run([
+            'http://embedly.com/page\n',
+            'http://-example.com/\n',
+            'http://foo_bar.example.com/\n',
+        ])
+
+        self.assertEqual(stats['invalid'], 2)
+        self.assertEqual(stats['queued'], 1)
+        self.mock_job_queue.enqueue.assert_called_once_with(
+            self.embedly_client.TASK, [u'http://foo_bar.example.com/'],
+            mock.ANY, ttl=mock.ANY, at_front=False)
+        self.mock_domain_limiter.checked_insert.assert_called_once_with(
+            'foo_bar.example.com')
+
+    def test_resume_from_offset(self):
+        stats = self.get_warmer().run(iter(self.get_lines(5)), offset=3)
+
+        self.assertEqual(stats['lines'], 2)
+        self.assertIn('offset=5 ', self.output.getvalue())
+        self.mock_job_queue.enqueue.assert_called_once_with(
+            self.embedly_client.TASK,
+            [u'http://example.com/3', u'http://example.com/4'],
+            mock.ANY, ttl=mock.ANY, at_front=False)
+
+    def test_domain_limited_urls_are_retried(self):
+        self.mock_domain_limiter.checked_insert.side_effect = [
+            True, False, False, True]
+
+        stats = self.get_warmer().run(self.get_lines(2))
+
+        self.assertEqual(stats['queued'], 2)
+        self.assertEqual(stats['rate_limited'], 0)
+        self.assertEqual(self.mock_sleep.call_count, 2)
+
+    def test_domain_limited_urls_are_dropped_after_retries(self):
+        self.mock_domain_limiter.checked_insert.return_value = False
+
+        stats = self.get_warmer().run(self.get_lines(2))
+
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['rate_limited'], 2)
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 0)
+
+    def test_admission_does_not_hold_urls_back(self):
+        self.embedly_client.admission_policies = {
+            'embedly': {'min_requests': 5, 'reject': 'skip'}}
+
+        stats = self.get_warmer().run(self.get_lines(2))
+
+        self.assertEqual(stats['queued'], 2)
+        self.assertEqual(stats['rate_limited'], 0)
+        self.assertEqual(self.mock_sleep.call_count, 0)
+
+    def test_waits_while_job_queue_is_full(self):
+        type(self.mock_job_queue).count = mock.PropertyMock(
+            side_effect=[10, 10, 3, 3])
+
+        self.get_warmer().run(self.get_lines(1))
+
+        self.mock_sleep.assert_has_calls([mock.call(1), mock.call(1)])
+
+    def test_rate_limits_queued_urls(self):
+        self.get_warmer(rate=2).run(self.get_lines(4))
+
+        self.assertTrue(self.mock_sleep.call_args[0][0] > 1.5)
+
+    def test_progress_is_reported(self):
+        self.get_warmer(progress_interval=3600).run(self.get_lines(3))
+
+        self.assertEqual(self.output.getvalue().count('\n'), 1)
+        self.assertIn('offset=3 lines=3', self.output.getvalue())
+
+
+class TestWarmupParser(AppTest):
+
+    def test_defaults(self):
+        args = get_parser().parse_args([])
+
+        self.assertEqual(args.path, '-')
+        self.assertEqual(args.service, 'embedly')
+        self.assertEqual(args.offset, 0)
@@ -0,0 +1,285 @@
+from unittest import TestCase
+
+import gevent
+import gevent.pool
+import mock
+import redis
+from rq.exceptions import DequeueTimeout
+
+from proxy.app import get_job_executor, get_redis_connection_pool
+from proxy.tests.base import AppTest
+from proxy.worker import JobExecutor, ProcessSupervisor, get_parser
+
+
+class JobExecutorTest(TestCase):
+
+    def setUp(self):
+        mock_statsd_patcher = mock.patch('proxy.worker.statsd_client')
+        self.mock_statsd = mock_statsd_patcher.start()
+        self.addCleanup(mock_statsd_patcher.stop)
+
+        self.jobs = []
+        mock_dequeue_patcher = mock.patch(
+            'proxy.worker.Queue.dequeue_any', side_effect=self.dequeue)
+        self.mock_dequeue = mock_dequeue_patcher.start()
+        self.addCleanup(mock_dequeue_patcher.stop)
+
+        self.executor = JobExecutor(
+            mock.Mock(), concurrency=2, default_timeout=1,
+            shutdown_timeout=1, poll_timeout=0.01)
+
+    def dequeue(self, queues, timeout, connection):
+        # Like the blocking redis read it stands in for, this yields to the
+        # running jobs.
+        gevent.sleep(0.001)
+
+        if not self.jobs:
+            raise DequeueTimeout(timeout, queues)
+
+        return self.jobs.pop(0), queues[0]
+
+    def get_job(self, perform=None, timeout=None):
+        job = mock.Mock()
+        job.timeout = timeout
+        job.perform.side_effect = perform
+        return job
+
+
+class TestJobExecutor(JobExecutorTest):
+
+    def test_jobs_run_concurrently(self):
+        running = []
+        overlapped = []
+
+        def perform():
+            running.append(1)
+            gevent.sleep(0.01)
+            overlapped.append(len(running))
+            running.pop()
+
+        jobs = [self.get_job(perform) for _ in range(4)]
+        self.jobs.extend(jobs)
+
+        self.executor.work(burst=True)
+
+        self.assertEqual(max(overlapped), 2)
+        for job in jobs:
+            self.assertEqual(job.perform.call_count, 1)
+            job.delete.assert_called_once_with(remove_from_queue=False)
+        self.assertEqual(
+            self.mock_statsd.incr.call_args_list,
+            [mock.call('worker_job_success')] * 4)
+
+    def test_failed_job_does_not_stop_others(self):
+        def fail():
+            raise ValueError()
+
+        failed_job = self.get_job(fail)
+        job = self.get_job()
+        self.jobs.extend([failed_job, job])
+
+        self.executor.work(burst=True)
+
+        self.assertEqual(job.perform.call_count, 1)
+        failed_job.delete.assert_called_once_with(remove_from_queue=False)
+        self.mock_statsd.incr.assert_any_call('worker_job_fail')
+
+    def test_job_timeout(self):
+        job = self.get_job(lambda: gevent.sleep(1), timeout=0.01)
+
+        self.executor.run_job(job)
+
+        self.mock_statsd.incr.assert_called_once_with('worker_job_timeout')
+        self.assertEqual(job.delete.call_count, 1)
+
+    def test_timed_out_job_is_dropped(self):
+        job = self.get_job()
+        job.perform.side_effect = JobExecutor.JobTimeoutException
+
+        self.executor.run_job(job)
+
+        self.mock_statsd.incr.assert_called_once_with('worker_job_timeout')
+        self.assertEqual(job.delete.call_count, 1)
+
+    def test_default_timeout(self):
+        self.executor.default_timeout = 0.01
+
+        self.executor.run_job(self.get_job(lambda: gevent.sleep(1)))
+
+        self.mock_statsd.incr.assert_called_once_with('worker_job_timeout')
+
+    def test_empty_queue_is_polled_until_stopped(self):
+        def dequeue(queues, timeout, connection):
+            if self.mock_dequeue.call_count > 2:
+                self.executor.stop()
+            raise DequeueTimeout(timeout, queues)
+
+        self.mock_dequeue.side_effect = dequeue
+
+        self.executor.work()
+
+        self.assertEqual(self.mock_dequeue.call_count, 3)
+
+    def test_stop_while_waiting_for_a_free_slot(self):
+        self.executor.pool = mock.Mock()
+        self.executor.pool.wait_available.side_effect = self.executor.stop
+        self.executor.pool.__len__ = mock.Mock(return_value=0)
+
+        self.executor.work()
+
+        self.assertEqual(self.mock_dequeue.call_count, 0)
+
+    def test_heartbeat_on_every_pass(self):
+        self.executor.worker_registry = mock.Mock()
+        self.jobs.append(self.get_job())
+
+        self.executor.work(burst=True)
+
+        self.assertEqual(self.executor.worker_registry.beat.call_count, 2)
+
+    def test_cleanup_failure(self):
+        job = self.get_job()
+        job.delete.side_effect = redis.RedisError
+        self.jobs.append(job)
+
+        self.executor.work(burst=True)
+
+        self.mock_statsd.incr.assert_any_call('worker_job_cleanup_fail')
+
+    def test_deleted_job_is_skipped(self):
+        self.mock_dequeue.side_effect = [None]
+
+        self.executor.work(burst=True)
+
+        self.assertEqual(self.mock_dequeue.call_count, 1)
+
+    def test_dequeue_failure_is_retried(self):
+        job = self.get_job()
+        self.mock_dequeue.side_effect = [
+            redis.ConnectionError(), (job, None), DequeueTimeout(0, [])]
+
+        with mock.patch('proxy.worker.gevent.sleep') as mock_sleep:
+            self.executor.work(burst=True)
+
+        mock_sleep.assert_called_once_with(0.01)
+
+        self.assertEqual(job.perform.call_count, 1)
+        self.mock_statsd.incr.assert_any_call('worker_dequeue_fail')
+
+    def test_stop_waits_for_running_jobs(self):
+        finished = []
+
+        def perform():
+            self.executor.stop()
+            gevent.sleep(0.01)
+            finished.append(True)
+
+        self.executor.pool = gevent.pool.Pool(1)
+        self.jobs.extend([self.get_job(perform), self.get_job()])
+
+        self.executor.work()
+
+        self.assertEqual(finished, [True])
+        self.assertEqual(len(self.jobs), 1)
+
+    def test_jobs_running_past_shutdown_are_killed(self):
+        finished = []
+
+        def perform():
+            self.executor.stop()
+            gevent.sleep(1)
+            finished.append(True)
+
+        self.executor.shutdown_timeout = 0.01
+        self.jobs.append(self.get_job(perform))
+
+        self.executor.work()
+
+        self.assertEqual(finished, [])
+        self.mock_statsd.gauge.assert_called_once_with(
+            'worker_jobs_killed', 1)
+
+
+class TestProcessSupervisor(TestCase):
+
+    def setUp(self):
+        mock_statsd_patcher = mock.patch('proxy.worker.statsd_client')
+        self.mock_statsd = mock_statsd_patcher.start()
+        self.addCleanup(mock_statsd_patcher.stop)
+
+        mock_popen_patcher = mock.patch('proxy.worker.subprocess.Popen')
+        self.mock_popen = mock_popen_patcher.start()
+        self.mock_popen.side_effect = self.start_child
+        self.addCleanup(mock_popen_patcher.stop)
+
+        self.supervisor = ProcessSupervisor(
+            ['worker'], processes=2, shutdown_timeout=0.05,
+            check_interval=0)
+
+    def start_child(self, command):
+        child = mock.Mock()
+        child.poll.return_value = None
+        child.send_signal.side_effect = (
+            lambda signum: setattr(child.poll, 'return_value', 0))
+        return child
+
+    def test_dead_children_are_replaced(self):
+        self.supervisor.children = [
+            self.start_child(None), self.start_child(None)]
+        dead_child = self.supervisor.children[1]
+        dead_child.poll.return_value = -11
+
+        self.supervisor.check_children()
+
+        self.assertNotEqual(self.supervisor.children[1], dead_child)
+        self.mock_popen.assert_called_once_with(['worker'])
+        self.mock_statsd.incr.assert_called_once_with(
+            'worker_process_restart')
+
+    def test_run_until_stopped(self):
+        def check_children():
+            self.supervisor.stop()
+
+        self.supervisor.check_children = check_children
+
+        self.supervisor.run()
+
+        self.assertEqual(self.mock_popen.call_count, 2)
+        for child in self.supervisor.children:
+            self.assertEqual(child.send_signal.call_count, 1)
+            self.assertEqual(child.kill.call_count, 0)
+
+    def test_children_not_exiting_are_killed(self):
+        stuck_child = self.start_child(None)
+        stuck_child.send_signal.side_effect = None
+        exited_child = self.start_child(None)
+        exited_child.poll.return_value = 0
+        self.supervisor.children = [stuck_child, exited_child]
+
+        self.supervisor.shutdown()
+
+        self.assertEqual(stuck_child.kill.call_count, 1)
+        self.assertEqual(exited_child.send_signal.call_count, 0)
+
+
+class TestGetJobExecutor(AppTest):
+
+    def test_executor_uses_the_job_queue(self):
+        executor = get_job_executor(job_queue=self.mock_job_queue)
+
+        self.assertEqual(executor.job_queue, self.mock_job_queue)
+        self.assertEqual(executor.concurrency, 20)
+        self.assertEqual(
+            executor.worker_registry.redis_client,
+            self.mock_job_queue.connection)
+
+    def test_connection_pools_are_shared(self):
+        self.assertIs(
+            get_redis_connection_pool('test', 'redis'),
+            get_redis_connection_pool('test', 'redis'))
+
+    def test_parser(self):
+        args = get_parser().parse_args(['--processes', '4'])
+
+        self.assertEqual(args.processes, 4)
+        self.assertFalse(args.child)
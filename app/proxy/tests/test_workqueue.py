@@ -0,0 +1,336 @@
+import os
+from unittest import TestCase
+
+import gevent
+import mock
+import redis
+
+from proxy.app import get_embedly_client
+from proxy.metadata import MetadataClient
+from proxy.tests.base import AppTest
+from proxy.workqueue import URLQueue, URLQueueWorker, get_parser
+
+
+class FakeRedis(object):
+    # Just enough list and sorted set commands to hold URL queues.
+
+    def __init__(self):
+        self.lists = {}
+        self.sorted_sets = {}
+
+    def lpush(self, key, *values):
+        for value in values:
+            self.lists.setdefault(key, []).insert(0, value)
+
+    def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+
+    def blpop(self, key, timeout):
+        if self.lists.get(key):
+            return key, self.lists[key].pop(0)
+
+    def lrange(self, key, start, end):
+        return self.lists.get(key, [])[start:end + 1]
+
+    def ltrim(self, key, start, end):
+        self.lists[key] = self.lists.get(key, [])[start:]
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    def zadd(self, key, *pairs):
+        self.sorted_sets.setdefault(key, {}).update(
+            zip(pairs[1::2], pairs[::2]))
+
+    def zrem(self, key, *members):
+        for member in members:
+            self.sorted_sets.get(key, {}).pop(member, None)
+
+    def zrange(self, key, start, end, withscores):
+        return sorted(
+            self.sorted_sets.get(key, {}).items(),
+            key=lambda item: item[1])[start:end + 1]
+
+    def pipeline(self, transaction):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    # Queues commands and runs them against the FakeRedis on execute.
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((getattr(self.redis_client, name), args,
+                                  kwargs))
+        return command
+
+    def execute(self):
+        return [command(*args, **kwargs)
+                for command, args, kwargs in self.commands]
+
+
+class URLQueueTest(TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.url_queue = URLQueue(self.redis)
+
+    def popped_urls(self, count=10):
+        return [
+            url for url, _ in self.url_queue.pop('embedly', count, 1)]
+
+
+class TestURLQueue(URLQueueTest):
+
+    def test_urls_are_popped_in_order(self):
+        self.url_queue.push('embedly', ['a', 'b'], at_front=False)
+        self.url_queue.push('embedly', ['c', 'd'], at_front=True)
+
+        self.assertEqual(self.url_queue.count('embedly'), 4)
+        self.assertEqual(self.url_queue.count('mozilla'), 0)
+        self.assertEqual(self.popped_urls(3), ['c', 'd', 'a'])
+        self.assertEqual(self.popped_urls(3), ['b'])
+        self.assertEqual(self.popped_urls(3), [])
+
+    def test_entries_are_timestamped(self):
+        with mock.patch('proxy.workqueue.time.time', return_value=100.0):
+            self.url_queue.push('embedly', [u'http://example.com/\u4e2d'])
+
+        self.assertEqual(
+            self.url_queue.pop('embedly', 10, 1),
+            [(u'http://example.com/\u4e2d', 100.0)])
+
+    def test_oldest_entry_is_found_wherever_it_was_pushed(self):
+        for queued_at, url, at_front in (
+                (200.0, 'b', True), (100.0, 'a', False), (300.0, 'c', True)):
+            with mock.patch(
+                    'proxy.workqueue.time.time', return_value=queued_at):
+                self.url_queue.push('embedly', [url], at_front=at_front)
+
+        self.assertEqual(
+            self.url_queue.get_oldest_queued_at('embedly'), 100.0)
+
+        self.url_queue.pop('embedly', 3, 1)
+
+        self.assertEqual(self.url_queue.get_oldest_queued_at('embedly'), None)
+        self.assertEqual(self.redis.sorted_sets['URL_QUEUE_TIMES:embedly'], {})
+
+    def test_no_urls_pushes_nothing(self):
+        self.url_queue.push('embedly', [])
+
+        self.assertEqual(self.redis.lists, {})
+
+    def test_redis_errors_raise_exception(self):
+        self.url_queue.redis_client = mock_redis = mock.Mock()
+        mock_redis.pipeline.return_value.execute.side_effect = (
+            redis.RedisError)
+        mock_redis.blpop.side_effect = redis.RedisError
+        mock_redis.llen.side_effect = redis.RedisError
+
+        with self.assertRaises(URLQueue.URLQueueException):
+            self.url_queue.push('embedly', ['a'])
+
+        with self.assertRaises(URLQueue.URLQueueException):
+            self.url_queue.pop('embedly', 10, 1)
+
+        with self.assertRaises(URLQueue.URLQueueException):
+            self.url_queue.count('embedly')
+
+
+class TestURLQueueWorker(URLQueueTest):
+
+    def setUp(self):
+        super(TestURLQueueWorker, self).setUp()
+
+        mock_statsd_patcher = mock.patch('proxy.workqueue.statsd_client')
+        self.mock_statsd = mock_statsd_patcher.start()
+        self.addCleanup(mock_statsd_patcher.stop)
+
+        self.cached = {'http://example.com/cached': '{}'}
+        self.metadata_client = mock.Mock()
+        self.metadata_client.SERVICE_NAME = 'embedly'
+        self.metadata_client.url_batch_size = 2
+        self.metadata_client.MetadataClientException = (
+            MetadataClient.MetadataClientException)
+        self.metadata_client.get_completed_urls.side_effect = (
+            lambda urls: {
+                url: self.cached[url] for url in urls if url in self.cached})
+        self.metadata_client.get_remote_urls.side_effect = (
+            lambda urls: {url: '{}' for url in urls})
+
+        self.worker = URLQueueWorker(
+            self.metadata_client, self.url_queue, batch_size=10,
+            concurrency=2, fetch_timeout=1, shutdown_timeout=1,
+            poll_timeout=0.01)
+
+    def fetched_batches(self):
+        return [
+            fetch_call[0][0] for fetch_call
+            in self.metadata_client.get_remote_urls.call_args_list]
+
+    def test_urls_from_many_requests_are_fetched_in_full_batches(self):
+        for url in ['a', 'b', 'c']:
+            self.url_queue.push('embedly', [url])
+        self.url_queue.push('embedly', ['a', 'http://example.com/cached'])
+
+        self.worker.work(burst=True)
+
+        self.assertEqual(self.fetched_batches(), [['a', 'c'], ['b']])
+        self.assertEqual(self.url_queue.count('embedly'), 0)
+        self.mock_statsd.gauge.assert_any_call('url_queue_drained', 5)
+        self.mock_statsd.gauge.assert_any_call('url_queue_already_cached', 1)
+        self.assertEqual(self.mock_statsd.timing.call_count, 3)
+
+    def test_queue_is_drained_in_bulk(self):
+        self.url_queue.push('embedly', [str(i) for i in range(25)])
+
+        with mock.patch.object(
+                self.url_queue, 'pop', wraps=self.url_queue.pop) as mock_pop:
+            self.worker.work(burst=True)
+
+        self.assertEqual(mock_pop.call_count, 4)
+        self.assertEqual(self.metadata_client.get_remote_urls.call_count, 13)
+
+    def test_heartbeat_on_every_pass(self):
+        self.worker.worker_registry = mock.Mock()
+        self.url_queue.push('embedly', ['a'])
+
+        self.worker.work(burst=True)
+
+        self.assertEqual(self.worker.worker_registry.beat.call_count, 2)
+
+    def test_fetch_failure(self):
+        self.metadata_client.get_remote_urls.side_effect = (
+            MetadataClient.MetadataClientException)
+        self.url_queue.push('embedly', ['a'])
+
+        self.worker.work(burst=True)
+
+        self.mock_statsd.incr.assert_called_once_with('url_queue_fetch_fail')
+
+    def test_fetch_timeout(self):
+        self.worker.fetch_timeout = 0.01
+        self.metadata_client.get_remote_urls.side_effect = (
+            lambda urls: gevent.sleep(1))
+        self.url_queue.push('embedly', ['a'])
+
+        self.worker.work(burst=True)
+
+        self.mock_statsd.incr.assert_called_once_with(
+            'url_queue_fetch_timeout')
+
+    def test_timed_out_fetch_is_counted(self):
+        self.metadata_client.get_remote_urls.side_effect = (
+            URLQueueWorker.FetchTimeoutException)
+
+        self.worker.fetch_batch(['a'], {'a': 0})
+
+        self.mock_statsd.incr.assert_called_once_with(
+            'url_queue_fetch_timeout')
+
+    def test_cache_check_failure_fetches_every_url(self):
+        self.metadata_client.get_completed_urls.side_effect = (
+            MetadataClient.MetadataClientException)
+        self.url_queue.push('embedly', ['http://example.com/cached'])
+
+        self.worker.work(burst=True)
+
+        self.assertEqual(
+            self.fetched_batches(), [['http://example.com/cached']])
+
+    def test_pop_failure_is_retried(self):
+        self.url_queue.pop = mock.Mock(side_effect=[
+            URLQueue.URLQueueException(), [('a', 0)], []])
+
+        with mock.patch('proxy.workqueue.gevent.sleep') as mock_sleep:
+            self.worker.work(burst=True)
+
+        mock_sleep.assert_called_once_with(0.01)
+        self.assertEqual(self.fetched_batches(), [['a']])
+        self.mock_statsd.incr.assert_called_once_with('url_queue_pop_fail')
+
+    def test_empty_queue_is_polled_until_stopped(self):
+        def pop(service, count, timeout):
+            if self.url_queue.pop.call_count > 2:
+                self.worker.stop()
+            return []
+
+        self.url_queue.pop = mock.Mock(side_effect=pop)
+
+        self.worker.work()
+
+        self.assertEqual(self.url_queue.pop.call_count, 3)
+
+    def test_stop_while_waiting_for_a_free_slot(self):
+        self.worker.pool = mock.Mock()
+        self.worker.pool.wait_available.side_effect = self.worker.stop
+        self.url_queue.pop = mock.Mock()
+
+        self.worker.work()
+
+        self.assertEqual(self.url_queue.pop.call_count, 0)
+
+    def test_fetches_run_concurrently(self):
+        running = []
+        overlapped = []
+
+        def get_remote_urls(urls):
+            running.append(1)
+            gevent.sleep(0.01)
+            overlapped.append(len(running))
+            running.pop()
+            return {}
+
+        self.metadata_client.get_remote_urls.side_effect = get_remote_urls
+        self.url_queue.push('embedly', [str(i) for i in range(8)])
+
+        self.worker.work(burst=True)
+
+        self.assertEqual(max(overlapped), 2)
+
+
+class TestMetadataClientURLQueue(AppTest):
+
+    def setUp(self):
+        super(TestMetadataClientURLQueue, self).setUp()
+
+        with mock.patch.dict(os.environ, {'URL_WORK_QUEUE': '1'}):
+            self.metadata_client = get_embedly_client(
+                self.mock_redis, self.mock_job_queue)
+
+        self.mock_redis.llen.return_value = 3
+
+    def test_urls_are_pushed_instead_of_enqueued(self):
+        self.metadata_client.queue_urls(['a', 'b', 'c', 'd', 'e', 'f'])
+
+        self.assertEqual(self.mock_job_queue.enqueue.call_count, 0)
+        self.mock_redis.pipeline.return_value.lpush.assert_called_once_with(
+            'URL_QUEUE:embedly', *[mock.ANY] * 6)
+        self.assertEqual(self.mock_redis.setex.call_count, 6)
+        self.assertEqual(self.metadata_client.get_queue_size(), 3)
+
+    def test_push_failure(self):
+        self.mock_redis.pipeline.return_value.execute.side_effect = (
+            redis.RedisError)
+
+        self.metadata_client.queue_urls(['a'])
+
+        self.assertEqual(self.mock_redis.setex.call_count, 0)
+
+    def test_rq_is_used_by_default(self):
+        metadata_client = get_embedly_client(
+            self.mock_redis, self.mock_job_queue)
+        self.mock_job_queue.count = 5
+
+        self.assertEqual(metadata_client.url_queue, None)
+        self.assertEqual(metadata_client.get_queue_size(), 5)
+
+    def test_parser(self):
+        args = get_parser().parse_args(['--service', 'mozilla'])
+
+        self.assertEqual(args.service, 'mozilla')
+        self.assertEqual(args.batch_size, None)
@@ -0,0 +1,205 @@
+import argparse
+import itertools
+import sys
+import time
+import urlparse
+
+
+def canonicalize_url(line):
+    url = line.strip()
+
+    if not url or url.startswith('#'):
+        return None
+
+    try:
+        url = url.decode('utf8')
+    except UnicodeDecodeError:
+        return None
+
+    parsed = urlparse.urlsplit(url)
+
+    if parsed.scheme.lower() not in ('http', 'https') or not parsed.netloc:
+        return None
+
+    # Only the case insensitive scheme and host are normalized; the rest is
+    # kept byte for byte as it is part of the cache key clients look up.
+    return u'{scheme}://{netloc}{rest}'.format(
+        scheme=parsed.scheme.lower(),
+        netloc=parsed.netloc.lower(),
+        rest=url[len(parsed.scheme) + 3 + len(parsed.netloc):],
+    )
+
+
+class CacheWarmer(object):
+    # Streams a URL list through the metadata client's cache check, domain
+    # limiter and job queue.  Jobs go to the back of the queue so organic
+    # misses are still fetched first.  The URLs are queued whatever the
+    # admission policy, so only the domain limiter holds any back.  They are
+    # checked by the same preprocessor as requested URLs, and those it drops
+    # as unusable or blocked are counted as invalid.
+
+    def __init__(self, metadata_client, batch_size, rate, max_queue_size,
+                 limit_retries, progress_interval, output=sys.stderr):
+        self.metadata_client = metadata_client
+        self.batch_size = batch_size
+        self.rate = rate
+        self.max_queue_size = max_queue_size
+        self.limit_retries = limit_retries
+        self.progress_interval = progress_interval
+        self.output = output
+        self.stats = {
+            'lines': 0,
+            'invalid': 0,
+            'cached': 0,
+            'queued': 0,
+            'rate_limited': 0,
+        }
+
+    def wait_for_queue(self):
+        while self.metadata_client.get_queue_size() >= self.max_queue_size:
+            time.sleep(1)
+
+    def throttle(self, started):
+        # Sleeps until the URLs queued so far fit within the rate.
+        if self.rate:
+            ahead = self.stats['queued'] / float(self.rate) - (
+                time.time() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def queue_urls(self, urls, netlocs=None):
+        for attempt in range(self.limit_retries + 1):
+            if attempt:
+                # The domain limiter counts per second.
+                time.sleep(1)
+
+            queued_urls = self.metadata_client.queue_urls(
+                urls, at_front=False, netlocs=netlocs, admission=False)
+            self.stats['queued'] += len(queued_urls)
+
+            queued_urls = set(queued_urls)
+            urls = [url for url in urls if url not in queued_urls]
+
+            if not urls:
+                break
+
+        self.stats['rate_limited'] += len(urls)
+
+    def warm_batch(self, lines):
+        urls = []
+        for line in lines:
+            url = canonicalize_url(line)
+
+            if url is None:
+                self.stats['invalid'] += 1
+            elif url not in urls:
+                urls.append(url)
+
+        netlocs = self.metadata_client.preprocess_urls(urls)
+        self.stats['invalid'] += len(urls) - len(netlocs)
+        urls = netlocs.keys()
+
+        cached_urls = self.metadata_client.get_cached_urls(urls)
+        self.stats['cached'] += len(cached_urls)
+
+        uncached_urls = [
+            uncached_url for uncached_url in urls
+            if uncached_url not in cached_urls]
+        if uncached_urls:
+            self.wait_for_queue()
+            self.queue_urls(uncached_urls, netlocs)
+
+    def report(self, offset, started):
+        elapsed = time.time() - started
+        self.output.write(
+            ('offset={offset} lines={lines} cached={cached} queued={queued} '
+             'invalid={invalid} rate_limited={rate_limited} '
+             'urls_per_second={speed:.1f}\n').format(
+                offset=offset,
+                speed=self.stats['queued'] / elapsed if elapsed else 0,
+                **self.stats))
+
+    def run(self, lines, offset=0):
+        started = last_report = time.time()
+        lines = itertools.islice(lines, offset, None)
+
+        while True:
+            # Read a batch at a time so a list of any length streams through
+            # in constant memory.
+            batch = list(itertools.islice(lines, self.batch_size))
+            if not batch:
+                break
+
+            self.warm_batch(batch)
+            self.stats['lines'] += len(batch)
+            offset += len(batch)
+
+            if time.time() - last_report >= self.progress_interval:
+                self.report(offset, started)
+                last_report = time.time()
+
+            self.throttle(started)
+
+        self.report(offset, started)
+
+        return self.stats
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Queue metadata fetches for a list of URLs, one per '
+                    'line, that are not cached yet.')
+    parser.add_argument(
+        'path', nargs='?', default='-',
+        help='File of URLs, or - for stdin.')
+    parser.add_argument(
+        '--service', choices=['embedly', 'mozilla'], default='embedly',
+        help='Warm the /v2/extract (embedly) or /v2/metadata (mozilla) '
+             'cache.')
+    parser.add_argument(
+        '--offset', type=int, default=0,
+        help='Skip this many lines, to resume from a reported offset.')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument(
+        '--rate', type=float, default=50,
+        help='Most URLs queued per second, 0 for no limit.')
+    parser.add_argument(
+        '--max-queue-size', type=int, default=1000,
+        help='Pause while the job queue holds this many jobs.')
+    parser.add_argument(
+        '--limit-retries', type=int, default=5,
+        help='Times to retry URLs held back by the domain limiter.')
+    parser.add_argument(
+        '--progress-interval', type=float, default=10,
+        help='Seconds between progress lines.')
+    return parser
+
+
+def main():  # pragma: no cover
+    from proxy.app import get_embedly_client, get_provider_chain_client
+
+    args = get_parser().parse_args()
+
+    client_factories = {
+        'embedly': get_embedly_client,
+        'mozilla': get_provider_chain_client,
+    }
+
+    warmer = CacheWarmer(
+        client_factories[args.service](),
+        batch_size=args.batch_size,
+        rate=args.rate,
+        max_queue_size=args.max_queue_size,
+        limit_retries=args.limit_retries,
+        progress_interval=args.progress_interval,
+    )
+
+    if args.path == '-':
+        warmer.run(sys.stdin, args.offset)
+    else:
+        with open(args.path) as lines:
+            warmer.run(lines, args.offset)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,210 @@
+import argparse
+import signal
+import subprocess
+import sys
+import time
+
+import gevent
+import gevent.pool
+import redis
+from rq import Queue
+from rq.exceptions import DequeueTimeout
+
+from proxy.stats import statsd_client
+
+
+class JobExecutor(object):
+    # Runs queued jobs in up to concurrency greenlets of one long lived
+    # process, instead of forking a work horse per job as rq worker does.
+    # The jobs are network bound, so with gevent's monkey patching the
+    # greenlets overlap their upstream and redis waits.
+
+    class JobTimeoutException(Exception):
+        pass
+
+    def __init__(self, job_queue, concurrency, default_timeout,
+                 shutdown_timeout, poll_timeout=1, worker_registry=None):
+        self.job_queue = job_queue
+        self.concurrency = concurrency
+        self.default_timeout = default_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.poll_timeout = poll_timeout
+        self.worker_registry = worker_registry
+        self.pool = gevent.pool.Pool(concurrency)
+        self.stopping = False
+
+    def dequeue(self):
+        try:
+            dequeued = Queue.dequeue_any(
+                [self.job_queue], self.poll_timeout,
+                connection=self.job_queue.connection)
+        except DequeueTimeout:
+            return None
+
+        return dequeued[0] if dequeued else None
+
+    def run_job(self, job):
+        started = time.time()
+
+        # A job that raises or overruns its timeout only ends its own
+        # greenlet.  Like rq worker with the ignore_failed_jobs handler,
+        # failed jobs are dropped rather than kept on the failed queue.
+        try:
+            with gevent.Timeout(job.timeout or self.default_timeout,
+                                self.JobTimeoutException):
+                job.perform()
+            statsd_client.incr('worker_job_success')
+        except self.JobTimeoutException:
+            statsd_client.incr('worker_job_timeout')
+        except Exception:
+            statsd_client.incr('worker_job_fail')
+
+        statsd_client.timing(
+            'worker_job_time', int((time.time() - started) * 1000))
+
+        # Results are not read, so the job is deleted straight away.
+        try:
+            job.delete(remove_from_queue=False)
+        except redis.RedisError:
+            statsd_client.incr('worker_job_cleanup_fail')
+
+    def stop(self):
+        self.stopping = True
+
+    def work(self, burst=False):
+        while not self.stopping:
+            if self.worker_registry is not None:
+                self.worker_registry.beat()
+
+            # Stopping may be asked for while waiting for a free slot.
+            self.pool.wait_available()
+            if self.stopping:
+                break
+
+            try:
+                job = self.dequeue()
+            except redis.RedisError:
+                statsd_client.incr('worker_dequeue_fail')
+                gevent.sleep(self.poll_timeout)
+            else:
+                if job is not None:
+                    self.pool.spawn(self.run_job, job)
+                elif burst:
+                    break
+
+        # Running jobs get the shutdown timeout to finish.  Any still
+        # running are killed; their URLs' sentinels expire on their own.
+        self.pool.join(timeout=self.shutdown_timeout)
+        statsd_client.gauge('worker_jobs_killed', len(self.pool))
+        self.pool.kill()
+
+
+class ProcessSupervisor(object):
+    # Keeps a number of executor processes running.  Each is started once
+    # and runs many jobs, and one that dies, say on a segfault or the OOM
+    # killer, only loses its own jobs and is replaced.
+
+    def __init__(self, command, processes, shutdown_timeout,
+                 check_interval=1):
+        self.command = command
+        self.processes = processes
+        self.shutdown_timeout = shutdown_timeout
+        self.check_interval = check_interval
+        self.children = []
+        self.stopping = False
+
+    def start_child(self):
+        return subprocess.Popen(self.command)
+
+    def check_children(self):
+        for index, child in enumerate(self.children):
+            if child.poll() is not None:
+                statsd_client.incr('worker_process_restart')
+                self.children[index] = self.start_child()
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def shutdown(self):
+        for child in self.children:
+            if child.poll() is None:
+                child.send_signal(signal.SIGTERM)
+
+        deadline = time.time() + self.shutdown_timeout
+        for child in self.children:
+            while child.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+
+            if child.poll() is None:
+                child.kill()
+                child.wait()
+
+    def run(self):
+        self.children = [
+            self.start_child() for _ in range(self.processes)]
+
+        try:
+            while not self.stopping:
+                self.check_children()
+                time.sleep(self.check_interval)
+        finally:
+            self.shutdown()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Run queued fetch jobs in long lived processes, each '
+                    'running many jobs at once.')
+    parser.add_argument(
+        '--processes', type=int,
+        help='Executor processes, default WORKER_PROCESSES.')
+    parser.add_argument(
+        '--concurrency', type=int,
+        help='Jobs run at once per process, default WORKER_CONCURRENCY.')
+    parser.add_argument(
+        '--child', action='store_true',
+        help='Run one executor in this process.')
+    parser.add_argument(
+        '--burst', action='store_true',
+        help='Exit once the queue is empty; implies --child.')
+    return parser
+
+
+def run_child(args):  # pragma: no cover
+    from gevent import monkey
+    monkey.patch_all()
+
+    from proxy.app import get_job_executor
+
+    executor = get_job_executor(concurrency=args.concurrency)
+    gevent.signal(signal.SIGTERM, executor.stop)
+    gevent.signal(signal.SIGINT, executor.stop)
+    executor.work(burst=args.burst)
+
+
+def main():  # pragma: no cover
+    from proxy.app import get_config
+
+    args = get_parser().parse_args()
+    config = get_config()
+
+    if args.child or args.burst:
+        return run_child(args)
+
+    command = [sys.executable, '-m', 'proxy.worker', '--child']
+    if args.concurrency:
+        command += ['--concurrency', str(args.concurrency)]
+
+    supervisor = ProcessSupervisor(
+        command,
+        args.processes or config['WORKER_PROCESSES'],
+        # Children get the same grace period, plus a little to exit.
+        config['WORKER_SHUTDOWN_TIMEOUT'] + 5,
+    )
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    signal.signal(signal.SIGINT, supervisor.stop)
+    supervisor.run()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
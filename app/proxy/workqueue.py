@@ -0,0 +1,247 @@
+import argparse
+import itertools
+import json
+import signal
+import time
+
+import gevent
+import gevent.pool
+import redis
+
+from proxy.metadata import group_by
+from proxy.stats import statsd_client
+
+
+class URLQueue(object):
+    # A redis list of URLs waiting to be fetched, one per service.  Each
+    # entry is just the URL and when it was queued, where an rq job is a
+    # pickled call in a hash plus its registry entries for every batch.
+
+    class URLQueueException(Exception):
+        pass
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    def _get_key(self, service):
+        return 'URL_QUEUE:{service}'.format(service=service)
+
+    def _get_times_key(self, service):
+        return 'URL_QUEUE_TIMES:{service}'.format(service=service)
+
+    def push(self, service, urls, at_front=True):
+        queued_at = time.time()
+        entries = [json.dumps([url, queued_at]) for url in urls]
+
+        if not entries:
+            return
+
+        # Entries pushed at the front and back meet in the middle of the
+        # list, so each is also kept in a sorted set by when it was queued
+        # to find the oldest.
+        try:
+            pipeline = self.redis_client.pipeline(transaction=True)
+            if at_front:
+                # LPUSH adds each value at the head in turn, so the entries
+                # are reversed to keep them in order.
+                pipeline.lpush(self._get_key(service), *reversed(entries))
+            else:
+                pipeline.rpush(self._get_key(service), *entries)
+            pipeline.zadd(
+                self._get_times_key(service),
+                *itertools.chain.from_iterable(
+                    (queued_at, entry) for entry in entries))
+            pipeline.execute()
+        except redis.RedisError:
+            raise self.URLQueueException('Unable to write to redis.')
+
+    def pop(self, service, count, timeout):
+        # Waits for the first entry, then takes up to count - 1 more in one
+        # transaction, so concurrent workers never take the same entry.
+        key = self._get_key(service)
+
+        try:
+            popped = self.redis_client.blpop(key, timeout)
+            if popped is None:
+                return []
+
+            pipeline = self.redis_client.pipeline(transaction=True)
+            pipeline.lrange(key, 0, count - 2)
+            pipeline.ltrim(key, count - 1, -1)
+            more_entries, _ = pipeline.execute()
+
+            entries = [popped[1]] + more_entries
+            self.redis_client.zrem(self._get_times_key(service), *entries)
+        except redis.RedisError:
+            raise self.URLQueueException('Unable to read from redis.')
+
+        return [tuple(json.loads(entry)) for entry in entries]
+
+    def get_oldest_queued_at(self, service):
+        try:
+            pipeline = self.redis_client.pipeline(transaction=True)
+            pipeline.llen(self._get_key(service))
+            pipeline.zrange(
+                self._get_times_key(service), 0, 0, withscores=True)
+            count, oldest = pipeline.execute()
+        except redis.RedisError:
+            raise self.URLQueueException('Unable to read from redis.')
+
+        # Times left behind by a failed pop are not counted once the queue
+        # has emptied.
+        return oldest[0][1] if count and oldest else None
+
+    def count(self, service):
+        try:
+            return self.redis_client.llen(self._get_key(service))
+        except redis.RedisError:
+            raise self.URLQueueException('Unable to read from redis.')
+
+
+class URLQueueWorker(object):
+    # Drains a service's URL queue batch_size entries at a time.  URLs
+    # queued by different requests are fetched together in full provider
+    # batches, up to concurrency batches at once, and URLs another worker
+    # has fetched since they were queued are skipped.
+
+    class FetchTimeoutException(Exception):
+        pass
+
+    def __init__(self, metadata_client, url_queue, batch_size, concurrency,
+                 fetch_timeout, shutdown_timeout, poll_timeout=1,
+                 worker_registry=None):
+        self.metadata_client = metadata_client
+        self.url_queue = url_queue
+        self.service = metadata_client.SERVICE_NAME
+        self.batch_size = batch_size
+        self.fetch_timeout = fetch_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.poll_timeout = poll_timeout
+        self.worker_registry = worker_registry
+        self.pool = gevent.pool.Pool(concurrency)
+        self.stopping = False
+
+    def fetch_batch(self, urls, queued_at):
+        # Like a job run by the executor, a fetch that overruns its timeout
+        # frees its slot in the pool, and its URLs are left to expire from
+        # the queued marker and be queued again.
+        try:
+            with gevent.Timeout(self.fetch_timeout,
+                                self.FetchTimeoutException):
+                url_data = self.metadata_client.get_remote_urls(urls)
+            statsd_client.gauge('url_queue_fetch_cached', len(url_data))
+        except self.FetchTimeoutException:
+            statsd_client.incr('url_queue_fetch_timeout')
+        except self.metadata_client.MetadataClientException:
+            statsd_client.incr('url_queue_fetch_fail')
+
+        now = time.time()
+        for url in urls:
+            statsd_client.timing(
+                'url_queue_fetch_time', int((now - queued_at[url]) * 1000))
+
+    def process(self, entries):
+        # The first time a URL was queued is kept for its timing.
+        queued_at = {}
+        urls = []
+        for url, entry_queued_at in entries:
+            if url not in queued_at:
+                urls.append(url)
+                queued_at[url] = entry_queued_at
+
+        statsd_client.gauge('url_queue_drained', len(entries))
+
+        try:
+            completed_urls = self.metadata_client.get_completed_urls(urls)
+        except self.metadata_client.MetadataClientException:
+            completed_urls = {}
+
+        statsd_client.gauge('url_queue_already_cached', len(completed_urls))
+
+        # Spawning waits for a free slot in the pool.
+        for batch in group_by(
+                [url for url in urls if url not in completed_urls],
+                self.metadata_client.url_batch_size):
+            self.pool.spawn(self.fetch_batch, batch, queued_at)
+
+    def stop(self):
+        self.stopping = True
+
+    def work(self, burst=False):
+        while not self.stopping:
+            if self.worker_registry is not None:
+                self.worker_registry.beat()
+
+            # Only take more URLs once a fetch can start on them.
+            self.pool.wait_available()
+            if self.stopping:
+                break
+
+            try:
+                entries = self.url_queue.pop(
+                    self.service, self.batch_size, self.poll_timeout)
+            except self.url_queue.URLQueueException:
+                statsd_client.incr('url_queue_pop_fail')
+                gevent.sleep(self.poll_timeout)
+            else:
+                if entries:
+                    self.process(entries)
+                elif burst:
+                    break
+
+        self.pool.join(timeout=self.shutdown_timeout)
+        self.pool.kill()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Fetch the URLs queued on a service\'s URL queue.')
+    parser.add_argument(
+        '--service', choices=['embedly', 'mozilla'], default='embedly',
+        help='Drain the /v2/extract (embedly) or /v2/metadata (mozilla) '
+             'queue.')
+    parser.add_argument(
+        '--batch-size', type=int,
+        help='Most URLs taken at once, default URL_QUEUE_BATCH_SIZE.')
+    parser.add_argument(
+        '--concurrency', type=int,
+        help='Batches processed at once, default WORKER_CONCURRENCY.')
+    parser.add_argument(
+        '--burst', action='store_true',
+        help='Exit once the queue is empty.')
+    return parser
+
+
+def main():  # pragma: no cover
+    from gevent import monkey
+    monkey.patch_all()
+
+    from proxy.app import (
+        get_config, get_embedly_client, get_provider_chain_client,
+        get_worker_registry)
+
+    args = get_parser().parse_args()
+    config = get_config()
+
+    client_factories = {
+        'embedly': get_embedly_client,
+        'mozilla': get_provider_chain_client,
+    }
+    metadata_client = client_factories[args.service]()
+
+    worker = URLQueueWorker(
+        metadata_client,
+        URLQueue(metadata_client.redis_client),
+        args.batch_size or config['URL_QUEUE_BATCH_SIZE'],
+        args.concurrency or config['WORKER_CONCURRENCY'],
+        config['WORKER_JOB_TIMEOUT'],
+        config['WORKER_SHUTDOWN_TIMEOUT'],
+        worker_registry=get_worker_registry(metadata_client.redis_client),
+    )
+    gevent.signal(signal.SIGTERM, worker.stop)
+    gevent.signal(signal.SIGINT, worker.stop)
+    worker.work(burst=args.burst)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
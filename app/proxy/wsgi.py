@@ -1,3 +1,6 @@
 from app import create_app
 
 application = create_app()
+
+# Health checks read the report this keeps fresh in the background.
+application.health_monitor.start()